@@ -1,9 +1,15 @@
 import os
 import sys
+import copy
+import time
+import argparse
+import contextlib
 import importlib
+import contextvars
 import datetime
 import json
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -30,6 +36,10 @@ def setup_logger():
     logger = logging.getLogger("collector")
     logger.setLevel(logging.INFO)
     
+    # 常駐モードなどで複数回呼ばれてもハンドラーを重複させない
+    if logger.handlers:
+        return logger
+    
     # ファイルハンドラーの設定
     file_handler = logging.FileHandler(log_file)
     file_handler.setLevel(logging.INFO)
@@ -49,38 +59,483 @@ def setup_logger():
     
     return logger
 
-# 各サービスのローカル版コレクター
-from nook.local.services.reddit_explorer import RedditExplorer
-from nook.local.services.hacker_news import HackerNewsCollector
-from nook.local.services.github_trending import GitHubTrendingCollector
-from nook.local.services.tech_feed import TechFeedCollector
-from nook.local.services.paper_summarizer import PaperSummarizer
+from nook.local.common import clock
+from nook.local.common.circuit_breaker import get_breakers
+from nook.local.common.deadline import RUN_BUDGET, budget, pop_skipped
+from nook.local.common.profiling import profile_collector
+from nook.local.common.quota import all_quotas, pop_tier_stats, remaining_today
+from nook.local.common.ranking import LLM_CALL_BUDGET, group_by_source, select_top
+from nook.local.common.tracing import span, start_tracing, stop_tracing
+
+# 各サービスのローカル版コレクター（キーはデータディレクトリ名）
+# praw・google.generativeai・arxiv・feedparser・bs4などの重い依存を避けるため、
+# モジュールは選択されたコレクターの分だけ実行時にインポートする
+COLLECTORS = {
+    "reddit_explorer": ("Reddit Explorer", "nook.local.services.reddit_explorer", "RedditExplorer"),
+    "hacker_news": ("Hacker News", "nook.local.services.hacker_news", "HackerNewsCollector"),
+    "github_trending": ("GitHub Trending", "nook.local.services.github_trending", "GitHubTrendingCollector"),
+    "tech_feed": ("Tech Feed", "nook.local.services.tech_feed", "TechFeedCollector"),
+    "paper_summarizer": ("Paper Summarizer", "nook.local.services.paper_summarizer", "PaperSummarizer"),
+}
+
+# 過去の日付を収集できるコレクター（Reddit・GitHub Trendingは現在の一覧しか取得できない）
+BACKFILL_COLLECTORS = ("hacker_news", "tech_feed", "paper_summarizer")
+# 過去の日付を収集する際に並行して処理する日数
+BACKFILL_WORKERS = int(os.environ.get("NOOK_BACKFILL_WORKERS", 4))
+
+def select_collectors(only=None, skip=None):
+    """実行するコレクターのキーを定義順で返す"""
+    only = list(only or [])
+    skip = list(skip or [])
+    unknown = [key for key in only + skip if key not in COLLECTORS]
+    if unknown:
+        raise ValueError(f"Unknown collectors: {', '.join(unknown)} (available: {', '.join(COLLECTORS)})")
+    return [key for key in COLLECTORS if (not only or key in only) and key not in skip]
+
+def load_collector(key):
+    """コレクターのクラスをインポートして返す"""
+    _, module_name, class_name = COLLECTORS[key]
+    return getattr(importlib.import_module(module_name), class_name)
+
+def _env_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true", "yes")
 
-def run_collector():
-    """全てのコレクターを実行"""
+def run_collector(profile=None, trace=None, run_budget=None, only=None, skip=None, record=None, replay=None):
+    """全てのコレクターを実行
+
+    `record`を指定すると全てのHTTP通信とLLMの応答をそのパスのカセットに記録し、
+    `replay`を指定すると記録したカセットから、通信せずに記録時と同じ実行を再現する。
+    """
+    if record or replay:
+        # requestsの読み込みを避けるため、記録・再生する場合だけインポートする
+        from nook.local.common.cassette import Cassette, use_cassette
+        cassette = Cassette.load(replay) if replay else Cassette.record(record)
+        with use_cassette(cassette):
+            return _run_collector(profile, trace, run_budget, only, skip, cassette)
+    return _run_collector(profile, trace, run_budget, only, skip)
+
+def _journal_path(key, date_str):
+    return os.path.join(data_dir, key, f"{date_str}.md.partial")
+
+def _prepare_cassette(cassette, keys, today, logger):
+    """当日のジャーナル（途中まで完了した項目）を、記録時はカセットに保存し、再生時は記録時の状態に戻す"""
+    if not cassette.replaying:
+        journals = {}
+        for key in keys:
+            with contextlib.suppress(FileNotFoundError), open(_journal_path(key, today), encoding="utf-8") as f:
+                journals[key] = f.read()
+        cassette.set_meta(journals=journals)
+        logger.info(f"Recording all HTTP and LLM traffic to {cassette.path}")
+        return
+    
+    journals = cassette.meta.get("journals", {})
+    for key in keys:
+        path = _journal_path(key, today)
+        if key in journals:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(journals[key])
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+    logger.info(f"Replaying the run recorded in {cassette.path}")
+
+def _run_collector(profile, trace, run_budget, only, skip, cassette=None):
     # ロガーのセットアップ
     logger = setup_logger()
     
-    today = datetime.date.today().strftime("%Y-%m-%d")
+    # 記録した実行を再生する場合は、記録時の日付になる
+    today = clock.today_jst().strftime("%Y-%m-%d")
     logger.info(f"Running collectors for {today}")
+    if cassette:
+        _prepare_cassette(cassette, select_collectors(only, skip), today, logger)
     
-    collectors = [
-        ("Reddit Explorer", RedditExplorer()),
-        ("Hacker News", HackerNewsCollector()),
-        ("GitHub Trending", GitHubTrendingCollector()),
-        ("Tech Feed", TechFeedCollector()),
-        ("Paper Summarizer", PaperSummarizer())
-    ]
+    # プロファイリングは明示的に有効化された場合のみ行う
+    if profile is None:
+        profile = _env_flag("NOOK_PROFILE")
+    if profile:
+        logger.info(f"Profiling enabled: reports will be written to {logs_dir}")
     
-    for name, collector in collectors:
+    # トレースも明示的に有効化された場合のみ記録する
+    if trace is None:
+        trace = _env_flag("NOOK_TRACE")
+    if trace:
+        start_tracing()
+    
+    # 選択されたコレクターだけをインポート・生成する
+    started = time.perf_counter()
+    collectors = []
+    for key in select_collectors(only, skip):
+        name = COLLECTORS[key][0]
         try:
-            logger.info(f"Running {name}...")
-            collector()
-            logger.info(f"{name} completed")
+            collectors.append((key, name, load_collector(key)()))
         except Exception as e:
-            logger.error(f"Error in {name}: {e}", exc_info=True)
+            logger.error(f"Error initializing {name}: {e}", exc_info=True)
+    logger.info(
+        f"Loaded {len(collectors)} collectors ({', '.join(name for _, name, _ in collectors)}) "
+        f"in {time.perf_counter() - started:.2f}s"
+    )
+    if not collectors:
+        logger.warning("No collectors to run")
+        return
+    
+    # 実行全体の予算を、まだ実行していないコレクターで均等に分ける
+    # (早く終わったコレクターの残り時間は後続に繰り越される)
+    if run_budget is None:
+        run_budget = RUN_BUDGET
+    logger.info(f"Run budget: {run_budget:.0f}s")
+    
+    with budget(run_budget, name="run") as run_deadline:
+        # 1. LLMで要約するコレクターから要約の候補を集める
+        # (候補の取得は一覧の取得だけなので、各コレクターの取り分を超えないようにする)
+        candidates = []
+        gathered = set()
+        for key, name, collector in collectors:
+            if not hasattr(collector, "gather"):
+                continue
+            try:
+                logger.info(f"Gathering candidates for {name}...")
+                gather_budget = run_deadline.remaining() / len(collectors)
+                with span(f"{name} gather", cat="collector"), budget(gather_budget, name=name):
+                    candidates.extend(collector.gather())
+                gathered.add(key)
+            except Exception as e:
+                logger.error(f"Error gathering candidates for {name}: {e}", exc_info=True)
+        
+        # 2. 全情報源の候補を順位付けし、LLM呼び出しの予算に収まる上位の候補だけを要約する
+        # (Gemini APIの当日の残り回数が少ない場合は、その範囲でスコアの高いものを優先する)
+        call_budget = LLM_CALL_BUDGET
+        min_per_source = None
+        quota_left = remaining_today()
+        if cassette and cassette.replaying:
+            # 記録時と同じ条件で候補を選ぶ
+            call_budget = cassette.meta.get("call_budget", call_budget)
+            min_per_source = cassette.meta.get("min_per_source")
+        elif quota_left is not None and quota_left < call_budget:
+            logger.warning(f"Only {quota_left} Gemini requests left today; limiting summaries to the top {quota_left}")
+            call_budget = quota_left
+            # 残りが少ない場合は情報源ごとの最低件数を設けず、スコア順だけで選ぶ
+            min_per_source = 0
+        if cassette and not cassette.replaying:
+            cassette.set_meta(call_budget=call_budget, min_per_source=min_per_source)
+        selected = group_by_source(select_top(candidates, call_budget, min_per_source))
+        if gathered:
+            logger.info(
+                f"Selected {sum(len(items) for items in selected.values())} of {len(candidates)} candidates "
+                f"for summarization (LLM call budget {call_budget})"
+            )
+            for key in gathered:
+                logger.info(f"  {COLLECTORS[key][0]}: {len(selected.get(key, []))}")
+        
+        # 3. 各コレクターを実行（候補を集めたコレクターは選ばれた候補だけを要約する）
+        for i, (key, name, collector) in enumerate(collectors):
+            collector_budget = run_deadline.remaining() / (len(collectors) - i)
+            if hasattr(collector, "gather") and key not in gathered:
+                continue
+            try:
+                logger.info(f"Running {name} (budget {collector_budget:.0f}s)...")
+                profiler = (
+                    profile_collector(name, logs_dir, today, logger)
+                    if profile
+                    else contextlib.nullcontext()
+                )
+                with profiler, span(name, cat="collector"), budget(collector_budget, name=name):
+                    if key in gathered:
+                        collector.summarize(selected.get(key, []))
+                    else:
+                        collector()
+                logger.info(f"{name} completed")
+            except Exception as e:
+                logger.error(f"Error in {name}: {e}", exc_info=True)
+    
+    _report_run(logger)
+    
+    if trace:
+        trace_path = os.path.join(
+            logs_dir, f"trace_{datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json"
+        )
+        span_count = stop_tracing(trace_path)
+        logger.info(f"Saved {span_count} trace spans to {trace_path} (open with chrome://tracing or ui.perfetto.dev)")
     
     logger.info("All collectors completed")
 
+def _report_run(logger):
+    """実行の最後に、スキップした項目・APIの利用状況などを報告し、関連項目の索引を更新する"""
+    # 予算切れでスキップされた項目を報告
+    skipped = pop_skipped()
+    if skipped:
+        logger.warning(f"{len(skipped)} items were skipped because they missed their budget:")
+        for entry in skipped:
+            logger.warning(f"  [{entry['source']}] {entry['item']}: {entry['reason']}")
+    
+    # Gemini APIの利用状況をAPIキーとモデルの組み合わせごとに報告
+    for quota_name, quota in all_quotas().items():
+        usage = quota.usage()
+        logger.info(
+            f"Gemini quota [{quota_name}]: {usage['requests']}/{usage['limit'] or 'unlimited'} requests today, "
+            f"~{usage['tokens']} tokens, waited {usage['waited']:.0f}s for rate limits"
+            + (" (daily quota exhausted)" if usage["exhausted"] else "")
+        )
+    
+    for tier, stats in pop_tier_stats().items():
+        logger.info(
+            f"Gemini {tier} tier: {stats['calls']} calls, "
+            f"avg {stats['avg']:.1f}s, p95 {stats['p95']:.1f}s"
+        )
+    
+    # 条件付きGETで節約できた通信量を報告
+    # (requestsの読み込みを避けるため、コレクターと同様に実行後にインポートする)
+    from nook.local.common.http_cache import pop_stats
+    for cache_name, stats in pop_stats().items():
+        logger.info(
+            f"Conditional GET [{cache_name}]: {stats['hits']} not modified, "
+            f"{stats['bytes_saved']} bytes saved, {stats['bytes_downloaded']} bytes downloaded"
+        )
+    
+    # 関連項目の索引に今回書き込んだ日の項目を追加
+    # (numpyの読み込みを避けるため、実行後にインポートする)
+    try:
+        from nook.local.common.related_index import get_index
+        index = get_index()
+        added = index.update()
+        logger.info(f"Related index: {added} items updated ({len(index)} items in total)")
+    except Exception as e:
+        logger.error(f"Error updating related index: {e}", exc_info=True)
+    
+    # 閲覧用の静的サイトのうち、今回書き込んだ日を書き出し直す
+    _export_site(logger)
+    
+    # 遮断中のホストを報告
+    for host, retry_in in get_breakers().open_hosts().items():
+        logger.warning(f"Circuit open for {host} (next probe in {retry_in:.0f}s)")
+
+def _backfill_day(date, collectors, call_budget, min_per_source, logger):
+    """1日分を、その日に実行した場合と同じように収集・要約してその日のファイルに書き込む"""
+    date_str = date.strftime("%Y-%m-%d")
+    # 日ごとにコレクターを複製する（HTTPキャッシュ・LLMクライアントなどは全ての日で共有する）
+    collectors = [(key, name, copy.copy(collector)) for key, name, collector in collectors]
+    
+    # 新しさのスコアはその日の終わりを基準にする
+    with clock.run_at(clock.day_bounds(date)[1] - 1):
+        candidates = []
+        gathered = set()
+        for key, name, collector in collectors:
+            if not hasattr(collector, "gather"):
+                continue
+            try:
+                with span(f"{name} gather {date_str}", cat="collector"):
+                    candidates.extend(collector.gather(date=date))
+                gathered.add(key)
+            except Exception as e:
+                logger.error(f"Error gathering candidates for {name} on {date_str}: {e}", exc_info=True)
+        
+        selected = group_by_source(select_top(candidates, call_budget, min_per_source))
+        for key, name, collector in collectors:
+            if hasattr(collector, "gather") and key not in gathered:
+                continue
+            try:
+                with span(f"{name} {date_str}", cat="collector"):
+                    if key in gathered:
+                        collector.summarize(selected.get(key, []))
+                    else:
+                        collector(date=date)
+            except Exception as e:
+                logger.error(f"Error in {name} on {date_str}: {e}", exc_info=True)
+
+def run_backfill(start, end, only=None, skip=None, run_budget=None, workers=None):
+    """`start`から`end`まで（両端を含む）の各日を並行して収集・要約する
+    
+    過去の日付を取得できる情報源（arXivの投稿日時・Hacker Newsの投稿時刻・フィードの公開日時）だけを対象とし、
+    日本時間でその日に投稿・公開された項目を、その日に実行した場合と同じファイルに書き込む。
+    Gemini APIのレート制限とLLM呼び出しの予算は全ての日で共有する。
+    """
+    logger = setup_logger()
+    days = [start + datetime.timedelta(days=i) for i in range((end - start).days + 1)]
+    if not days:
+        raise ValueError(f"Backfill range is empty: {start} to {end}")
+    
+    keys = select_collectors(only, skip)
+    for key in keys:
+        if key not in BACKFILL_COLLECTORS:
+            logger.warning(f"{COLLECTORS[key][0]} cannot collect past dates; skipping it")
+    collectors = []
+    for key in keys:
+        if key not in BACKFILL_COLLECTORS:
+            continue
+        name = COLLECTORS[key][0]
+        try:
+            collectors.append((key, name, load_collector(key)()))
+        except Exception as e:
+            logger.error(f"Error initializing {name}: {e}", exc_info=True)
+    if not collectors:
+        logger.warning("No collectors to run")
+        return
+    
+    # LLM呼び出しの予算は日数分を上限とし、Gemini APIの残り回数が少なければその範囲を全ての日で均等に分ける
+    total_calls = LLM_CALL_BUDGET * len(days)
+    min_per_source = None
+    quota_left = remaining_today()
+    if quota_left is not None and quota_left < total_calls:
+        logger.warning(f"Only {quota_left} Gemini requests left today; sharing them across {len(days)} days")
+        total_calls = quota_left
+        min_per_source = 0
+    call_budget = total_calls // len(days)
+    
+    workers = min(workers or BACKFILL_WORKERS, len(days))
+    logger.info(
+        f"Backfilling {days[0]} to {days[-1]} ({len(days)} days, {workers} in parallel) "
+        f"with {', '.join(name for _, name, _ in collectors)}; LLM call budget {call_budget} per day"
+    )
+    
+    with budget(run_budget or RUN_BUDGET, name="backfill"), \
+            ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as executor:
+        # 期限などのコンテキストをワーカースレッドに引き継ぐ
+        futures = {
+            executor.submit(
+                contextvars.copy_context().run, _backfill_day, day, collectors, call_budget, min_per_source, logger
+            ): day
+            for day in days
+        }
+        for future in as_completed(futures):
+            future.result()
+            logger.info(f"Backfilled {futures[future]}")
+    
+    _report_run(logger)
+    logger.info("Backfill completed")
+
+def run_compaction():
+    """古い月の日ごとのファイルを、情報源・月ごとのパックファイルにまとめる"""
+    logger = setup_logger()
+    from nook.local.common.archive import KEEP_DAYS, compact
+    logger.info(f"Packing months older than {KEEP_DAYS} days...")
+    stats = compact()
+    for source, (days, loose_bytes, packed_bytes) in stats.items():
+        logger.info(f"  {source}: packed {days} days ({loose_bytes} -> {packed_bytes} bytes)")
+    if not stats:
+        logger.info("  Nothing to pack")
+
+def _export_site(logger, output_dir=None):
+    """閲覧用のページを静的サイトとして書き出す（書き出し先が設定されていなければ何もしない）"""
+    # (markdownとjinja2の読み込みを避けるため、実行時にインポートする)
+    from nook.local.common import static_site
+    output_dir = output_dir or static_site.EXPORT_DIR
+    if not output_dir:
+        return
+    try:
+        rendered, unchanged, removed = static_site.export(output_dir)
+        logger.info(
+            f"Static site [{output_dir}]: {rendered} days rendered, {unchanged} unchanged, {removed} removed"
+        )
+    except Exception as e:
+        logger.error(f"Error exporting static site: {e}", exc_info=True)
+
+def run_export(output_dir):
+    """閲覧用のページを静的なHTML/JSONとして書き出す（前回から変わった日だけ）"""
+    _export_site(setup_logger(), output_dir)
+
+def _parse_keys(value):
+    return [key.strip() for key in value.split(",") if key.strip()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nookの情報収集を実行")
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=None,
+        help="各コレクターをcProfileとtracemallocでプロファイルする（環境変数NOOK_PROFILE=1でも有効）",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        default=None,
+        help="取得・抽出・要約・描画のスパンをChrome/Perfetto形式のトレースJSONとしてlogs/に出力する（環境変数NOOK_TRACE=1でも有効）",
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=None,
+        help="実行全体の予算（秒）。各コレクターに分配され、超過した項目はスキップされる（既定値は環境変数NOOK_RUN_BUDGET）",
+    )
+    parser.add_argument(
+        "--only",
+        type=_parse_keys,
+        default=None,
+        help=f"実行するコレクター（カンマ区切り: {', '.join(COLLECTORS)}）",
+    )
+    parser.add_argument(
+        "--skip",
+        type=_parse_keys,
+        default=None,
+        help="実行しないコレクター（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="常駐して各情報源をそれぞれのスケジュールで実行する",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="古い月の日ごとのファイルを月ごとの圧縮パックファイルにまとめて終了する（常駐モードでは毎日実行）",
+    )
+    parser.add_argument(
+        "--export",
+        metavar="OUTPUT_DIR",
+        help="閲覧用のページを静的なHTML/JSONとして書き出して終了する（前回から変わった日だけを書き出し直す）",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="PATH",
+        help="全てのHTTP通信とLLMの応答をカセット（gzip圧縮のJSON Lines）に記録する",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="PATH",
+        help="記録したカセットから、通信やLLM呼び出しをせずに記録時と同じ実行を再現する",
+    )
+    parser.add_argument(
+        "--backfill",
+        nargs=2,
+        type=datetime.date.fromisoformat,
+        metavar=("START", "END"),
+        help="指定した期間（YYYY-MM-DD、両端を含む）の各日を、過去の日付を取得できる情報源から並行して収集する",
+    )
+    args = parser.parse_args(argv)
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
+    
+    if args.compact:
+        run_compaction()
+        return
+    
+    if args.export:
+        run_export(args.export)
+        return
+    
+    try:
+        keys = select_collectors(args.only, args.skip)
+    except ValueError as e:
+        parser.error(str(e))
+    
+    if args.backfill:
+        start, end = args.backfill
+        if end < start:
+            parser.error("--backfill END must not be before START")
+        run_backfill(start, end, only=args.only, skip=args.skip, run_budget=args.budget)
+        return
+    
+    if args.daemon:
+        from nook.local.daemon import run_daemon
+        run_daemon(
+            [(key, COLLECTORS[key][0], lambda key=key: load_collector(key)()) for key in keys],
+            setup_logger(),
+        )
+        return
+    
+    run_collector(
+        profile=args.profile, trace=args.trace, run_budget=args.budget, only=args.only, skip=args.skip,
+        record=args.record, replay=args.replay,
+    )
+
 if __name__ == "__main__":
-    run_collector()
\ No newline at end of file
+    main()
\ No newline at end of file
@@ -0,0 +1,224 @@
+import os
+import re
+import mmap
+import zlib
+import struct
+import datetime
+import threading
+
+# この日数より前の月は、月ごとのパックファイルにまとめる
+KEEP_DAYS = int(os.environ.get("NOOK_ARCHIVE_KEEP_DAYS", 35))
+
+# 各コレクターの出力先（表示する順）
+SOURCES = (
+    "github_trending",
+    "hacker_news",
+    "paper_summarizer",
+    "reddit_explorer",
+    "tech_feed",
+)
+
+_DATE_FILE = re.compile(r"^(\d{4}-\d{2}-\d{2})\.md$")
+_PACK_FILE = re.compile(r"^(\d{4}-\d{2})\.pack$")
+
+# パックファイルの形式: ヘッダー（識別子・日数）、日ごとの索引、日ごとにzlibで圧縮した本文
+_MAGIC = b"NOOKPK01"
+_HEADER = struct.Struct("<8sI")
+# 日付・本文の位置・圧縮後の長さ・元のサイズ・元のファイルの更新時刻（ns）
+_RECORD = struct.Struct("<10sQQQq")
+
+
+class Pack:
+    """1か月分の日ごとのMarkdownをまとめたパックファイルの読み出し
+
+    ファイル全体をメモリマップし、索引から要求された日の位置を引いてその日の分だけ展開する。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, count = _HEADER.unpack_from(self._map, 0)
+        if magic != _MAGIC:
+            raise ValueError(f"Not a Nook pack file: {path}")
+        self._records = {}
+        for i in range(count):
+            date, offset, length, size, mtime_ns = _RECORD.unpack_from(
+                self._map, _HEADER.size + i * _RECORD.size
+            )
+            self._records[date.decode("ascii")] = (offset, length, size, mtime_ns)
+
+    def dates(self):
+        return sorted(self._records)
+
+    def stat(self, date_str):
+        """元のファイルの(更新時刻, サイズ)。その日がなければNone"""
+        record = self._records.get(date_str)
+        return [record[3], record[2]] if record else None
+
+    def raw(self, date_str):
+        """圧縮されたままの本文"""
+        offset, length, _, _ = self._records[date_str]
+        return self._map[offset:offset + length]
+
+    def read(self, date_str):
+        """その日のMarkdown（なければNone）"""
+        if date_str not in self._records:
+            return None
+        return zlib.decompress(self.raw(date_str)).decode("utf-8")
+
+
+_packs = {}
+_packs_lock = threading.Lock()
+_MAX_OPEN_PACKS = 64
+
+
+def _open_pack(path):
+    """パックファイルを開く（開いたものは更新されるまで使い回す）。なければNone"""
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    with _packs_lock:
+        cached = _packs.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        pack = Pack(path)
+        if len(_packs) >= _MAX_OPEN_PACKS:
+            _packs.pop(next(iter(_packs)))
+        _packs[path] = (mtime, pack)
+        return pack
+
+
+def _pack_path(data_dir, source, date_str):
+    return os.path.join(data_dir, source, f"{date_str[:7]}.pack")
+
+
+def read_day(data_dir, source, date_str):
+    """情報源と日付のMarkdownを、個別のファイルまたはパックファイルから読み込む（なければNone）"""
+    try:
+        with open(os.path.join(data_dir, source, f"{date_str}.md"), "r", encoding="utf-8") as f:
+            return f.read()
+    except FileNotFoundError:
+        # パックにまとめられた日（まとめている最中に個別のファイルが消えた場合を含む）
+        pack = _open_pack(_pack_path(data_dir, source, date_str))
+        return pack.read(date_str) if pack else None
+
+
+def day_stat(data_dir, source, date_str):
+    """その日のMarkdownの(更新時刻, サイズ)。パックにまとめる前のファイルと同じ値を返す"""
+    try:
+        stat = os.stat(os.path.join(data_dir, source, f"{date_str}.md"))
+        return [stat.st_mtime_ns, stat.st_size]
+    except FileNotFoundError:
+        pack = _open_pack(_pack_path(data_dir, source, date_str))
+        return pack.stat(date_str) if pack else None
+
+
+def list_dates(data_dir, source):
+    """情報源にある日付の一覧（個別のファイルとパックファイルの両方）"""
+    source_dir = os.path.join(data_dir, source)
+    if not os.path.isdir(source_dir):
+        return []
+    dates = set()
+    for file_name in os.listdir(source_dir):
+        if match := _DATE_FILE.match(file_name):
+            dates.add(match.group(1))
+        elif _PACK_FILE.match(file_name):
+            pack = _open_pack(os.path.join(source_dir, file_name))
+            if pack:
+                dates.update(pack.dates())
+    return sorted(dates)
+
+
+def list_sources(data_dir):
+    """データディレクトリにある情報源の一覧"""
+    if not os.path.isdir(data_dir):
+        return []
+    return sorted(
+        name for name in os.listdir(data_dir)
+        if not name.startswith(".") and os.path.isdir(os.path.join(data_dir, name))
+    )
+
+
+def pack_month(data_dir, source, month, dates):
+    """個別のファイルを月のパックファイルにまとめ、まとめたファイルを削除する
+
+    既存のパックがあれば、その内容（同じ日は個別のファイルを優先）と合わせて書き直す。
+    (まとめた日数, 元のファイルの合計サイズ, 圧縮後の合計サイズ) を返す。
+    """
+    source_dir = os.path.join(data_dir, source)
+    pack_path = os.path.join(source_dir, f"{month}.pack")
+    blobs = {}
+
+    existing = _open_pack(pack_path)
+    if existing:
+        for date_str in existing.dates():
+            mtime_ns, size = existing.stat(date_str)
+            blobs[date_str] = (existing.raw(date_str), size, mtime_ns)
+
+    loose_bytes = packed_bytes = 0
+    for date_str in dates:
+        path = os.path.join(source_dir, f"{date_str}.md")
+        with open(path, "rb") as f:
+            content = f.read()
+        blobs[date_str] = (zlib.compress(content, 9), len(content), os.stat(path).st_mtime_ns)
+        loose_bytes += len(content)
+        packed_bytes += len(blobs[date_str][0])
+
+    ordered = sorted(blobs)
+    offset = _HEADER.size + len(ordered) * _RECORD.size
+    tmp_path = f"{pack_path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, len(ordered)))
+        for date_str in ordered:
+            blob, size, mtime_ns = blobs[date_str]
+            f.write(_RECORD.pack(date_str.encode("ascii"), offset, len(blob), size, mtime_ns))
+            offset += len(blob)
+        for date_str in ordered:
+            f.write(blobs[date_str][0])
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pack_path)
+
+    # パックを書き終えてから個別のファイルを削除する（読み出し側はパックに切り替わる）
+    # 収集時に保存したHTMLへの変換結果も削除し、パックにまとめた日は表示時に変換する
+    for date_str in dates:
+        os.remove(os.path.join(source_dir, f"{date_str}.md"))
+        try:
+            os.remove(os.path.join(source_dir, f"{date_str}.html.json"))
+        except FileNotFoundError:
+            pass
+    return len(dates), loose_bytes, packed_bytes
+
+
+def compact(data_dir=None, keep_days=KEEP_DAYS, today=None):
+    """`keep_days`日より前に終わった月の個別のファイルを、情報源・月ごとのパックファイルにまとめる
+
+    書き込み中（ジャーナルが残っている）の日はまとめない。
+    情報源ごとの(まとめた日数, 元のファイルの合計サイズ, 圧縮後の合計サイズ)を返す。
+    """
+    data_dir = data_dir or os.environ.get("DATA_DIR", "./data")
+    today = today or datetime.date.today()
+    cutoff = (today - datetime.timedelta(days=keep_days)).strftime("%Y-%m")
+
+    stats = {}
+    for source in list_sources(data_dir):
+        source_dir = os.path.join(data_dir, source)
+        months = {}
+        for file_name in os.listdir(source_dir):
+            match = _DATE_FILE.match(file_name)
+            if not match or os.path.exists(os.path.join(source_dir, f"{file_name}.partial")):
+                continue
+            date_str = match.group(1)
+            # cutoffの日を含む月はまだ書き込まれる可能性があるため残す
+            if date_str[:7] < cutoff:
+                months.setdefault(date_str[:7], []).append(date_str)
+
+        for month, dates in sorted(months.items()):
+            packed, loose_bytes, packed_bytes = pack_month(data_dir, source, month, sorted(dates))
+            total = stats.setdefault(source, [0, 0, 0])
+            total[0] += packed
+            total[1] += loose_bytes
+            total[2] += packed_bytes
+    return stats
@@ -0,0 +1,234 @@
+import gzip
+import json
+import base64
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from nook.local.common import clock
+from nook.local.common.deadline import DeadlineExceeded
+from nook.local.common.quota import QuotaExceededError
+
+# 再生時に送出し直すLLM呼び出しの例外
+_LLM_ERRORS = {error.__name__: error for error in (DeadlineExceeded, QuotaExceededError)}
+
+
+class CassetteMissError(requests.ConnectionError):
+    """再生中に、カセットに記録されていない通信・LLM呼び出しが行われたことを表す例外"""
+
+
+class Cassette:
+    """1回の実行の全てのHTTP応答とLLMの応答を記録し、後から同じ順に再生するカセット
+
+    `requests`の`HTTPAdapter.send`を差し替えるため、共有セッション・praw・arxivを含む
+    全てのHTTP通信が対象になる。LLMは`gemini_client.create_client`が返すクライアントを包む。
+    同じリクエスト（メソッド・URL・本文）は記録した順に返し、足りなくなれば最後の応答を繰り返す。
+    ファイルはgzipで圧縮したJSON Linesで、1行目に実行の情報（基準時刻など）を書く。
+    記録には認証トークンを含む応答も残るため、共有しないこと。
+    """
+
+    def __init__(self, path, mode, meta=None):
+        self.path = path
+        self.mode = mode
+        self.meta = meta or {}
+        self._entries = {}
+        self._cursors = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    @classmethod
+    def record(cls, path):
+        """記録用のカセットを作る"""
+        cassette = cls(path, "record", {"version": 1, "started": clock.now()})
+        cassette._file = gzip.open(path, "wt", encoding="utf-8")
+        cassette._write(cassette.meta)
+        return cassette
+
+    @classmethod
+    def load(cls, path):
+        """記録済みのカセットを再生用に読み込む"""
+        cassette = cls(path, "replay")
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 記録が途中で中断された行は無視する
+                    break
+                if i == 0:
+                    cassette.meta = entry
+                elif entry["key"] == "meta":
+                    cassette.meta.update({name: value for name, value in entry.items() if name != "key"})
+                else:
+                    cassette._entries.setdefault(entry["key"], []).append(entry)
+        return cassette
+
+    def _write(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def set_meta(self, **values):
+        """実行の情報を追記する（再生時に同じ条件で実行するために使う）"""
+        self.meta.update(values)
+        if not self.replaying:
+            self._write({"key": "meta", **values})
+
+    def _next(self, key):
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                raise CassetteMissError(f"Not recorded in {self.path}: {key}")
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = index + 1
+            return entries[min(index, len(entries) - 1)]
+
+    def close(self):
+        if self._file:
+            with self._lock:
+                self._file.close()
+                self._file = None
+
+    # HTTP
+
+    @staticmethod
+    def _http_key(request):
+        key = f"{request.method} {request.url}"
+        if request.body:
+            body = request.body if isinstance(request.body, bytes) else str(request.body).encode("utf-8")
+            key += f" {hashlib.sha256(body).hexdigest()[:16]}"
+        return key
+
+    def record_http(self, request, response=None, error=None):
+        entry = {"key": self._http_key(request)}
+        if error is not None:
+            entry["error"] = type(error).__name__
+            entry["message"] = str(error)
+        else:
+            content = response.content
+            entry.update({
+                "status": response.status_code,
+                "reason": response.reason,
+                "url": response.url,
+                "headers": dict(response.headers),
+            })
+            try:
+                entry["text"] = content.decode("utf-8")
+            except UnicodeDecodeError:
+                entry["base64"] = base64.b64encode(content).decode("ascii")
+        self._write(entry)
+
+    def replay_http(self, request, adapter):
+        entry = self._next(self._http_key(request))
+        if "error" in entry:
+            error = getattr(requests.exceptions, entry["error"], requests.ConnectionError)
+            raise error(entry["message"], request=request)
+
+        response = requests.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.url = entry["url"]
+        response.headers = CaseInsensitiveDict(entry["headers"])
+        # 記録時にrequestsが展開済みのため、圧縮の指定は外す
+        response.headers.pop("Content-Encoding", None)
+        response.encoding = get_encoding_from_headers(response.headers)
+        if "text" in entry:
+            response._content = entry["text"].encode("utf-8")
+        else:
+            response._content = base64.b64decode(entry["base64"])
+        response.request = request
+        response.connection = adapter
+        return response
+
+    # LLM
+
+    def call_llm(self, method, args, call):
+        """LLMの呼び出しを記録する（再生時は記録した応答を返す）"""
+        key = f"llm {method} {hashlib.sha256(json.dumps(args, ensure_ascii=False).encode('utf-8')).hexdigest()}"
+        if self.replaying:
+            entry = self._next(key)
+            if "error" in entry:
+                raise _LLM_ERRORS.get(entry["error"], RuntimeError)(entry["message"])
+            return entry["response"]
+
+        try:
+            response = call()
+        except tuple(_LLM_ERRORS.values()) as e:
+            self._write({"key": key, "error": type(e).__name__, "message": str(e)})
+            raise
+        self._write({"key": key, "response": response})
+        return response
+
+    def wrap_client(self, client):
+        return _CassetteClient(self, client)
+
+
+class _CassetteClient:
+    """Geminiクライアントの呼び出しをカセットに記録・再生するラッパー"""
+
+    def __init__(self, cassette, client):
+        self._cassette = cassette
+        self._client = client
+
+    def generate_content(self, contents, system_instruction=None):
+        return self._cassette.call_llm(
+            "generate_content",
+            [contents, system_instruction],
+            lambda: self._client.generate_content(contents=contents, system_instruction=system_instruction),
+        )
+
+    def chat_with_search(self, message):
+        return self._cassette.call_llm(
+            "chat_with_search", [message], lambda: self._client.chat_with_search(message)
+        )
+
+
+_active = None
+_original_send = HTTPAdapter.send
+
+
+def _send(adapter, request, **kwargs):
+    cassette = _active
+    if cassette is None:
+        return _original_send(adapter, request, **kwargs)
+    if cassette.replaying:
+        return cassette.replay_http(request, adapter)
+    try:
+        response = _original_send(adapter, request, **kwargs)
+    except requests.RequestException as e:
+        cassette.record_http(request, error=e)
+        raise
+    cassette.record_http(request, response)
+    return response
+
+
+def active_cassette():
+    """記録・再生中のカセット（なければNone）"""
+    return _active
+
+
+def replaying():
+    return _active is not None and _active.replaying
+
+
+@contextmanager
+def use_cassette(cassette):
+    """このブロック内の全てのHTTP通信とLLM呼び出しを、カセットに記録またはカセットから再生する"""
+    global _active
+    _active = cassette
+    HTTPAdapter.send = _send
+    try:
+        with clock.run_at(cassette.meta["started"]):
+            yield cassette
+    finally:
+        HTTPAdapter.send = _original_send
+        _active = None
+        cassette.close()
@@ -0,0 +1,147 @@
+import os
+import time
+import uuid
+import inspect
+import threading
+from collections import OrderedDict
+
+from nook.local.common.deadline import DeadlineExceeded
+from nook.local.common.quota import QuotaExceededError, estimate_tokens
+
+# 会話履歴（要約を除く）がこのトークン数を超えたら、古いやり取りを要約に畳み込む
+HISTORY_TOKENS = int(os.environ.get("NOOK_CHAT_HISTORY_TOKENS", 2000))
+# 畳み込まずにそのまま残す直近の発言数
+KEEP_TURNS = int(os.environ.get("NOOK_CHAT_KEEP_TURNS", 4))
+# 最後の発言からこの秒数が経ったセッションは破棄する
+SESSION_TTL = int(os.environ.get("NOOK_CHAT_SESSION_TTL", 3600))
+# 保持するセッション数の上限（超えた場合は最も古いものから破棄する）
+MAX_SESSIONS = int(os.environ.get("NOOK_CHAT_MAX_SESSIONS", 200))
+
+_ROLE_LABELS = {"user": "ユーザー", "assistant": "アシスタント"}
+
+
+class ChatSession:
+    """トピックごとの会話の状態（記事・取得済みのリンクの内容・会話の要約・直近の発言）
+
+    複数のリクエストから同時に使われるため、読み書きは`lock`を取得して行う。
+    """
+
+    def __init__(self, session_id, topic_id):
+        self.session_id = session_id
+        self.topic_id = topic_id
+        self.markdown = ""
+        # URLごとの取得済みの内容（取得できなかった場合はNone）
+        self.link_contents = {}
+        # 古いやり取りを畳み込んだ要約
+        self.summary = ""
+        self.turns = []
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        # 要約中は次の要約を始めない
+        self._compacting = False
+
+    def add_turn(self, role, text):
+        self.turns.append((role, text))
+        self.updated = time.monotonic()
+
+    def _format_turns(self, turns):
+        return "\n\n".join(f"{_ROLE_LABELS[role]}: {text}" for role, text in turns)
+
+    def history(self):
+        """プロンプトに含める会話履歴（要約と直近の発言）"""
+        parts = []
+        if self.summary:
+            parts.append(f"(これまでの会話の要約)\n{self.summary}")
+        if self.turns:
+            parts.append(self._format_turns(self.turns))
+        return "\n\n".join(parts) or "なし"
+
+    def needs_compaction(self):
+        return (
+            len(self.turns) > KEEP_TURNS
+            and estimate_tokens(self._format_turns(self.turns)) > HISTORY_TOKENS
+        )
+
+    def compact(self, client):
+        """直近の発言を残して、古いやり取りをこれまでの要約と合わせて要約し直す
+
+        要約できなかった場合も古いやり取りは破棄し、プロンプトの大きさを一定に保つ。
+        要約の生成中はロックを取らないため、その間も次の発言を受け付けられる。
+        """
+        with self.lock:
+            if self._compacting or not self.needs_compaction():
+                return
+            self._compacting = True
+            old_turns = self.turns[:-KEEP_TURNS]
+            prompt = inspect.cleandoc(
+                f"""
+                以下はある記事についてのユーザーとアシスタントの会話です。
+                これまでの要約と新しいやり取りを合わせて、後の質問に答えるために必要な事実・質問の意図・
+                アシスタントの回答の要点が分かるよう、日本語で800文字以内に要約してください。
+
+                [これまでの要約]
+                {self.summary or "なし"}
+
+                [新しいやり取り]
+                {self._format_turns(old_turns)}
+
+                要約:
+                """
+            )
+        summary = None
+        try:
+            summary = client.generate_content(contents=prompt)
+        except (DeadlineExceeded, QuotaExceededError) as e:
+            print(f"Could not compact chat session {self.session_id}: {e}")
+        finally:
+            # 要約している間に追加された発言は残し、要約したやり取りだけを置き換える
+            with self.lock:
+                del self.turns[:len(old_turns)]
+                if summary is not None:
+                    self.summary = summary
+                self._compacting = False
+
+
+class ChatSessionStore:
+    """トピックとセッションIDごとの会話を保持する（一定時間使われなかったものから破棄する）"""
+
+    def __init__(self, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS):
+        self._ttl = ttl
+        self._max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, topic_id, session_id=None):
+        """セッションを返す（IDがない・期限切れの場合は新しく作る）"""
+        with self._lock:
+            self._evict()
+            session = self._sessions.get((topic_id, session_id)) if session_id else None
+            if session is None:
+                session = ChatSession(session_id or uuid.uuid4().hex, topic_id)
+                self._sessions[(topic_id, session.session_id)] = session
+            self._sessions.move_to_end((topic_id, session.session_id))
+            return session
+
+    def _evict(self):
+        now = time.monotonic()
+        for key, session in list(self._sessions.items()):
+            if now - session.updated > self._ttl:
+                del self._sessions[key]
+        while len(self._sessions) >= self._max_sessions:
+            self._sessions.popitem(last=False)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_sessions():
+    """プロセス共通のチャットセッションの保存先を返す"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ChatSessionStore()
+        return _store
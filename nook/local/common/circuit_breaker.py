@@ -0,0 +1,144 @@
+import os
+import json
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間の排他を行わない
+    fcntl = None
+
+# 連続失敗がこの回数に達したらホストを遮断する
+FAILURE_THRESHOLD = int(os.environ.get("NOOK_BREAKER_FAILURES", 3))
+# この秒数を超えた応答は失敗とみなす
+SLOW_THRESHOLD = float(os.environ.get("NOOK_BREAKER_SLOW_SECONDS", 10))
+# 遮断してから再試行するまでの待機時間（秒）
+COOLDOWN = float(os.environ.get("NOOK_BREAKER_COOLDOWN", 1800))
+# 再試行に失敗するたびに待機時間を倍にする際の上限（秒）
+MAX_COOLDOWN = 24 * 60 * 60
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """遮断中のホストへのリクエストを拒否したことを表す例外"""
+
+
+class CircuitBreakers:
+    """ホストごとのサーキットブレーカー（状態は実行をまたいで保存される）
+
+    状態のファイルは常駐モード・通常の実行・ビューアーで共有するため、保存するときはファイルをロックし、
+    他のプロセスが保存した他のホストの状態と合わせる。
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._probing = set()
+        self._states = self._load()
+
+    def _load(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, host):
+        """ホストの状態を保存し、他のプロセスが保存した他のホストの状態を読み込む"""
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(f"{self._path}.lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            states = self._load()
+            states[host] = self._states[host]
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(states, f, indent=2)
+            os.replace(tmp_path, self._path)
+        self._states.update(states)
+
+    def _state(self, host):
+        return self._states.setdefault(host, {"state": CLOSED, "failures": 0, "opened_at": 0, "cooldown": COOLDOWN})
+
+    def before_call(self, host):
+        """呼び出し前に確認し、遮断中ならCircuitOpenErrorを送出する"""
+        with self._lock:
+            state = self._states.get(host)
+            if state is None or state["state"] == CLOSED:
+                return
+            if state["state"] == OPEN:
+                wait = state["opened_at"] + state["cooldown"] - time.time()
+                if wait > 0:
+                    raise CircuitOpenError(f"circuit for {host} is open (retry in {wait:.0f}s)")
+                # 待機時間が過ぎたら1回だけ試す
+                state["state"] = HALF_OPEN
+                self._save(host)
+            if host in self._probing:
+                raise CircuitOpenError(f"circuit for {host} is half-open and already probing")
+            self._probing.add(host)
+
+    def record_success(self, host, elapsed):
+        """成功を記録（遅すぎる応答は失敗として扱う）"""
+        if elapsed > SLOW_THRESHOLD:
+            self.record_failure(host, f"slow response ({elapsed:.1f}s)")
+            return
+        with self._lock:
+            self._probing.discard(host)
+            state = self._states.get(host)
+            if state is None or (state["state"] == CLOSED and state["failures"] == 0):
+                return
+            if state["state"] != CLOSED:
+                print(f"Circuit for {host} closed again")
+            self._states[host] = {"state": CLOSED, "failures": 0, "opened_at": 0, "cooldown": COOLDOWN}
+            self._save(host)
+
+    def record_failure(self, host, reason=""):
+        """失敗を記録し、必要に応じて遮断する"""
+        with self._lock:
+            self._probing.discard(host)
+            state = self._state(host)
+            state["failures"] += 1
+            if state["state"] == HALF_OPEN:
+                # 再試行にも失敗した場合は待機時間を延ばして再び遮断
+                state["state"] = OPEN
+                state["opened_at"] = time.time()
+                state["cooldown"] = min(state["cooldown"] * 2, MAX_COOLDOWN)
+                print(f"Circuit for {host} re-opened for {state['cooldown']:.0f}s: {reason}")
+            elif state["state"] == CLOSED and state["failures"] >= FAILURE_THRESHOLD:
+                state["state"] = OPEN
+                state["opened_at"] = time.time()
+                state["cooldown"] = COOLDOWN
+                print(f"Circuit for {host} opened for {state['cooldown']:.0f}s after {state['failures']} failures: {reason}")
+            self._save(host)
+
+    def release(self, host):
+        """成功とも失敗とも数えずに呼び出しを終える（遮断中のホストは次の呼び出しで再び試す）"""
+        with self._lock:
+            self._probing.discard(host)
+
+    def open_hosts(self):
+        """現在遮断中のホストと再試行までの秒数"""
+        now = time.time()
+        with self._lock:
+            return {
+                host: max(0.0, state["opened_at"] + state["cooldown"] - now)
+                for host, state in self._states.items()
+                if state["state"] != CLOSED
+            }
+
+
+_breakers = None
+_breakers_lock = threading.Lock()
+
+
+def get_breakers():
+    """プロセス共通のサーキットブレーカーを返す"""
+    global _breakers
+    with _breakers_lock:
+        if _breakers is None:
+            data_dir = os.environ.get("DATA_DIR", "./data")
+            _breakers = CircuitBreakers(os.path.join(data_dir, ".state", "circuit_breakers.json"))
+        return _breakers
@@ -0,0 +1,38 @@
+import time
+import datetime
+import contextvars
+from contextlib import contextmanager
+
+import pytz
+
+JST = pytz.timezone("Asia/Tokyo")
+
+# 実行の基準時刻（UNIX時間）。Noneなら現在時刻を使う
+_run_time = contextvars.ContextVar("nook_run_time", default=None)
+
+
+def now():
+    """実行の基準時刻（UNIX時間）"""
+    run_time = _run_time.get()
+    return time.time() if run_time is None else run_time
+
+
+def today_jst():
+    """実行の基準時刻の、日本時間での日付"""
+    return datetime.datetime.fromtimestamp(now(), JST).date()
+
+
+@contextmanager
+def run_at(timestamp):
+    """このブロック内の基準時刻を固定する（記録した実行の再生などで使う）"""
+    token = _run_time.set(timestamp)
+    try:
+        yield
+    finally:
+        _run_time.reset(token)
+
+
+def day_bounds(date):
+    """日本時間のその日の始まりと翌日の始まり（UNIX時間）"""
+    start = JST.localize(datetime.datetime.combine(date, datetime.time()))
+    return start.timestamp(), (start + datetime.timedelta(days=1)).timestamp()
@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# 1回の実行全体の予算（秒）
+RUN_BUDGET = float(os.environ.get("NOOK_RUN_BUDGET", 3600))
+# HTTPリクエスト1回あたりの上限（秒）
+HTTP_TIMEOUT = float(os.environ.get("NOOK_HTTP_TIMEOUT", 20))
+# LLM呼び出し1回あたりの上限（秒）
+LLM_TIMEOUT = float(os.environ.get("NOOK_LLM_TIMEOUT", 120))
+
+# 現在のコンテキストで有効な期限
+_current = contextvars.ContextVar("nook_deadline", default=None)
+
+# スキップした項目や統計を集計する実行（常駐モードで同時に動くジョブの記録を分ける）
+_run_scope = contextvars.ContextVar("nook_run_scope", default=None)
+
+# 期限切れでスキップされた項目（実行ごと）
+_skipped = {}
+_skipped_lock = threading.Lock()
+
+
+class DeadlineExceeded(TimeoutError):
+    """予算内に処理が終わらなかったことを表す例外"""
+
+
+class Deadline:
+    """単調増加時計に基づく期限（親の期限を超えない）"""
+
+    def __init__(self, seconds, name=None, parent=None):
+        self.name = name
+        self.expires_at = time.monotonic() + seconds
+        if parent is not None:
+            self.expires_at = min(self.expires_at, parent.expires_at)
+
+    def remaining(self):
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+
+@contextmanager
+def budget(seconds, name=None):
+    """指定した秒数の予算を現在のコンテキストに設定する（外側の予算を超えない）"""
+    deadline = Deadline(seconds, name=name, parent=_current.get())
+    token = _current.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _current.reset(token)
+
+
+def remaining():
+    """現在の予算の残り秒数（予算がなければNone）"""
+    deadline = _current.get()
+    return deadline.remaining() if deadline else None
+
+
+def expired():
+    """現在の予算を使い切ったかどうか"""
+    deadline = _current.get()
+    return deadline is not None and deadline.expired()
+
+
+def call_timeout(default):
+    """1回の呼び出しに使えるタイムアウトを返す（予算切れならDeadlineExceeded）"""
+    deadline = _current.get()
+    if deadline is None:
+        return default
+    left = deadline.remaining()
+    if left <= 0:
+        raise DeadlineExceeded(f"budget '{deadline.name}' exhausted")
+    return min(default, left)
+
+
+def run_with_timeout(func, timeout, *args, **kwargs):
+    """タイムアウトを指定できないライブラリ呼び出しを別スレッドで実行し、時間内に終わらなければ諦める"""
+    result = {}
+    context = contextvars.copy_context()
+
+    def target():
+        try:
+            result["value"] = context.run(func, *args, **kwargs)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise DeadlineExceeded(f"{getattr(func, '__name__', func)} did not finish within {timeout:.1f}s")
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+@contextmanager
+def run_scope():
+    """このブロック内（コンテキストを引き継いだワーカーを含む）で記録したスキップ項目・統計を、
+    他の実行と分けて集計する（ブロック内で`pop_*`を呼ぶと、この実行の分だけを取り出す）"""
+    token = _run_scope.set(object())
+    try:
+        yield
+    finally:
+        _run_scope.reset(token)
+
+
+def current_run():
+    """スキップ項目・統計を集計する現在の実行（`run_scope`の外ではNone）"""
+    return _run_scope.get()
+
+
+def record_skip(source, item, reason):
+    """予算切れでスキップした項目を記録"""
+    print(f"Skipped {source} item {item}: {reason}")
+    with _skipped_lock:
+        _skipped.setdefault(current_run(), []).append(
+            {"source": source, "item": str(item), "reason": str(reason)}
+        )
+
+
+def pop_skipped():
+    """現在の実行で記録されたスキップ項目を取り出してリセット"""
+    with _skipped_lock:
+        return _skipped.pop(current_run(), [])
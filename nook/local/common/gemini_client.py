@@ -1,12 +1,167 @@
 import os
+import json
+import time
+import atexit
+import zlib
+import hashlib
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 import google.generativeai as genai
+import google.ai.generativelanguage as glm
+from google.api_core import exceptions as google_exceptions
 import random
 import re
 
-def create_client(use_search=False):
-    """Gemini APIクライアントを作成する"""
-    api_key = os.environ.get("GEMINI_API_KEY")
-    model_name = os.environ.get("GEMINI_MODEL_NAME", "gemini-2.0-pro-exp-02-05")
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間の排他を行わない
+    fcntl = None
+
+from nook.local.common.cassette import active_cassette
+from nook.local.common.deadline import DeadlineExceeded, LLM_TIMEOUT, call_timeout
+from nook.local.common.quota import (
+    INTERACTIVE_PRIORITY,
+    QuotaExceededError,
+    estimate_tokens,
+    get_quota,
+    priority,
+    record_tier_latency,
+)
+from nook.local.common.tracing import span
+
+# レート制限を受けた場合に再試行する回数
+RATE_LIMIT_RETRIES = int(os.environ.get("GEMINI_RATE_LIMIT_RETRIES", 3))
+# APIが再試行までの時間を返さなかった場合の待機時間（秒）
+DEFAULT_RETRY_DELAY = 30
+# サーバーエラーを返した組み合わせを避ける時間（秒）
+SERVER_ERROR_COOLDOWN = 60
+# 応答時間の指数移動平均の重み
+LATENCY_ALPHA = 0.3
+
+# 短い入力・簡単なタスクに使う高速なモデル（空にすると常に大きいモデルを使う）
+FAST_MODEL_NAMES = os.environ.get("GEMINI_FAST_MODEL_NAMES", "gemini-2.0-flash")
+# この文字数以下のプロンプトは高速なモデルに送る
+FAST_MAX_CHARS = int(os.environ.get("GEMINI_FAST_MAX_CHARS", 6000))
+# サービスごとのモデルの選び方（auto: 入力の長さで選ぶ / fast / large）
+# 環境変数 GEMINI_ROUTE_<サービス名> で上書き可能
+DEFAULT_ROUTES = {
+    "reddit_explorer": "auto",
+    "hacker_news": "auto",
+    "tech_feed": "auto",
+    # 論文のアブストラクトを読み解く必要があるため、常に大きいモデルを使う
+    "paper_summarizer": "large",
+    "chat": "large",
+    # チャットの古いやり取りの要約は単純な作業のため、常に高速なモデルを使う
+    "chat_compaction": "fast",
+    # チャットで参照する長いページを要点に縮める作業も単純なため、高速なモデルを使う
+    "chat_context": "fast",
+}
+
+def _is_rate_limited(error):
+    if isinstance(error, google_exceptions.ResourceExhausted):
+        return True
+    message = str(error).lower()
+    return "429" in message or "quota" in message or "exhausted" in message
+
+def _retry_delay(error):
+    """レート制限のエラーに含まれる再試行までの秒数"""
+    match = re.search(r"retry_delay\s*\{\s*seconds:\s*(\d+)", str(error))
+    return float(match.group(1)) if match else DEFAULT_RETRY_DELAY
+
+def _split_env(name):
+    return [value.strip() for value in os.environ.get(name, "").split(",") if value.strip()]
+
+class GeminiBackend:
+    """APIキーとモデルの組み合わせごとのクライアント・クォータ・応答時間"""
+    
+    def __init__(self, api_key, model_name):
+        key_id = hashlib.sha256(api_key.encode()).hexdigest()[:8]
+        self.name = f"{model_name.replace('/', '_')}-{key_id}"
+        self.model_name = model_name
+        self._model_path = model_name if "/" in model_name else f"models/{model_name}"
+        # genai.configureはプロセス全体で1つのキーしか持てないため、キーごとに公開のクライアントを作って直接呼び出す
+        self._client = glm.GenerativeServiceClient(client_options={"api_key": api_key})
+        self.quota = get_quota(self.name)
+        self._lock = threading.Lock()
+        self._latency = None
+        self._running = 0
+        self._unhealthy_until = 0.0
+    
+    @contextmanager
+    def in_flight(self):
+        """呼び出し中の数を数え、成功した呼び出しの応答時間を記録する"""
+        with self._lock:
+            self._running += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._running -= 1
+        elapsed = time.monotonic() - started
+        with self._lock:
+            self._latency = elapsed if self._latency is None else (
+                LATENCY_ALPHA * elapsed + (1 - LATENCY_ALPHA) * self._latency
+            )
+    
+    def expected_latency(self):
+        """実行中の呼び出しを含めて、この組み合わせで応答が返るまでの見込み時間"""
+        with self._lock:
+            # まだ使っていない組み合わせは優先して試す
+            return (self._latency or 0.0) * (self._running + 1)
+    
+    def healthy(self):
+        return time.monotonic() >= self._unhealthy_until
+    
+    def mark_unhealthy(self):
+        self._unhealthy_until = time.monotonic() + SERVER_ERROR_COOLDOWN
+    
+    def generate_content(self, prompt, timeout):
+        """プロンプトから生成したテキストを返す（応答の解釈はgenai.GenerativeModelと同じ）"""
+        request = glm.GenerateContentRequest(
+            model=self._model_path,
+            contents=[glm.Content(role="user", parts=[glm.Part(text=str(prompt))])],
+        )
+        response = self._client.generate_content(request=request, timeout=timeout)
+        return genai.types.GenerateContentResponse.from_response(response).text
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def _get_backends(api_keys, model_names):
+    """APIキーとモデルの全ての組み合わせ（プロセス内で共有して呼び出し中の数と応答時間を集計する）"""
+    with _backends_lock:
+        backends = []
+        for api_key in api_keys:
+            for model_name in model_names:
+                if (api_key, model_name) not in _backends:
+                    _backends[(api_key, model_name)] = GeminiBackend(api_key, model_name)
+                backends.append(_backends[(api_key, model_name)])
+        return backends
+
+def create_client(use_search=False, service=None):
+    """Gemini APIクライアントを作成する
+
+    `service`ごとの設定（DEFAULT_ROUTES・GEMINI_ROUTE_<サービス名>）に従い、
+    短い入力や簡単なタスクは高速なモデルに、長い入力や複雑なタスクは大きいモデルに送る。
+    記録・再生モードでは呼び出しをカセットに記録する（再生時はAPIを呼び出さない）。
+    """
+    cassette = active_cassette()
+    if cassette is None:
+        return _create_client(use_search, service)
+    return cassette.wrap_client(None if cassette.replaying else _create_client(use_search, service))
+
+
+def _create_client(use_search=False, service=None):
+    # 複数のAPIキー・モデルをカンマ区切りで指定した場合は全ての組み合わせを使う
+    api_keys = _split_env("GEMINI_API_KEYS") or _split_env("GEMINI_API_KEY")
+    model_names = _split_env("GEMINI_MODEL_NAMES") or [os.environ.get("GEMINI_MODEL_NAME", "gemini-2.0-pro-exp-02-05")]
+    model_name = model_names[0]
+    fast_model_names = [name.strip() for name in FAST_MODEL_NAMES.split(",") if name.strip()]
+    route = os.environ.get(f"GEMINI_ROUTE_{(service or '').upper()}", DEFAULT_ROUTES.get(service, "auto")).lower()
     
     class DummyClient:
         """APIキーが設定されていない場合のダミークライアント"""
@@ -62,40 +217,339 @@ def create_client(use_search=False):
             print("DummyClient: APIを使わずにダミーレスポンスを返します")
             return self.generate_content(message)
     
-    if not api_key:
+    if not api_keys:
         print("警告: GEMINI_API_KEYが設定されていません。ダミークライアントを使用します。")
         return DummyClient()
     
-    genai.configure(api_key=api_key)
-    
     class GeminiClient:
         def __init__(self, model_name=model_name):
             # 最新のモデル名を使用
-            self.model = genai.GenerativeModel(model_name)
-            self.dummy_client = DummyClient()
+            self.model_name = model_name
+            self.route = route
+            # ティアごとに、APIキーとモデルの全ての組み合わせに呼び出しを振り分ける
+            self.tiers = {"large": _get_backends(api_keys, model_names)}
+            if fast_model_names:
+                self.tiers["fast"] = _get_backends(api_keys, fast_model_names)
+            # かたまりごとの要約のキャッシュで、モデルの設定が変わったら要約し直すための識別子
+            self.cache_namespace = f"{route}:{','.join(model_names)}:{','.join(fast_model_names)}"
+        
+        def _choose_tier(self, prompt):
+            """プロンプトの長さとサービスの設定からティアを選ぶ"""
+            if self.route in self.tiers:
+                return self.route
+            if "fast" in self.tiers and len(str(prompt)) <= FAST_MAX_CHARS:
+                return "fast"
+            return "large"
+        
+        def _choose_backend(self, backends, tokens):
+            """枠が早く空き、応答の速い組み合わせを選ぶ（全て1日の上限に達していればQuotaExceededError）"""
+            available = []
+            for backend in backends:
+                wait = backend.quota.estimate_wait(tokens)
+                if wait is not None:
+                    available.append((backend.healthy(), wait + backend.expected_latency(), backend))
+            if not available:
+                raise QuotaExceededError("Gemini daily quota exhausted for all API keys and models")
+            # サーバーエラーが続いている組み合わせは、他に使えるものがあれば避ける
+            healthy, cost, backend = min(available, key=lambda item: (not item[0], item[1]))
+            return backend
         
         def generate_content(self, contents, system_instruction=None):
-            """コンテンツを生成する"""
+            """コンテンツを生成する
+
+            入力の長さとサービスの設定から高速なモデルと大きいモデルのどちらかのティアを選び、
+            選んだティアが上限に達している場合はもう一方のティアを使う。
+            """
+            if system_instruction:
+                # 最新のAPIでは、system_instructionをプロンプトの一部として組み込む
+                prompt = f"{system_instruction}\n\n{contents}"
+            else:
+                prompt = contents
+            
+            tier = self._choose_tier(prompt)
             try:
-                if system_instruction:
-                    # 最新のAPIでは、system_instructionをプロンプトの一部として組み込む
-                    prompt = f"{system_instruction}\n\n{contents}"
-                    response = self.model.generate_content(prompt)
-                else:
-                    response = self.model.generate_content(contents)
-                
-                return response.text
-            except Exception as e:
-                print(f"Gemini API呼び出しエラー: {e}")
-                # APIクォータ制限に達した場合（429エラー）
-                if "429" in str(e) or "quota" in str(e).lower() or "exhausted" in str(e).lower():
-                    print("APIクォータ制限に達しました。ダミーレスポンスを返します。")
-                    return self.dummy_client.generate_content(contents, system_instruction)
-                return f"エラーが発生しました: {str(e)}"
+                return self._generate(prompt, tier)
+            except QuotaExceededError:
+                other = "large" if tier == "fast" else "fast"
+                if other not in self.tiers:
+                    raise
+                print(f"{tier}ティアのGemini APIが上限に達したため、{other}ティアで再試行します")
+                return self._generate(prompt, other)
+        
+        def _generate(self, prompt, tier):
+            """ティア内で呼び出す
+
+            呼び出しはAPIキーとモデルの組み合わせのうち、枠が早く空き応答の速いものに振り分け、
+            クォータマネージャーで上限内に収まるよう待たされる。
+            レート制限やサーバーエラーを受けた場合は別の組み合わせで再試行し、
+            それでも呼び出せない場合はQuotaExceededErrorを送出する。
+            """
+            backends = self.tiers[tier]
+            tokens = estimate_tokens(prompt)
+            
+            last_error = None
+            for attempt in range(len(backends) + RATE_LIMIT_RETRIES):
+                backend = self._choose_backend(backends, tokens)
+                try:
+                    # 枠が空くまで待つ（予算内に空かない場合はDeadlineExceededになる）
+                    backend.quota.acquire(tokens)
+                except QuotaExceededError:
+                    # 選んだ後に1日の上限に達した場合は別の組み合わせを選び直す
+                    continue
+                # 予算を使い切っている場合はここでDeadlineExceededになる
+                timeout = call_timeout(LLM_TIMEOUT)
+                try:
+                    started = time.monotonic()
+                    with backend.in_flight(), span(
+                        "llm.generate_content", cat="gemini", model=backend.model_name,
+                        backend=backend.name, tier=tier, prompt_chars=len(str(prompt)),
+                    ):
+                        text = backend.generate_content(prompt, timeout)
+                    record_tier_latency(tier, time.monotonic() - started)
+                    
+                    return text
+                except google_exceptions.DeadlineExceeded as e:
+                    raise DeadlineExceeded(f"Gemini API call timed out after {timeout:.1f}s") from e
+                except Exception as e:
+                    print(f"Gemini API呼び出しエラー（{backend.name}）: {e}")
+                    last_error = e
+                    if _is_rate_limited(e):
+                        if "perday" in str(e).lower():
+                            # 1日の上限に達した組み合わせは当日の残りの呼び出しを止める
+                            backend.quota.exhaust_today()
+                        else:
+                            backend.quota.defer(_retry_delay(e))
+                    elif isinstance(e, google_exceptions.ServerError):
+                        backend.mark_unhealthy()
+                    else:
+                        return f"エラーが発生しました: {str(e)}"
+                    print(f"別のAPIキー・モデルで再試行します（{attempt + 1}）")
+            
+            if isinstance(last_error, google_exceptions.ServerError):
+                return f"エラーが発生しました: {str(last_error)}"
+            raise QuotaExceededError(f"Gemini API still rate limited after {attempt + 1} attempts")
         
         def chat_with_search(self, message):
             """検索結果を活用してチャットする（ローカル版では検索機能は簡略化）"""
             # 実際の検索は行わず、単純に応答を返す
-            return self.generate_content(message)
+            # ユーザーが応答を待っているため、コレクターの呼び出しより先に通す
+            with priority(INTERACTIVE_PRIORITY):
+                return self.generate_content(message)
+    
+    return GeminiClient()
+
+# 長い文書を分割するかたまりの最大文字数（これ以下の文書はそのまま要約する）
+CHUNK_CHARS = int(os.environ.get("GEMINI_CHUNK_CHARS", 8000))
+# かたまりを並行して要約する数
+MAP_WORKERS = int(os.environ.get("GEMINI_MAP_WORKERS", 4))
+# かたまりごとの要約を保存する件数
+CHUNK_CACHE_SIZE = int(os.environ.get("GEMINI_CHUNK_CACHE_SIZE", 5000))
+
+# APIの呼び出しに失敗した場合にクライアントが返す文字列（キャッシュしない）
+_ERROR_PREFIX = "エラーが発生しました"
+_BLANK_LINE = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[。．！？.!?])")
+
+_MAP_INSTRUCTION = (
+    "あなたは長い文書を読み解くアシスタントです。"
+    "与えられた文書の一部から、要約に必要な事実・主張・手法・数値・結論を漏らさず、日本語の箇条書きで簡潔に抜き出してください。"
+)
+_REDUCE_INSTRUCTION = (
+    "あなたは長い文書を読み解くアシスタントです。"
+    "以下は同じ文書の連続した部分から抜き出した要点です。重複をまとめ、重要な点を落とさずに日本語の1つの箇条書きに統合してください。"
+)
+
+def _split_long_unit(unit, max_chars):
+    """1つの段落が長すぎる場合に、行・文の境界（最後は文字数）で分ける"""
+    if len(unit) <= max_chars:
+        return [unit]
+    for separator, parts in (("\n", unit.split("\n")), ("", _SENTENCE_END.split(unit))):
+        parts = [part for part in parts if part.strip()]
+        if len(parts) > 1:
+            pieces, current = [], ""
+            for part in parts:
+                if current and len(current) + len(separator) + len(part) > max_chars:
+                    pieces.append(current)
+                    current = ""
+                current = f"{current}{separator}{part}" if current else part
+            pieces.append(current)
+            return [piece for sub in pieces for piece in _split_long_unit(sub, max_chars)]
+    return [unit[i:i + max_chars] for i in range(0, len(unit), max_chars)]
+
+def split_chunks(text, max_chars=CHUNK_CHARS):
+    """テキストを段落・節の境界で`max_chars`文字以下のかたまりに分ける
+    
+    区切る位置は段落の内容のハッシュで決める（内容で決まる分割）ため、一部の段落を書き換えても
+    その前後以外のかたまりは変わらず、かたまりごとの要約のキャッシュをそのまま使える。
+    見出し（#で始まる行）の前では、かたまりが十分な長さになっていれば区切る。
+    """
+    min_chars = max_chars // 4
+    units = []
+    for block in _BLANK_LINE.split(text):
+        if block.strip():
+            units.extend(_split_long_unit(block.strip(), max_chars))
+    
+    chunks, current = [], ""
+    for unit in units:
+        if current and (
+            len(current) + len(unit) + 2 > max_chars
+            or (unit.startswith("#") and len(current) >= min_chars)
+        ):
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n\n{unit}" if current else unit
+        # 段落の内容から決まるおよそ4段落に1つの位置で区切る
+        if len(current) >= min_chars and zlib.crc32(unit.encode("utf-8")) % 4 == 0:
+            chunks.append(current)
+            current = ""
+    if current:
+        chunks.append(current)
+    return chunks
+
+class ChunkCache:
+    """かたまりごとの要約を内容のハッシュで保存するキャッシュ（`DATA_DIR/.cache/llm/chunks.json`）
+    
+    追加した要約はメモリに保持し、`save`で（実行の終わりなどにまとめて）ファイルに書き出す。
+    書き出すときはファイルをロックして他のプロセスが追加した要約と合わせる。
+    """
+    
+    def __init__(self, path=None, max_entries=CHUNK_CACHE_SIZE):
+        data_dir = os.environ.get("DATA_DIR", "./data")
+        self._path = path or os.path.join(data_dir, ".cache", "llm", "chunks.json")
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        # 前回の書き出しから追加した要約
+        self._added = OrderedDict()
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                self._entries = OrderedDict(json.load(f))
+        except (OSError, ValueError):
+            self._entries = OrderedDict()
+    
+    @staticmethod
+    def key(namespace, kind, title, text):
+        return hashlib.sha256(f"{namespace}\0{kind}\0{title}\0{text}".encode("utf-8")).hexdigest()
+    
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+            self._added[key] = value
+    
+    def save(self):
+        """追加した要約があれば、ファイルの内容と合わせて書き出す"""
+        with self._save_lock:
+            with self._lock:
+                added, self._added = self._added, OrderedDict()
+            if not added:
+                return
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(f"{self._path}.lock", "a") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(self._path, "r", encoding="utf-8") as f:
+                        entries = OrderedDict(json.load(f))
+                except (OSError, ValueError):
+                    entries = OrderedDict()
+                for key, value in added.items():
+                    entries[key] = value
+                    entries.move_to_end(key)
+                while len(entries) > self._max_entries:
+                    entries.popitem(last=False)
+                tmp_path = f"{self._path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(list(entries.items()), f, ensure_ascii=False)
+                os.replace(tmp_path, self._path)
+
+_chunk_cache = None
+_chunk_cache_lock = threading.Lock()
+
+def get_chunk_cache():
+    """プロセス共通のかたまりごとの要約のキャッシュを返す"""
+    global _chunk_cache
+    with _chunk_cache_lock:
+        if _chunk_cache is None:
+            _chunk_cache = ChunkCache()
+            # 文書ごとには書き出さず、プロセスの終了時（常駐モードではジョブごと）にまとめて書き出す
+            atexit.register(_chunk_cache.save)
+        return _chunk_cache
+
+def save_chunk_cache():
+    """このプロセスで追加したかたまりごとの要約を書き出す"""
+    with _chunk_cache_lock:
+        cache = _chunk_cache
+    if cache is not None:
+        cache.save()
+
+def _summarize_parts(client, kind, instruction, title, parts):
+    """複数のかたまりを並行して要約する（キャッシュ済みのかたまりはAPIを呼び出さない）"""
+    # 記録・再生中は、キャッシュの状態によらず同じ呼び出しになるようキャッシュを使わない
+    # (ダミークライアントの応答は、APIキーを設定した後に使われないようキャッシュしない)
+    namespace = getattr(client, "cache_namespace", None)
+    cache = None if active_cassette() or namespace is None else get_chunk_cache()
+    results = [None] * len(parts)
+    pending = []
+    for i, part in enumerate(parts):
+        key = ChunkCache.key(namespace, kind, title, part)
+        results[i] = cache.get(key) if cache else None
+        if results[i] is None:
+            pending.append((i, key, part))
+    
+    def summarize(part):
+        header = f"文書: {title}\n\n" if title else ""
+        with span(f"llm.{kind}", cat="gemini", chars=len(part)):
+            return client.generate_content(contents=f"{header}{part}", system_instruction=instruction)
+    
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(MAP_WORKERS, len(pending)), thread_name_prefix=kind) as executor:
+            # 期限や優先度をワーカースレッドに引き継ぐ
+            futures = [
+                (i, key, executor.submit(contextvars.copy_context().run, summarize, part))
+                for i, key, part in pending
+            ]
+            for i, key, future in futures:
+                results[i] = future.result()
+                if cache and not results[i].startswith(_ERROR_PREFIX):
+                    cache.put(key, results[i])
+    return results
+
+def condense_document(client, text, title="", max_chars=CHUNK_CHARS):
+    """長い文書を、要約に必要な要点に縮める（`max_chars`文字以下の文書はそのまま返す）
+    
+    段落・節の境界で分けたかたまりを並行して要約し（map）、要点の合計が`max_chars`に収まるまで
+    隣り合う要点をまとめて要約する（reduce）ことを繰り返す。
+    """
+    if len(text) <= max_chars:
+        return text
+    
+    notes = _summarize_parts(client, "map", _MAP_INSTRUCTION, title, split_chunks(text, max_chars))
+    while len(notes) > 1 and sum(len(note) + 2 for note in notes) > max_chars:
+        # 隣り合う要点を`max_chars`に収まる範囲（少なくとも2つ）でまとめる
+        groups, current = [], []
+        for note in notes:
+            if len(current) >= 2 and sum(len(item) + 2 for item in current) + len(note) > max_chars:
+                groups.append(current)
+                current = []
+            current.append(note)
+        groups.append(current)
+        notes = _summarize_parts(client, "reduce", _REDUCE_INSTRUCTION, title, ["\n\n".join(group) for group in groups])
+    return "\n\n".join(notes)
+
+def summarize_document(client, content, build_prompt, system_instruction=None, title=""):
+    """長さによらず文書全体を反映して要約する
     
-    return GeminiClient()
\ No newline at end of file
+    `build_prompt`は文書（長い場合は要点に縮めたもの）を受け取ってプロンプトを返す関数。
+    """
+    content = condense_document(client, content, title)
+    return client.generate_content(contents=build_prompt(content), system_instruction=system_instruction)
\ No newline at end of file
@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+
+from nook.local.common import http_client
+from nook.local.common.cassette import active_cassette
+from nook.local.common.deadline import current_run
+
+# 実行ごと・キャッシュ名ごとの節約量。実行の最後にpop_statsで取り出して報告する
+_stats_lock = threading.Lock()
+_stats = {}
+
+
+def _add_stats(name, hits=0, bytes_saved=0, bytes_downloaded=0):
+    with _stats_lock:
+        stats = _stats.setdefault(current_run(), {}).setdefault(
+            name, {"hits": 0, "bytes_saved": 0, "bytes_downloaded": 0}
+        )
+        stats["hits"] += hits
+        stats["bytes_saved"] += bytes_saved
+        stats["bytes_downloaded"] += bytes_downloaded
+
+
+def pop_stats():
+    """現在の実行での条件付きGETの統計をキャッシュ名ごとに取り出してリセットする"""
+    with _stats_lock:
+        return _stats.pop(current_run(), {})
+
+
+class ConditionalCache:
+    """URLごとのETag/Last-Modifiedと解析済みの結果を保存し、条件付きGETで再利用するキャッシュ
+
+    `get`で304が返った場合は前回`store`した解析結果を返すため、
+    ダウンロードと解析の両方を省略できる。
+    """
+
+    def __init__(self, name):
+        self.name = name
+        data_dir = os.environ.get("DATA_DIR", "./data")
+        self._path = os.path.join(data_dir, ".cache", "http", f"{name}.json")
+        self._lock = threading.Lock()
+        self._entries = self._load()
+        self.hits = 0
+        self.bytes_saved = 0
+        self.bytes_downloaded = 0
+
+    def _load(self):
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, url, headers=None):
+        """条件付きGETを行い、(レスポンス, キャッシュ済みの値)を返す
+
+        変更がなければレスポンスはNoneで、前回の解析結果が返る。
+        """
+        with self._lock:
+            entry = self._entries.get(url)
+
+        request_headers = dict(headers or {})
+        # 記録・再生中は、キャッシュの状態によらず再生できるよう常に本文を取得する
+        if entry and not active_cassette():
+            if entry.get("etag"):
+                request_headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                request_headers["If-Modified-Since"] = entry["last_modified"]
+
+        response = http_client.get(url, headers=request_headers)
+        if response.status_code == 304 and entry:
+            with self._lock:
+                self.hits += 1
+                self.bytes_saved += entry.get("size", 0)
+            _add_stats(self.name, hits=1, bytes_saved=entry.get("size", 0))
+            return None, entry["value"]
+
+        response.raise_for_status()
+        with self._lock:
+            self.bytes_downloaded += len(response.content)
+        _add_stats(self.name, bytes_downloaded=len(response.content))
+        return response, None
+
+    def store(self, url, response, value):
+        """レスポンスの検証子と解析結果を保存（検証子がなければ何もしない）"""
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        with self._lock:
+            self._entries[url] = {
+                "etag": etag,
+                "last_modified": last_modified,
+                "size": len(response.content),
+                "value": value,
+            }
+
+    def save(self):
+        """キャッシュをファイルに保存"""
+        with self._lock:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = f"{self._path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self._path)
@@ -0,0 +1,55 @@
+import time
+from urllib.parse import urlparse
+
+import requests
+
+from nook.local.common.cassette import replaying
+from nook.local.common.circuit_breaker import CircuitOpenError, get_breakers
+from nook.local.common.deadline import DeadlineExceeded, HTTP_TIMEOUT, call_timeout
+
+# ブラウザを装うUser-Agent（スクレイピング用）
+BROWSER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
+
+# 接続を使い回すための共有セッション
+_session = requests.Session()
+_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+_session.mount("http://", requests.adapters.HTTPAdapter(pool_connections=32, pool_maxsize=32))
+
+
+def get(url, headers=None, timeout=None, **kwargs):
+    """現在の予算に収まるタイムアウト付きでGETする
+
+    ホストごとのサーキットブレーカーが開いている場合は通信せずにCircuitOpenErrorを送出する。
+    """
+    full_timeout = timeout or HTTP_TIMEOUT
+    timeout = call_timeout(full_timeout)
+    # 再生中は通信しないため、ホストの状態によらず記録された応答を返す
+    if replaying():
+        return _session.get(url, headers=headers, timeout=timeout, **kwargs)
+
+    host = urlparse(url).hostname or url
+    breakers = get_breakers()
+    breakers.before_call(host)
+
+    started = time.monotonic()
+    try:
+        response = _session.get(url, headers=headers, timeout=timeout, **kwargs)
+    except requests.exceptions.Timeout as e:
+        # 予算の残りに合わせて短くしたタイムアウトで打ち切った場合は、ホストの失敗として数えない
+        if timeout < full_timeout:
+            breakers.release(host)
+        else:
+            breakers.record_failure(host, "timeout")
+        raise DeadlineExceeded(f"GET {url} timed out after {timeout:.1f}s") from e
+    except requests.exceptions.RequestException as e:
+        breakers.record_failure(host, type(e).__name__)
+        raise
+
+    # サーバー側の障害とレート制限のみホストの失敗として数える
+    if response.status_code >= 500 or response.status_code == 429:
+        breakers.record_failure(host, f"HTTP {response.status_code}")
+    else:
+        breakers.record_success(host, time.monotonic() - started)
+    return response
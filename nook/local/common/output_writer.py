@@ -0,0 +1,150 @@
+import os
+import glob
+import json
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windowsではロックを取らない
+    fcntl = None
+
+from nook.local.common.rendering import write_fragment
+
+
+def _sort_key(order):
+    """並び順を比べられる形にする（[フィードの番号, 番号]のようなリストと数値が混ざっていてもよい）"""
+    if isinstance(order, (list, tuple)):
+        return tuple(order)
+    return (order,)
+
+
+class MarkdownWriter:
+    """1日分のMarkdownを項目ごとに追記し、最後にアトミックに確定するライター
+
+    完了した項目は`<日付>.md.partial`にJSON Linesで逐次追記（fsync）される。
+    途中で落ちた場合は次回の実行時にこのファイルから再開し、
+    完了済みの項目（`is_done`）は取得やLLM呼び出しをやり直さずに済む。
+    確定時にはHTMLへの変換結果も隣に保存し、Webインターフェースはそれをそのまま返す。
+    当日のジャーナルは確定後も残すため、同じ日に再実行すると新しい項目だけを処理して
+    その日のファイルをその場で更新できる（それより前の日のジャーナルは確定時に削除する）。
+    書き込み中のジャーナルは共有ロックを取っておき、並行して書き込んでいる他の日のジャーナルは削除しない
+    （共有ロックのため、同じ日のライターどうしが待ち合うことはない）。
+    未完了（`complete=False`）として追記した項目は出力には含めるが、次回の実行でやり直す。
+    """
+
+    def __init__(self, data_dir, app_name, date_str, header="", separator="\n"):
+        output_dir = os.path.join(data_dir, app_name)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self._output_dir = output_dir
+        self.output_path = os.path.join(output_dir, f"{date_str}.md")
+        self._date_str = date_str
+        self._journal_path = f"{self.output_path}.partial"
+        self._header = header
+        self._separator = separator
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._sequence = 0
+
+        self.resumed = self._load_journal()
+        if self.resumed:
+            print(f"Resuming {app_name} for {date_str}: {self.resumed} items already completed")
+        self._journal = self._open_journal()
+
+    def _open_journal(self):
+        """ジャーナルを開き、確定するまで他のライターに削除されないよう共有ロックを取る"""
+        while True:
+            journal = open(self._journal_path, "a", encoding="utf-8")
+            if not fcntl:
+                return journal
+            fcntl.flock(journal, fcntl.LOCK_SH)
+            # ロックを待つ間に古いジャーナルとして削除された場合は開き直す
+            try:
+                if os.stat(self._journal_path).st_ino == os.fstat(journal.fileno()).st_ino:
+                    return journal
+            except FileNotFoundError:
+                pass
+            journal.close()
+
+    def _load_journal(self):
+        """前回中断した実行のジャーナルを読み込む"""
+        if not os.path.exists(self._journal_path):
+            return 0
+        with open(self._journal_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 書き込み途中で中断された行は無視する
+                    continue
+                self._entries[entry["key"]] = entry
+                self._sequence += 1
+        return sum(1 for entry in self._entries.values() if entry.get("complete", True))
+
+    def is_done(self, key):
+        """項目が完了済みかどうか"""
+        entry = self._entries.get(str(key))
+        return entry is not None and entry.get("complete", True)
+
+    def append(self, key, markdown, order=None, complete=True):
+        """項目を追記する（同じキーは後から書いたものが優先される）
+
+        `complete=False`の項目（要約できなかった項目など）は出力に含めるが、
+        `is_done`は偽のままなので次回の実行でやり直される。
+        """
+        with self._lock:
+            if order is None:
+                order = self._sequence
+            entry = {"key": str(key), "order": order, "markdown": markdown}
+            if not complete:
+                entry["complete"] = False
+            self._journal.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._entries[entry["key"]] = entry
+            self._sequence += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def finalize(self, write_empty=True):
+        """全項目を順番通りに結合してMarkdownファイルを確定する"""
+        with self._lock:
+            self._journal.close()
+            self._remove_stale_journals()
+            if not self._entries and not write_empty:
+                return None
+
+            entries = sorted(self._entries.values(), key=lambda entry: _sort_key(entry["order"]))
+            content = self._header + self._separator.join(entry["markdown"] for entry in entries)
+
+            tmp_path = f"{self.output_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(content)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.output_path)
+            try:
+                write_fragment(self.output_path, content)
+            except Exception as e:
+                # 変換結果がなくても、Webインターフェースが表示時に変換する
+                print(f"Error rendering {self.output_path}: {e}")
+            return self.output_path
+
+    def _remove_stale_journals(self):
+        """この日より前の日付の、書き込み中でないジャーナルを削除"""
+        for path in glob.glob(os.path.join(self._output_dir, "*.md.partial")):
+            if os.path.basename(path)[:-len(".md.partial")] >= self._date_str:
+                continue
+            try:
+                with open(path, "a") as f:
+                    if fcntl:
+                        try:
+                            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except OSError:
+                            # 他のライターが書き込み中
+                            continue
+                    os.remove(path)
+            except FileNotFoundError:
+                # 他のライターが先に削除した
+                pass
@@ -0,0 +1,112 @@
+import os
+import queue
+import threading
+import contextvars
+from dataclasses import dataclass
+from typing import Callable
+
+from nook.local.common.deadline import DeadlineExceeded, expired, record_skip
+
+# 段と段の間のキューに溜められる項目数
+QUEUE_SIZE = int(os.environ.get("NOOK_PIPELINE_QUEUE_SIZE", 8))
+# 段ごとの既定のワーカー数（通信・HTMLの解析・LLM呼び出し）
+FETCH_WORKERS = int(os.environ.get("NOOK_PIPELINE_FETCH_WORKERS", 8))
+PARSE_WORKERS = int(os.environ.get("NOOK_PIPELINE_PARSE_WORKERS", 2))
+LLM_WORKERS = int(os.environ.get("NOOK_PIPELINE_LLM_WORKERS", 4))
+
+# キューの終端を表す目印
+_DONE = object()
+
+
+@dataclass
+class Stage:
+    """パイプラインの1段（`func`は項目を受け取り、次の段に渡す項目を返す。Noneなら以降の段に渡さない）"""
+
+    name: str
+    func: Callable
+    workers: int = 1
+
+
+def run_pipeline(source, items, stages, describe=str, queue_size=None):
+    """項目を fetch → extract → summarize → render のような段に順に流す
+
+    段ごとにワーカースレッドを立て、段と段の間を上限付きのキューでつなぐため、
+    通信・HTML解析・LLM呼び出しが項目をまたいで並行して進み、全体の処理時間は
+    各段の合計ではなく最も遅い段で決まる。後段が詰まった場合は前段が待つ。
+    ワーカーは呼び出し元のコンテキスト（予算など）を引き継ぐ。
+    予算を使い切った後に途中の段へ進む項目と、段の中で例外になった項目はスキップする
+    （スキップの記録には元の項目を`describe`に渡した名前を使う）。
+    最後の段が返した値のリストを返す（順序は保証しない）。
+    """
+    queue_size = queue_size or QUEUE_SIZE
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    results = []
+    results_lock = threading.Lock()
+    threads = []
+
+    def feed():
+        for item in items:
+            queues[0].put((item, item))
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+
+    def work(index, remaining_workers):
+        stage = stages[index]
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            entry = inbox.get()
+            if entry is _DONE:
+                break
+            item, value = entry
+            # コレクターの予算を使い切った場合は残りをスキップ
+            # (最後の段は済んだ処理の結果を保存するだけなので、期限後も実行する)
+            if outbox is not None and expired():
+                record_skip(source, describe(item), "collector budget exhausted")
+                continue
+            try:
+                result = stage.func(value)
+            except DeadlineExceeded as e:
+                record_skip(source, describe(item), e)
+                continue
+            except Exception as e:
+                print(f"Error in {source} {stage.name} stage for {describe(item)}: {e}")
+                continue
+            if result is None:
+                continue
+            if outbox is not None:
+                outbox.put((item, result))
+            else:
+                with results_lock:
+                    results.append(result)
+
+        # この段の最後のワーカーが終わったら、次の段に終端を伝える
+        with remaining_workers["lock"]:
+            remaining_workers["count"] -= 1
+            last = remaining_workers["count"] == 0
+        if last and outbox is not None:
+            for _ in range(stages[index + 1].workers):
+                outbox.put(_DONE)
+
+    for index, stage in enumerate(stages):
+        remaining_workers = {"count": stage.workers, "lock": threading.Lock()}
+        for n in range(stage.workers):
+            # 期限などのコンテキストをワーカーに引き継ぐ
+            context = contextvars.copy_context()
+            thread = threading.Thread(
+                target=context.run,
+                args=(work, index, remaining_workers),
+                name=f"{source}-{stage.name}-{n}",
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+
+    feed_context = contextvars.copy_context()
+    feeder = threading.Thread(target=feed_context.run, args=(feed,), name=f"{source}-feed", daemon=True)
+    feeder.start()
+    threads.append(feeder)
+
+    for thread in threads:
+        thread.join()
+    return results
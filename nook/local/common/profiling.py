@@ -0,0 +1,111 @@
+import os
+import re
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+
+def _slugify(name):
+    """コレクター名をファイル名に使える形式に変換"""
+    return re.sub(r"[^a-z0-9]+", "_", name.lower()).strip("_")
+
+
+class _ThreadProfilers:
+    """プロファイル中に関数を呼び出した各スレッドのcProfile
+
+    cProfileは有効にしたスレッドしか計測しないため、`threading.setprofile`でフックを登録し、
+    各スレッドが最初に関数を呼び出したときにそのスレッド用のプロファイラを作って有効にする。
+    """
+
+    def __init__(self):
+        self._profilers = []
+        self._lock = threading.Lock()
+
+    def _hook(self, frame, event, arg):
+        # 有効にしたプロファイラがこのスレッドのフックを置き換えるため、スレッドごとに1回だけ呼ばれる
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def start(self):
+        # 開始後に作られたスレッドだけに登録する（実行中のスレッドには他のプロファイラが有効なものもあるため）
+        threading.setprofile(self._hook)
+        main = cProfile.Profile()
+        self._profilers.append(main)
+        main.enable()
+
+    def stop(self):
+        """フックを外し、全てのスレッドの計測結果をまとめたpstats.Statsを返す
+
+        開始前から動いているスレッドは計測しない。終了後も動き続けるワーカースレッドは、
+        そのスレッドの終了まで計測を続ける（まとめた結果には含まれない）。
+        """
+        self._profilers[0].disable()
+        threading.setprofile(None)
+        with self._lock:
+            profilers = list(self._profilers)
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        return stats, len(profilers)
+
+
+def _hot_functions(stats, limit):
+    """自己実行時間の長い関数を抽出"""
+    rows = []
+    for (file_name, line, func_name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        rows.append((tottime, cumtime, calls, f"{func_name} ({os.path.basename(file_name)}:{line})"))
+    rows.sort(reverse=True)
+    return rows[:limit]
+
+
+@contextmanager
+def profile_collector(name, output_dir, date_str, logger=None, top=10):
+    """cProfileとtracemallocでコレクターの実行をプロファイルする
+
+    呼び出したスレッドに加えて、ワーカースレッドの計測結果もまとめる。
+    `.prof`ファイルとメモリ確保の上位レポートを`output_dir`に書き出し、
+    ホットな関数の概要をログに出力する。
+    """
+    slug = _slugify(name)
+    prof_path = os.path.join(output_dir, f"profile_{date_str}_{slug}.prof")
+    alloc_path = os.path.join(output_dir, f"profile_{date_str}_{slug}_alloc.txt")
+    log = logger.info if logger else print
+
+    profilers = _ThreadProfilers()
+    tracemalloc.start()
+    profilers.start()
+    try:
+        yield
+    finally:
+        stats, threads = profilers.stop()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats.dump_stats(prof_path)
+
+        # メモリ確保の上位をファイル単位・行単位で保存
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+        with open(alloc_path, "w", encoding="utf-8") as f:
+            f.write(f"# {name}: current {current / 1024 / 1024:.1f} MiB, peak {peak / 1024 / 1024:.1f} MiB\n\n")
+            f.write("## Top allocations by line\n\n")
+            for stat in snapshot.statistics("lineno")[:30]:
+                f.write(f"{stat}\n")
+            f.write("\n## Top allocations by file\n\n")
+            for stat in snapshot.statistics("filename")[:15]:
+                f.write(f"{stat}\n")
+
+        log(
+            f"[profile] {name}: {threads} threads, peak memory {peak / 1024 / 1024:.1f} MiB, "
+            f"saved {prof_path} and {alloc_path}"
+        )
+        for tottime, cumtime, calls, label in _hot_functions(stats, top):
+            log(f"[profile]   {tottime:8.3f}s self {cumtime:8.3f}s total {calls:>8} calls  {label}")
@@ -0,0 +1,273 @@
+import os
+import json
+import math
+import time
+import heapq
+import datetime
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import pytz
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間の排他を行わない
+    fcntl = None
+
+from nook.local.common.deadline import DeadlineExceeded, current_run, remaining
+
+# Gemini APIの上限（0で無制限）。契約しているプランに合わせて設定する
+REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_RPM", 10))
+TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TPM", 1000000))
+REQUESTS_PER_DAY = int(os.environ.get("GEMINI_RPD", 1000))
+TOKENS_PER_DAY = int(os.environ.get("GEMINI_TPD", 0))
+
+# 1日の上限は太平洋時間の0時にリセットされる
+QUOTA_TIMEZONE = pytz.timezone("America/Los_Angeles")
+
+# ビューアーのチャットなど、ユーザーが応答を待っている呼び出しの優先度
+# (コレクターの呼び出しには順位付けのスコア（0〜1）を使う)
+INTERACTIVE_PRIORITY = 100.0
+
+# 要約できなかった項目に表示する文言（次回の実行で要約し直す）
+UNSUMMARIZED = "*（Gemini APIの利用上限に達したため未要約です。次回の実行で要約します）*"
+
+# 現在のコンテキストで行うLLM呼び出しの優先度
+_priority = contextvars.ContextVar("nook_llm_priority", default=0.0)
+
+
+class QuotaExceededError(Exception):
+    """Gemini APIの利用上限によりLLMを呼び出せないことを表す例外"""
+
+
+@contextmanager
+def priority(value):
+    """このブロック内のLLM呼び出しの優先度を設定する（大きいほど先に呼び出す）"""
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(text):
+    """プロンプトのトークン数を見積もる（日本語を含むため多めに1トークン2文字とする）"""
+    return max(1, len(str(text)) // 2)
+
+
+class QuotaManager:
+    """Gemini APIの分単位・日単位の利用量を管理し、上限内に収まるよう呼び出しを待たせる
+
+    上限はAPIキー（プロジェクト）とモデルの組み合わせごとにかかるため、組み合わせごとに1つ作る。
+    利用量は`DATA_DIR/.state/gemini_quota/<名前>.json`に保存し、コレクターとビューアーなど
+    同じデータディレクトリを使うプロセス間で共有する。
+    枠が空くのを待つ呼び出しが複数ある場合は優先度の高いものから通す。
+    """
+
+    def __init__(
+        self, path, rpm=REQUESTS_PER_MINUTE, tpm=TOKENS_PER_MINUTE, rpd=REQUESTS_PER_DAY, tpd=TOKENS_PER_DAY
+    ):
+        self._path = path
+        self._rpm = rpm
+        self._tpm = tpm
+        self._rpd = rpd
+        self._tpd = tpd
+        self._cond = threading.Condition()
+        self._waiting = []
+        self._sequence = itertools.count()
+        self.waited = 0.0
+
+    def _read_state(self):
+        """保存された利用状況を読み込む（日付が変わっていればリセットし、1分より前の呼び出しは除く）"""
+        try:
+            with open(self._path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            state = {}
+
+        today = datetime.datetime.now(QUOTA_TIMEZONE).strftime("%Y-%m-%d")
+        if state.get("date") != today:
+            state.update({"date": today, "requests": 0, "tokens": 0, "exhausted": False})
+        now = time.time()
+        state["window"] = [call for call in state.get("window", []) if call[0] > now - 60]
+        state.setdefault("blocked_until", 0)
+        return state
+
+    @contextmanager
+    def _shared_state(self):
+        """ファイルをロックして利用状況を読み込み、ブロック内で変更されていれば保存する
+
+        読み込むだけの場合は`_read_state`を使う（保存は置き換えで行うため、ロックなしでも壊れた内容は読まない）。
+        """
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(f"{self._path}.lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            state = self._read_state()
+            before = json.dumps(state)
+
+            yield state
+
+            if json.dumps(state) != before:
+                tmp_path = f"{self._path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self._path)
+
+    def _wait_time(self, state, tokens):
+        """枠が空くまでの秒数（1日の上限に達していればNone）"""
+        now = time.time()
+        if state["exhausted"] or (self._rpd and state["requests"] >= self._rpd):
+            return None
+        if self._tpd and state["tokens"] + tokens > self._tpd:
+            return None
+        if state["blocked_until"] > now:
+            return state["blocked_until"] - now
+        window = state["window"]
+        if self._rpm and len(window) >= self._rpm:
+            return window[0][0] + 60 - now
+        if self._tpm and window and sum(call[1] for call in window) + tokens > self._tpm:
+            return window[0][0] + 60 - now
+        return 0
+
+    def _try_reserve(self, tokens):
+        """枠があれば確保して0を、なければ空くまでの秒数を返す"""
+        with self._shared_state() as state:
+            wait = self._wait_time(state, tokens)
+            if wait is None:
+                raise QuotaExceededError(
+                    f"Gemini daily quota exhausted ({state['requests']} requests, {state['tokens']} tokens today)"
+                )
+            if wait > 0:
+                return wait
+            state["window"].append([time.time(), tokens])
+            state["requests"] += 1
+            state["tokens"] += tokens
+            return 0
+
+    def estimate_wait(self, tokens):
+        """枠を確保せずに、空くまでの秒数を見積もる（1日の上限に達していればNone）"""
+        wait = self._wait_time(self._read_state(), tokens)
+        with self._cond:
+            # このプロセス内で順番を待っている呼び出しの分も考慮する
+            if wait is not None and self._waiting:
+                wait += len(self._waiting) * 60 / (self._rpm or 60)
+        return wait
+
+    def acquire(self, tokens):
+        """呼び出し枠が空くまで待って確保する
+
+        待ち時間が現在の予算を超える場合はDeadlineExceededを、
+        1日の上限に達している場合はQuotaExceededErrorを送出する。
+        """
+        entry = (-_priority.get(), next(self._sequence))
+        started = time.monotonic()
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+            try:
+                while True:
+                    wait = 1.0
+                    if self._waiting[0] == entry:
+                        wait = self._try_reserve(tokens)
+                        if wait <= 0:
+                            return
+                    budget_left = remaining()
+                    if budget_left is not None and wait > budget_left:
+                        raise DeadlineExceeded(
+                            f"Gemini quota would free up in {wait:.0f}s, after the budget runs out"
+                        )
+                    # 他のプロセスの利用状況も変わるため、長くても1秒ごとに確認し直す
+                    self._cond.wait(min(wait, 1.0))
+            finally:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self.waited += time.monotonic() - started
+                self._cond.notify_all()
+
+    def defer(self, seconds):
+        """APIからレート制限を受けた場合に、指定された秒数だけ呼び出しを止める"""
+        with self._shared_state() as state:
+            state["blocked_until"] = max(state["blocked_until"], time.time() + seconds)
+        with self._cond:
+            self._cond.notify_all()
+
+    def exhaust_today(self):
+        """APIから1日の上限に達したと返された場合に、当日の残りの呼び出しを止める"""
+        with self._shared_state() as state:
+            state["exhausted"] = True
+
+    def remaining_today(self):
+        """当日に残っている呼び出し回数（上限がなければNone）"""
+        state = self._read_state()
+        if state["exhausted"] or (self._tpd and state["tokens"] >= self._tpd):
+            return 0
+        if not self._rpd:
+            return None
+        return max(0, self._rpd - state["requests"])
+
+    def usage(self):
+        """当日の利用状況"""
+        state = self._read_state()
+        return {
+            "requests": state["requests"],
+            "tokens": state["tokens"],
+            "limit": self._rpd or None,
+            "token_limit": self._tpd or None,
+            "exhausted": state["exhausted"],
+            "waited": self.waited,
+        }
+
+
+# 実行ごと・ティア（高速なモデル・大きいモデル）ごとの応答時間。実行の最後にpop_tier_statsで取り出して報告する
+_tier_latencies = {}
+_tier_lock = threading.Lock()
+
+
+def record_tier_latency(tier, elapsed):
+    """成功した呼び出しの応答時間をティアごとに記録する"""
+    with _tier_lock:
+        _tier_latencies.setdefault(current_run(), {}).setdefault(tier, []).append(elapsed)
+
+
+def pop_tier_stats():
+    """現在の実行でのティアごとの呼び出し回数と応答時間（平均・p95）を取り出してリセットする"""
+    with _tier_lock:
+        latencies = _tier_latencies.pop(current_run(), {})
+    stats = {}
+    for tier, values in latencies.items():
+        values = sorted(values)
+        stats[tier] = {
+            "calls": len(values),
+            "avg": sum(values) / len(values),
+            "p95": values[min(len(values) - 1, math.ceil(len(values) * 0.95) - 1)],
+        }
+    return stats
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_quota(name="gemini"):
+    """名前（APIキーとモデルの組み合わせ）ごとのプロセス共通のクォータマネージャーを返す"""
+    with _managers_lock:
+        if name not in _managers:
+            data_dir = os.environ.get("DATA_DIR", "./data")
+            _managers[name] = QuotaManager(os.path.join(data_dir, ".state", "gemini_quota", f"{name}.json"))
+        return _managers[name]
+
+
+def all_quotas():
+    """このプロセスで使っているクォータマネージャー"""
+    with _managers_lock:
+        return dict(_managers)
+
+
+def remaining_today():
+    """全てのAPIキーとモデルで当日に残っている呼び出し回数の合計（上限がなければNone）"""
+    remaining = [manager.remaining_today() for manager in all_quotas().values()]
+    if not remaining or None in remaining:
+        return None
+    return sum(remaining)
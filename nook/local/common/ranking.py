@@ -0,0 +1,126 @@
+import os
+import math
+from dataclasses import dataclass, field
+from typing import Any
+
+from nook.local.common import clock
+
+# 1回の実行で要約に使うLLM呼び出しの上限（全コレクターの合計）
+LLM_CALL_BUDGET = int(os.environ.get("NOOK_LLM_CALL_BUDGET", 40))
+# 情報源ごとに最低限要約する件数（人気の指標がない情報源が埋もれないようにする）
+MIN_PER_SOURCE = int(os.environ.get("NOOK_RANK_MIN_PER_SOURCE", 3))
+# 新しさのスコアが半分になるまでの時間（時間）
+RECENCY_HALF_LIFE = float(os.environ.get("NOOK_RANK_HALF_LIFE_HOURS", 24))
+# タイトルや本文に含まれていれば加点するキーワード（カンマ区切り）
+KEYWORDS = [
+    keyword.strip().lower()
+    for keyword in os.environ.get(
+        "NOOK_RANK_KEYWORDS",
+        "llm,gpt,gemini,claude,transformer,agent,rag,diffusion,fine-tuning,inference,python,rust",
+    ).split(",")
+    if keyword.strip()
+]
+
+# 各指標の重み
+WEIGHTS = {"popularity": 0.5, "recency": 0.3, "keywords": 0.2}
+
+
+@dataclass
+class Candidate:
+    """要約の候補となる項目と、順位付けに使う指標"""
+
+    source: str
+    key: str
+    title: str
+    # 情報源ごとの人気の指標（スコア・いいね数・スター数など。なければNone）
+    popularity: float | None = None
+    # 公開時刻（UNIX時間。不明ならNone）
+    published: float | None = None
+    # キーワードの照合に使う本文
+    text: str = ""
+    # コレクターが要約時に使う元のデータ
+    payload: Any = None
+    score: float = 0.0
+    signals: dict[str, float] = field(default_factory=dict)
+
+
+def _normalize_popularity(candidates):
+    """人気の指標を情報源ごとに0〜1へ正規化する（対数を取ってから最小・最大で揃える）"""
+    by_source = {}
+    for candidate in candidates:
+        by_source.setdefault(candidate.source, []).append(candidate)
+
+    for source_candidates in by_source.values():
+        values = [math.log1p(max(c.popularity, 0)) for c in source_candidates if c.popularity is not None]
+        low, high = (min(values), max(values)) if values else (0.0, 0.0)
+        for candidate in source_candidates:
+            if candidate.popularity is None or high == low:
+                # 指標がない・差がない場合は中央の値にする
+                candidate.signals["popularity"] = 0.5
+            else:
+                value = math.log1p(max(candidate.popularity, 0))
+                candidate.signals["popularity"] = (value - low) / (high - low)
+
+
+def _recency(published, now):
+    if published is None:
+        return 0.5
+    age_hours = max(0.0, now - published) / 3600
+    return 0.5 ** (age_hours / RECENCY_HALF_LIFE)
+
+
+def _keyword_score(candidate):
+    if not KEYWORDS:
+        return 0.0
+    haystack = f"{candidate.title} {candidate.text}".lower()
+    matches = sum(1 for keyword in KEYWORDS if keyword in haystack)
+    # 2つ以上一致すれば満点とする
+    return min(1.0, matches / 2)
+
+
+def score_candidates(candidates, now=None):
+    """候補にスコアを付けて高い順に並べ替えたリストを返す"""
+    now = now or clock.now()
+    _normalize_popularity(candidates)
+    for candidate in candidates:
+        candidate.signals["recency"] = _recency(candidate.published, now)
+        candidate.signals["keywords"] = _keyword_score(candidate)
+        candidate.score = sum(WEIGHTS[name] * candidate.signals[name] for name in WEIGHTS)
+    return sorted(candidates, key=lambda candidate: candidate.score, reverse=True)
+
+
+def select_top(candidates, limit=None, min_per_source=None):
+    """全情報源の候補からスコアの高い上位`limit`件を選ぶ
+
+    各情報源から最低`min_per_source`件（候補がそれより少なければ全件）を先に確保し、
+    残りの枠をスコア順に割り当てる。
+    """
+    limit = LLM_CALL_BUDGET if limit is None else limit
+    min_per_source = MIN_PER_SOURCE if min_per_source is None else min_per_source
+    ranked = score_candidates(list(candidates))
+
+    selected = []
+    per_source = {}
+    for candidate in ranked:
+        if len(selected) >= limit:
+            break
+        if per_source.get(candidate.source, 0) < min_per_source:
+            selected.append(candidate)
+            per_source[candidate.source] = per_source.get(candidate.source, 0) + 1
+
+    chosen = {id(candidate) for candidate in selected}
+    for candidate in ranked:
+        if len(selected) >= limit:
+            break
+        if id(candidate) not in chosen:
+            selected.append(candidate)
+
+    return sorted(selected, key=lambda candidate: candidate.score, reverse=True)
+
+
+def group_by_source(candidates):
+    """候補を情報源ごとに分ける"""
+    groups = {}
+    for candidate in candidates:
+        groups.setdefault(candidate.source, []).append(candidate)
+    return groups
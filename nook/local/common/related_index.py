@@ -0,0 +1,257 @@
+import os
+import re
+import json
+import zlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+from nook.local.common import archive
+from nook.local.common.rendering import render_markdown
+
+try:
+    import fcntl
+except ImportError:  # Windowsではプロセス間の排他を行わない
+    fcntl = None
+
+# 特徴量をハッシュで割り当てる次元数（大きいほど衝突が減るが、1項目あたり次元数×4バイトを使う）
+DIM = int(os.environ.get("NOOK_RELATED_DIM", 512))
+# 索引の形式の版（項目の持ち方を変えた場合に上げると、保存済みの索引を作り直す）
+INDEX_VERSION = 2
+# 関連項目として返す最小の類似度
+MIN_SCORE = float(os.environ.get("NOOK_RELATED_MIN_SCORE", 0.1))
+
+_HEADING = re.compile(r"^## (.+)$", re.MULTILINE)
+# 見出しの表示が元のMarkdownと変わりうる記法（リンク・強調・エスケープ・HTMLなど）
+_INLINE_MARKUP = re.compile(r"[\\\[\]*_`<>&!]")
+_URL = re.compile(r"https?://\S+")
+_WORD = re.compile(r"[a-z0-9][a-z0-9+#]*")
+# ひらがな・カタカナ・漢字の連続（分かち書きの代わりに文字2-gramにする）
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u9fff]+")
+_STOPWORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "are", "was", "you", "your",
+    "not", "but", "have", "has", "its", "into", "about", "view", "on", "in", "of", "to",
+    "is", "it", "an", "as", "at", "by", "or", "be", "we", "can", "will", "url", "pdf",
+}
+
+
+def tokenize(text):
+    """英数字は単語、日本語は文字2-gramに分割する"""
+    text = _URL.sub(" ", text.lower())
+    tokens = [word for word in _WORD.findall(text) if len(word) > 1 and word not in _STOPWORDS]
+    for run in _CJK.findall(text):
+        tokens.extend(run[i:i + 2] for i in range(max(1, len(run) - 1)))
+    return tokens
+
+
+def vectorize(text, dim=DIM):
+    """符号付きの特徴ハッシュで、対数を取った単語頻度のベクトルを作る"""
+    counts = {}
+    for token in tokenize(text):
+        counts[token] = counts.get(token, 0) + 1
+    vector = np.zeros(dim, dtype=np.float32)
+    for token, count in counts.items():
+        h = zlib.crc32(token.encode("utf-8"))
+        sign = 1.0 if h & 0x80000000 else -1.0
+        vector[h % dim] += sign * (1.0 + np.log(count))
+    return vector
+
+
+def heading_text(title):
+    """h2見出しのMarkdownを、Webインターフェースに表示される見出し（`render_markdown`の見出しの一覧）と同じテキストにする"""
+    title = title.strip()
+    if not _INLINE_MARKUP.search(title):
+        return title
+    headings = render_markdown(f"## {title}")["headings"]
+    return headings[0]["title"] if headings else title
+
+
+def split_sections(markdown):
+    """Markdownをh2見出しごとの(見出し, 本文)に分ける（見出しがなければ全体を「サマリー」とする）"""
+    matches = list(_HEADING.finditer(markdown))
+    if not matches:
+        return [("サマリー", markdown)] if markdown.strip() else []
+    sections = []
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(markdown)
+        sections.append((match.group(1).strip(), markdown[match.end():end]))
+    return sections
+
+
+class RelatedIndex:
+    """全ての日付・情報源の項目（h2見出しごとの節）のTF-IDFベクトルを行列で保持し、類似した項目を探す
+
+    ベクトルは特徴ハッシュで固定の次元に収めるため、語彙を持たずに項目を追加できる。
+    単語頻度のベクトルと文書頻度を`DATA_DIR/.index/related/index.npz`に保存し、
+    コレクターの実行後に変更のあった日のファイルだけを読み直して更新する。
+    IDFの重み付けと正規化は読み込み時にまとめて行う。
+    """
+
+    def __init__(self, data_dir=None, dim=DIM):
+        self._data_dir = data_dir or os.environ.get("DATA_DIR", "./data")
+        self._path = os.path.join(self._data_dir, ".index", "related", "index.npz")
+        self._dim = dim
+        self._lock = threading.Lock()
+        self._loaded_mtime = None
+        self._reset()
+
+    def _reset(self):
+        self.items = []
+        # 日ごとのファイルの状態（"情報源/日付" -> [更新時刻, サイズ]）
+        self.days = {}
+        self.vectors = np.zeros((0, self._dim), dtype=np.float32)
+        self.df = np.zeros(self._dim, dtype=np.int64)
+        self._weighted = None
+        self._lookup = {}
+
+    @contextmanager
+    def _file_lock(self):
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        with open(f"{self._path}.lock", "a") as lock_file:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _load(self):
+        """保存された索引を読み込む（次元数・形式が変わっていれば作り直す）"""
+        self._reset()
+        try:
+            self._loaded_mtime = os.stat(self._path).st_mtime_ns
+            with np.load(self._path, allow_pickle=False) as data:
+                vectors, df, meta = data["vectors"], data["df"], json.loads(str(data["meta"]))
+        except (OSError, ValueError, KeyError):
+            return
+        if vectors.shape[1] != self._dim or meta.get("version") != INDEX_VERSION:
+            return
+        self.vectors, self.df = vectors.astype(np.float32), df
+        self.items, self.days = meta["items"], meta["days"]
+
+    def _save(self):
+        meta = json.dumps({"version": INDEX_VERSION, "items": self.items, "days": self.days}, ensure_ascii=False)
+        tmp_path = f"{self._path}.tmp.npz"
+        # 単語頻度は小さな値なので、ファイルには半精度で保存する
+        np.savez(tmp_path, vectors=self.vectors.astype(np.float16), df=self.df, meta=np.array(meta))
+        os.replace(tmp_path, self._path)
+        self._loaded_mtime = os.stat(self._path).st_mtime_ns
+
+    def update(self):
+        """変更のあった日のファイルを読み直して索引を更新し、追加した項目数を返す"""
+        with self._lock, self._file_lock():
+            self._load()
+            # パックファイルにまとめられた日も、まとめる前のファイルと同じ状態として扱う
+            current = {}
+            for source in archive.list_sources(self._data_dir):
+                for date in archive.list_dates(self._data_dir, source):
+                    current[f"{source}/{date}"] = (source, date, archive.day_stat(self._data_dir, source, date))
+
+            stale = {day for day, state in self.days.items() if day not in current or current[day][2] != state}
+            added = [day for day in current if day not in self.days or day in stale]
+            if not stale and not added:
+                return 0
+
+            # 変更・削除された日の項目を取り除く
+            if stale:
+                keep = np.array([f"{item['source']}/{item['date']}" not in stale for item in self.items], dtype=bool)
+                self.df -= (self.vectors[~keep] != 0).sum(axis=0)
+                self.vectors = self.vectors[keep]
+                self.items = [item for item, kept in zip(self.items, keep) if kept]
+                for day in stale:
+                    del self.days[day]
+
+            new_items, new_vectors = [], []
+            for day in added:
+                source, date, state = current[day]
+                markdown = archive.read_day(self._data_dir, source, date) or ""
+                for title, body in split_sections(markdown):
+                    # 見出しはWebインターフェースに表示されるテキストで持ち、画面の見出しで引けるようにする
+                    new_items.append({"source": source, "date": date, "title": heading_text(title)})
+                    new_vectors.append(vectorize(f"{title}\n{title}\n{body}", self._dim))
+                self.days[day] = state
+
+            if new_vectors:
+                new_vectors = np.vstack(new_vectors)
+                self.vectors = np.vstack([self.vectors, new_vectors])
+                self.df += (new_vectors != 0).sum(axis=0)
+                self.items.extend(new_items)
+
+            self._save()
+            self._prepare()
+            return len(new_items)
+
+    def refresh(self):
+        """他のプロセスが索引を更新していれば読み込み直す"""
+        with self._lock:
+            try:
+                mtime = os.stat(self._path).st_mtime_ns
+            except OSError:
+                mtime = None
+            if mtime != self._loaded_mtime or self._weighted is None:
+                self._load()
+                self._prepare()
+
+    def _prepare(self):
+        """IDFで重み付けして正規化した行列と、項目の検索表を作る"""
+        idf = np.log((1 + len(self.items)) / (1 + self.df)) + 1
+        self._idf = idf.astype(np.float32)
+        weighted = self.vectors * self._idf
+        norms = np.linalg.norm(weighted, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        self._weighted = weighted / norms
+        self._lookup = {
+            (item["source"], item["date"], item["title"]): i for i, item in enumerate(self.items)
+        }
+        day_ids = {}
+        self._day_ids = np.array(
+            [day_ids.setdefault((item["source"], item["date"]), len(day_ids)) for item in self.items],
+            dtype=np.int64,
+        )
+
+    def _top(self, vector, k, exclude_day=None):
+        vector = vector * self._idf
+        norm = np.linalg.norm(vector)
+        if norm == 0 or not self.items:
+            return []
+        scores = self._weighted @ (vector / norm)
+        # 同じ日の同じ情報源の項目（同じページに表示されるもの）は除く
+        if exclude_day is not None:
+            scores[self._day_ids == exclude_day] = -1
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {**self.items[i], "score": round(float(scores[i]), 4)}
+            for i in top
+            if scores[i] >= MIN_SCORE
+        ]
+
+    def related(self, source, date, title, k=5):
+        """指定した項目に類似した、他の日・他の情報源の項目を類似度の高い順に返す"""
+        self.refresh()
+        with self._lock:
+            index = self._lookup.get((source, date, title))
+            if index is None:
+                return None
+            return self._top(self.vectors[index], k, exclude_day=self._day_ids[index])
+
+    def search(self, text, k=5):
+        """テキストに類似した項目を類似度の高い順に返す"""
+        self.refresh()
+        with self._lock:
+            return self._top(vectorize(text, self._dim), k)
+
+    def __len__(self):
+        return len(self.items)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """プロセス共通の関連項目の索引を返す"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = RelatedIndex()
+        return _index
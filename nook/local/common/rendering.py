@@ -0,0 +1,110 @@
+import os
+import re
+import json
+import html
+import threading
+from collections import OrderedDict
+
+import markdown
+from markdown.extensions.toc import TocExtension, slugify_unicode
+
+from nook.local.common import archive
+
+# 変換結果の形式の版（変換処理を変えた場合に上げると、保存済みの変換結果を使わなくなる）
+FRAGMENT_VERSION = 1
+# パックにまとめた日など、変換結果が保存されていない日の変換結果をメモリに保持する件数
+RENDER_CACHE_SIZE = 256
+
+EMPTY = {"title": None, "html": "", "headings": []}
+
+_H1 = re.compile(r"<h1[^>]*>(.*?)</h1>\s*", re.S)
+
+
+def _flatten(tokens):
+    for token in tokens:
+        yield token
+        yield from _flatten(token["children"])
+
+
+def render_markdown(markdown_text):
+    """1日分のMarkdownをHTMLに変換し、タイトル（h1）・本文・h2見出しの一覧を返す
+
+    本文からはh1を除き、h2には見出しへ移動するためのidを付ける。
+    見出しがない場合は、ブラウザ側での表示と同じく「サマリー」を1つ置く。
+    """
+    # Markdownのインスタンスは変換の状態を持つため、呼び出しごとに作る
+    md = markdown.Markdown(extensions=["extra", "sane_lists", TocExtension(slugify=slugify_unicode)])
+    body = md.convert(markdown_text)
+
+    title = None
+    if match := _H1.search(body):
+        title = match.group(1)
+        body = body[:match.start()] + body[match.end():]
+
+    headings = [
+        {"id": token["id"], "title": html.unescape(token["name"])}
+        for token in _flatten(md.toc_tokens)
+        if token["level"] == 2
+    ]
+    if not headings and markdown_text.strip():
+        headings.append({"id": None, "title": "サマリー"})
+
+    return {"title": title, "html": body, "headings": headings}
+
+
+def fragment_path(markdown_path):
+    """Markdownファイルの隣に置く変換結果のパス（`<日付>.md` -> `<日付>.html.json`）"""
+    return f"{markdown_path[:-len('.md')]}.html.json"
+
+
+def write_fragment(markdown_path, markdown_text):
+    """確定したMarkdownファイルを変換し、元のファイルの(更新時刻, サイズ)と一緒に隣に保存する"""
+    stat = os.stat(markdown_path)
+    fragment = {
+        "version": FRAGMENT_VERSION,
+        "source": [stat.st_mtime_ns, stat.st_size],
+        **render_markdown(markdown_text),
+    }
+    path = fragment_path(markdown_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(fragment, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def load_rendered(data_dir, source, date_str):
+    """情報源と日付の変換結果（タイトル・本文のHTML・見出しの一覧）を返す
+
+    収集時に保存した変換結果が元のMarkdownと一致すればそれを使い、
+    なければ（パックにまとめた日や、変換結果を保存する前に書かれた日）その場で変換してメモリに保持する。
+    """
+    stat = archive.day_stat(data_dir, source, date_str)
+    if stat is None:
+        return EMPTY
+
+    try:
+        with open(fragment_path(os.path.join(data_dir, source, f"{date_str}.md")), "r", encoding="utf-8") as f:
+            fragment = json.load(f)
+        if fragment.get("version") == FRAGMENT_VERSION and fragment.get("source") == stat:
+            return {key: fragment[key] for key in EMPTY}
+    except (OSError, ValueError):
+        pass
+
+    key = (data_dir, source, date_str, tuple(stat))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    markdown_text = archive.read_day(data_dir, source, date_str)
+    rendered = render_markdown(markdown_text) if markdown_text else EMPTY
+    with _cache_lock:
+        _cache[key] = rendered
+        while len(_cache) > RENDER_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return rendered
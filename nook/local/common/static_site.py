@@ -0,0 +1,183 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import markdown
+from jinja2 import Environment, FileSystemLoader
+
+from nook.local.common import archive, rendering
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates")
+
+# 書き出し先（設定すると、収集のたびに内容が変わった日だけを書き出し直す）
+EXPORT_DIR = os.environ.get("NOOK_EXPORT_DIR") or None
+# 日ごとのMarkdown→HTML変換を並行して行うプロセス数
+EXPORT_WORKERS = int(os.environ.get("NOOK_EXPORT_WORKERS", 0)) or os.cpu_count() or 1
+
+# 前回の書き出しで使った各日の元データの(更新時刻, サイズ)を記録するファイル
+_MANIFEST = ".manifest.json"
+
+_template = None
+# 常駐モードでは複数のジョブが同時に書き出しうるため、1つずつ行う
+_export_lock = threading.Lock()
+
+
+def _write(path, content):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _version():
+    """書き出す内容に影響するテンプレートと変換処理の版（変わった場合は全ての日を書き出し直す）"""
+    digest = hashlib.sha256(markdown.__version__.encode("utf-8"))
+    for path in (os.path.join(TEMPLATES_DIR, "index.html"), rendering.__file__):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _get_template():
+    global _template
+    if _template is None:
+        env = Environment(loader=FileSystemLoader(TEMPLATES_DIR), autoescape=True)
+        _template = env.get_template("index.html")
+    return _template
+
+
+def render_day(data_dir, output_dir, date_str):
+    """1日分の各情報源をHTMLに変換し、`<日付>/<情報源>.json`と`<日付>/index.html`に書き出す"""
+    date_dir = os.path.join(output_dir, date_str)
+    os.makedirs(date_dir, exist_ok=True)
+
+    contents = {}
+    for source in archive.SOURCES:
+        # 収集時に変換済みの日は、その結果をそのまま使う
+        contents[source] = rendering.load_rendered(data_dir, source, date_str)
+        _write(os.path.join(date_dir, f"{source}.json"), json.dumps(contents[source], ensure_ascii=False))
+
+    # 日付の一覧はページに埋め込まず dates.json から読むため、日付が増えても過去のページは変わらない
+    page = _get_template().render(
+        contents=contents,
+        headings={source: rendered["headings"] for source, rendered in contents.items()},
+        selected_date=date_str,
+        app_names=list(archive.SOURCES),
+        weather=None,
+        available_dates=[date_str],
+        base="..",
+        static_export=True,
+    )
+    _write(os.path.join(date_dir, "index.html"), page)
+    return date_str
+
+
+def _render_days(data_dir, output_dir, dates, workers):
+    """日ごとの書き出しを複数のプロセスで並行して行い、書き出し終えた日を順に返す"""
+    if workers > 1 and len(dates) > 1:
+        try:
+            # 常駐モードなどスレッドを使っているプロセスからforkしないよう、spawnでワーカーを起動する
+            with ProcessPoolExecutor(
+                max_workers=min(workers, len(dates)), mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                yield from executor.map(
+                    render_day, [data_dir] * len(dates), [output_dir] * len(dates), dates, chunksize=8
+                )
+            return
+        except (BrokenProcessPool, OSError) as e:
+            # プロセスを作れない環境では、このプロセスで順に書き出す（書き出し済みの日も書き直す）
+            print(f"Exporting in a single process: {e}")
+    for date_str in dates:
+        yield render_day(data_dir, output_dir, date_str)
+
+
+def _copy_static(output_dir):
+    """CSS・JavaScriptを書き出し先にコピーする（変わっていないファイルはそのまま）"""
+    static_dir = os.path.join(TEMPLATES_DIR, "static")
+    target_dir = os.path.join(output_dir, "static")
+    os.makedirs(target_dir, exist_ok=True)
+    for file_name in os.listdir(static_dir):
+        source_path = os.path.join(static_dir, file_name)
+        target_path = os.path.join(target_dir, file_name)
+        if not os.path.isfile(source_path):
+            continue
+        source_stat = os.stat(source_path)
+        try:
+            target_stat = os.stat(target_path)
+            if (target_stat.st_mtime_ns, target_stat.st_size) == (source_stat.st_mtime_ns, source_stat.st_size):
+                continue
+        except FileNotFoundError:
+            pass
+        shutil.copy2(source_path, target_path)
+
+
+def export(output_dir=None, data_dir=None, workers=EXPORT_WORKERS):
+    """閲覧用のページを静的なHTML/JSONとして書き出し、(書き出した日数, 変わらなかった日数, 削除した日数)を返す
+
+    各日の元データの(更新時刻, サイズ)を前回の書き出しと比べ、変わった日だけを書き出し直す。
+    書き出し先は任意の静的ファイルサーバーで配信でき、関連する項目とチャットは
+    引き続きviewerで提供する。
+    """
+    output_dir = output_dir or EXPORT_DIR
+    data_dir = data_dir or os.environ.get("DATA_DIR", "./data")
+    with _export_lock:
+        return _export(output_dir, data_dir, workers)
+
+
+def _export(output_dir, data_dir, workers):
+    os.makedirs(output_dir, exist_ok=True)
+
+    manifest_path = os.path.join(output_dir, _MANIFEST)
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+    version = _version()
+    previous = manifest.get("days", {}) if manifest.get("version") == version else {}
+
+    dates = set()
+    for source in archive.SOURCES:
+        dates.update(archive.list_dates(data_dir, source))
+
+    days = {}
+    pending = []
+    for date_str in sorted(dates):
+        days[date_str] = {source: archive.day_stat(data_dir, source, date_str) for source in archive.SOURCES}
+        if previous.get(date_str) != days[date_str] or not os.path.exists(
+            os.path.join(output_dir, date_str, "index.html")
+        ):
+            pending.append(date_str)
+
+    # 書き出しが途中で中断しても、書き出し終えた日はやり直さないよう定期的に記録する
+    done = {date_str: stats for date_str, stats in previous.items() if date_str in dates}
+    for i, date_str in enumerate(_render_days(data_dir, output_dir, pending, workers), 1):
+        done[date_str] = days[date_str]
+        if i % 100 == 0:
+            _write(manifest_path, json.dumps({"version": version, "days": done}))
+
+    removed = [date_str for date_str in manifest.get("days", {}) if date_str not in dates]
+    for date_str in removed:
+        shutil.rmtree(os.path.join(output_dir, date_str), ignore_errors=True)
+
+    _copy_static(output_dir)
+    available_dates = sorted(dates, reverse=True)
+    _write(os.path.join(output_dir, "dates.json"), json.dumps(available_dates))
+    # トップページは最新の日へ移動する
+    if available_dates:
+        head = f'<meta http-equiv="refresh" content="0; url={available_dates[0]}/">\n'
+        body = f'<a href="{available_dates[0]}/">{available_dates[0]}</a>'
+    else:
+        head, body = "", "データがありません"
+    _write(os.path.join(output_dir, "index.html"), (
+        f'<!DOCTYPE html>\n<html lang="ja">\n<head>\n<meta charset="UTF-8">\n{head}'
+        f"<title>Nook Local</title>\n</head>\n<body>{body}</body>\n</html>\n"
+    ))
+    _write(manifest_path, json.dumps({"version": version, "days": days}))
+
+    return len(pending), len(dates) - len(pending), len(removed)
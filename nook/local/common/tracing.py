@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+# 有効なトレーサー（無効時はNone）
+_tracer = None
+
+
+class Tracer:
+    """スパンを記録してChrome/Perfetto形式のトレースJSONに書き出す"""
+
+    def __init__(self):
+        self._events = []
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def _now_us(self):
+        return (time.perf_counter() - self._origin) * 1_000_000
+
+    def _tid(self):
+        thread = threading.current_thread()
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads[thread.ident] = (len(self._threads) + 1, thread.name)
+            return self._threads[thread.ident][0]
+
+    def add(self, name, cat, start_us, end_us, tid, args):
+        """完了したスパンを追加"""
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round(start_us, 3),
+            "dur": round(end_us - start_us, 3),
+            "pid": self._pid,
+            "tid": tid,
+        }
+        if args:
+            event["args"] = {key: str(value) for key, value in args.items()}
+        with self._lock:
+            self._events.append(event)
+
+    def export(self, path):
+        """トレースをJSONファイルに保存"""
+        with self._lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._threads.values()
+            ]
+            events = metadata + sorted(self._events, key=lambda e: e["ts"])
+
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+        return len(events) - len(metadata)
+
+
+def start_tracing():
+    """トレースの記録を開始"""
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing(path):
+    """トレースの記録を終了してファイルに書き出し、記録したスパン数を返す"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return 0
+    return tracer.export(path)
+
+
+def tracing_enabled():
+    return _tracer is not None
+
+
+@contextmanager
+def span(name, cat="nook", **args):
+    """処理の開始から終了までをスパンとして記録する（無効時は何もしない）"""
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+
+    tid = tracer._tid()
+    start = tracer._now_us()
+    try:
+        yield
+    finally:
+        tracer.add(name, cat, start, tracer._now_us(), tid, args)
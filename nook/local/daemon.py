@@ -0,0 +1,196 @@
+import os
+import re
+import signal
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytz
+
+from nook.local.common import archive, static_site
+from nook.local.common.deadline import RUN_BUDGET, budget, pop_skipped, run_scope
+from nook.local.common.http_cache import pop_stats
+from nook.local.common.quota import pop_tier_stats
+from nook.local.common.related_index import get_index
+
+JST = pytz.timezone('Asia/Tokyo')
+
+# 情報源ごとの既定スケジュール（環境変数 NOOK_SCHEDULE_<KEY> で上書き可能）
+# arXivの新着リストは米国東部時間20時（日本時間の午前9〜10時）に公開されるため、その後に実行する
+DEFAULT_SCHEDULES = {
+    "hacker_news": "every 60m",
+    "tech_feed": "every 3h",
+    "reddit_explorer": "every 6h",
+    "github_trending": "daily 09:00",
+    "paper_summarizer": "daily 10:30",
+}
+# 古い月のファイルをパックファイルにまとめるスケジュール（環境変数 NOOK_SCHEDULE_ARCHIVE で上書き可能）
+ARCHIVE_SCHEDULE = "daily 04:00"
+
+
+class Schedule:
+    """`every 30m` / `every 2h` / `daily 10:30`（日本時間）形式の実行スケジュール"""
+
+    def __init__(self, spec):
+        self.spec = spec.strip()
+        every = re.fullmatch(r"every\s+(\d+)\s*([mh])", self.spec)
+        daily = re.fullmatch(r"daily\s+(\d{1,2}):(\d{2})", self.spec)
+        if every:
+            amount, unit = int(every.group(1)), every.group(2)
+            self.interval = datetime.timedelta(minutes=amount if unit == "m" else amount * 60)
+            self.time_of_day = None
+        elif daily:
+            self.interval = None
+            self.time_of_day = datetime.time(int(daily.group(1)), int(daily.group(2)))
+        else:
+            raise ValueError(f"Invalid schedule: {spec!r} (expected 'every 30m', 'every 2h' or 'daily HH:MM')")
+
+    def next_after(self, now):
+        """`now`より後の次回実行時刻"""
+        if self.interval is not None:
+            return now + self.interval
+        candidate = now.replace(
+            hour=self.time_of_day.hour, minute=self.time_of_day.minute, second=0, microsecond=0
+        )
+        if candidate <= now:
+            candidate += datetime.timedelta(days=1)
+        return candidate
+
+    def first_run(self, now, has_today_output):
+        """起動直後の初回実行時刻（当日分が未作成で予定時刻を過ぎていればすぐに実行）"""
+        if self.interval is not None:
+            return now
+        today_at = now.replace(
+            hour=self.time_of_day.hour, minute=self.time_of_day.minute, second=0, microsecond=0
+        )
+        if today_at <= now and not has_today_output:
+            return now
+        return self.next_after(now)
+
+
+class _Job:
+    """常駐中に使い回すコレクターと、その実行状態"""
+
+    def __init__(self, key, name, collector, schedule):
+        self.key = key
+        self.name = name
+        self.collector = collector
+        self.schedule = schedule
+        self.next_run = None
+        self.lock = threading.Lock()
+
+
+def _has_today_output(data_dir, key, now):
+    return os.path.exists(os.path.join(data_dir, key, f"{now.strftime('%Y-%m-%d')}.md"))
+
+
+def _compact_archive(logger):
+    for source, (days, loose_bytes, packed_bytes) in archive.compact().items():
+        logger.info(f"  {source}: packed {days} days ({loose_bytes} -> {packed_bytes} bytes)")
+
+
+def run_daemon(collectors, logger, poll_interval=30):
+    """コレクターを常駐させ、情報源ごとのスケジュールで実行する
+
+    コレクターは起動時に一度だけ生成し、Redditの認証・Geminiの設定・HTTP接続を使い回す。
+    同じ情報源の実行が重なる場合は後から来た実行をスキップする。
+    """
+    data_dir = os.environ.get("DATA_DIR", "./data")
+    now = datetime.datetime.now(JST)
+
+    jobs = []
+    for key, name, create_collector in collectors:
+        spec = os.environ.get(f"NOOK_SCHEDULE_{key.upper()}", DEFAULT_SCHEDULES.get(key, "daily 06:00"))
+        if spec.strip().lower() == "off":
+            logger.info(f"{name}: disabled")
+            continue
+        schedule = Schedule(spec)
+        logger.info(f"Initializing {name} ({schedule.spec})...")
+        job = _Job(key, name, create_collector(), schedule)
+        job.next_run = schedule.first_run(now, _has_today_output(data_dir, key, now))
+        jobs.append(job)
+
+    if not jobs:
+        logger.warning("No collectors are scheduled")
+        return
+
+    spec = os.environ.get("NOOK_SCHEDULE_ARCHIVE", ARCHIVE_SCHEDULE)
+    if spec.strip().lower() != "off":
+        schedule = Schedule(spec)
+        job = _Job("archive", "Archive compaction", lambda: _compact_archive(logger), schedule)
+        job.next_run = schedule.next_after(now)
+        jobs.append(job)
+
+    # 1回の実行あたりの予算は、通常実行で各コレクターに割り当てられる分と同じにする
+    job_budget = RUN_BUDGET / len(collectors)
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        logger.info("Stopping collector daemon...")
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    def run_job(job):
+        # 同時に動く他のジョブのスキップ項目・統計と混ざらないよう、ジョブごとに集計する
+        with run_scope():
+            try:
+                logger.info(f"Running {job.name}...")
+                with budget(job_budget, name=job.name):
+                    job.collector()
+                logger.info(f"{job.name} completed")
+            except Exception as e:
+                logger.error(f"Error in {job.name}: {e}", exc_info=True)
+            finally:
+                for entry in pop_skipped():
+                    logger.warning(f"  [{entry['source']}] skipped {entry['item']}: {entry['reason']}")
+                for tier, stats in pop_tier_stats().items():
+                    logger.info(
+                        f"  Gemini {tier} tier: {stats['calls']} calls, avg {stats['avg']:.1f}s, p95 {stats['p95']:.1f}s"
+                    )
+                for cache_name, stats in pop_stats().items():
+                    logger.info(
+                        f"  [{cache_name}] {stats['hits']} not modified, {stats['bytes_saved']} bytes saved"
+                    )
+                try:
+                    # コレクターの生成時に読み込み済みのため、ここでのインポートは重くない
+                    from nook.local.common.gemini_client import save_chunk_cache
+                    save_chunk_cache()
+                except Exception as e:
+                    logger.error(f"Error saving chunk summary cache: {e}", exc_info=True)
+                try:
+                    added = get_index().update()
+                    logger.info(f"  Related index: {added} items updated")
+                except Exception as e:
+                    logger.error(f"Error updating related index: {e}", exc_info=True)
+                if static_site.EXPORT_DIR:
+                    try:
+                        rendered = static_site.export()[0]
+                        logger.info(f"  Static site: {rendered} days rendered")
+                    except Exception as e:
+                        logger.error(f"Error exporting static site: {e}", exc_info=True)
+                job.lock.release()
+
+    logger.info("Collector daemon started")
+    for job in jobs:
+        logger.info(f"{job.name}: next run at {job.next_run.strftime('%Y-%m-%d %H:%M')}")
+
+    with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="collector") as executor:
+        while not stop_event.is_set():
+            now = datetime.datetime.now(JST)
+            for job in jobs:
+                if job.next_run > now:
+                    continue
+                job.next_run = job.schedule.next_after(now)
+                # 前回の実行が終わっていなければ重ねて実行しない
+                if not job.lock.acquire(blocking=False):
+                    logger.warning(f"{job.name} is still running; skipping this run")
+                    continue
+                executor.submit(run_job, job)
+                logger.info(f"{job.name}: next run at {job.next_run.strftime('%Y-%m-%d %H:%M')}")
+            stop_event.wait(poll_interval)
+
+        logger.info("Waiting for running collectors to finish...")
+
+    logger.info("Collector daemon stopped")
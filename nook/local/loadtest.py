@@ -0,0 +1,332 @@
+import os
+import sys
+import json
+import math
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+from urllib.parse import urlencode
+
+# viewerを適切なパスからインポートできるようにする
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# 負荷をかける対象のエンドポイントと重み
+ENDPOINTS = {
+    "index": 1,
+    "fetch_rendered": 6,
+    "fetch_markdown": 1,
+    "api_weather": 2,
+    "chat": 1,
+}
+
+_SAMPLE_PARAGRAPH = (
+    "この記事は新しいアルゴリズムの効率性と、それが業界にもたらす可能性のある変化について述べています。"
+    "主な論点は計算コストの削減と精度の向上であり、実運用での検証結果も紹介されています。"
+)
+
+
+def build_synthetic_data_dir(root, app_names, years=3, items_per_day=10):
+    """複数年分のダミーMarkdownを持つDATA_DIRを生成する"""
+    end = datetime.date.today()
+    start = end - datetime.timedelta(days=365 * years)
+    dates = []
+    day = start
+    while day <= end:
+        dates.append(day.strftime("%Y-%m-%d"))
+        day += datetime.timedelta(days=1)
+
+    for app_name in app_names:
+        app_dir = os.path.join(root, app_name)
+        os.makedirs(app_dir, exist_ok=True)
+        for date_str in dates:
+            parts = [f"# {app_name} {date_str}\n\n"]
+            for i in range(items_per_day):
+                parts.append(f"## Item {i} of {date_str}\n\n")
+                parts.append(f"[Read Article](https://example.com/{app_name}/{date_str}/{i})\n\n")
+                parts.append(f"{_SAMPLE_PARAGRAPH}\n\n---\n\n")
+            with open(os.path.join(app_dir, f"{date_str}.md"), "w", encoding="utf-8") as f:
+                f.write("".join(parts))
+
+    return dates
+
+
+class _StubResponse:
+    """requests.Responseの代わりに使うスタブ"""
+    def __init__(self, url, payload=None, text=""):
+        self.url = url
+        self.status_code = 200
+        self._payload = payload
+        self.text = text
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self._payload
+
+
+class _StubUpstream:
+    """気象庁APIとリンク先ページを模擬するスタブ（指定した遅延でブロックする）"""
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def get(self, url, *args, **kwargs):
+        self.calls += 1
+        # 本物のrequests.getと同じく同期的にブロックする
+        time.sleep(self.latency)
+        if "jma.go.jp" in url:
+            return _StubResponse(url, payload=self._weather_payload())
+        html = f"<html><body><article><p>{_SAMPLE_PARAGRAPH * 20}</p></article></body></html>"
+        return _StubResponse(url, text=html)
+
+    @staticmethod
+    def _weather_payload():
+        return [{
+            "timeSeries": [
+                {"areas": [{"area": {"name": "東京地方", "code": "130010"}, "weatherCodes": ["100"]}]},
+                {"areas": []},
+                {"areas": [{"area": {"name": "東京", "code": "44132"}, "temps": ["12", "20"]}]},
+            ]
+        }]
+
+
+class _StubLLM:
+    """Geminiクライアントを模擬するスタブ"""
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generate_content(self, contents, system_instruction=None):
+        time.sleep(self.latency)
+        return "ダミーの応答です。"
+
+    def chat_with_search(self, message):
+        return self.generate_content(message)
+
+
+async def _asgi_request(app, method, path, query=None, body=None):
+    """ASGIアプリに直接リクエストを送り、ステータスとボディを返す"""
+    raw_body = json.dumps(body).encode("utf-8") if body is not None else b""
+    headers = [(b"host", b"loadtest")]
+    if body is not None:
+        headers.append((b"content-type", b"application/json"))
+        headers.append((b"content-length", str(len(raw_body)).encode()))
+
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "query_string": urlencode(query or {}).encode(),
+        "root_path": "",
+        "headers": headers,
+        "client": ("127.0.0.1", 50000),
+        "server": ("loadtest", 80),
+    }
+
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": raw_body, "more_body": False}
+        # レスポンス送信完了まで待機させる
+        await asyncio.sleep(3600)
+        return {"type": "http.disconnect"}
+
+    status = None
+    chunks = []
+
+    async def send(message):
+        nonlocal status
+        if message["type"] == "http.response.start":
+            status = message["status"]
+        elif message["type"] == "http.response.body":
+            chunks.append(message.get("body", b""))
+
+    await app(scope, receive, send)
+    return status, b"".join(chunks)
+
+
+def _percentile(sorted_values, p):
+    """ソート済みリストから最近傍順位法でパーセンタイルを求める"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+class LoadTester:
+    """viewerのFastAPIアプリに並行リクエストを送り、レイテンシを計測する"""
+
+    def __init__(self, viewer, dates, concurrency=10, total_requests=200, endpoints=None, seed=0):
+        self._viewer = viewer
+        self._dates = dates
+        self._concurrency = concurrency
+        self._total_requests = total_requests
+        self._endpoints = endpoints or list(ENDPOINTS)
+        self._random = random.Random(seed)
+        self._latencies = {name: [] for name in self._endpoints}
+        self._errors = {name: 0 for name in self._endpoints}
+        self._loop_lags = []
+
+    def _next_request(self):
+        """重みに従って次に送るリクエストを決める"""
+        weights = [ENDPOINTS[name] for name in self._endpoints]
+        name = self._random.choices(self._endpoints, weights=weights)[0]
+        date = self._random.choice(self._dates)
+        app_name = self._random.choice(self._viewer.app_names)
+
+        if name == "index":
+            return name, "GET", "/", {"date": date}, None
+        if name == "fetch_rendered":
+            return name, "GET", "/fetch_rendered", {"app_name": app_name, "date": date}, None
+        if name == "fetch_markdown":
+            return name, "GET", "/fetch_markdown", {"app_name": app_name, "date": date}, None
+        if name == "api_weather":
+            return name, "GET", "/api/weather", None, None
+        markdown = self._viewer.fetch_markdown(app_name, date)
+        body = {
+            "message": "この記事の要点を教えてください",
+            "markdown": markdown[:2000],
+        }
+        return name, "POST", f"/chat/{app_name}-{date}", None, body
+
+    async def _worker(self, remaining):
+        while remaining:
+            remaining.pop()
+            name, method, path, query, body = self._next_request()
+            started = time.perf_counter()
+            try:
+                # ネットワーク受信を模してループに制御を戻す（他リクエストの待ち時間も計測に含める）
+                await asyncio.sleep(0)
+                status, _ = await _asgi_request(self._viewer.app, method, path, query, body)
+                if status is None or status >= 400:
+                    self._errors[name] += 1
+            except Exception as e:
+                print(f"Error requesting {path}: {e}")
+                self._errors[name] += 1
+            self._latencies[name].append(time.perf_counter() - started)
+
+    async def _monitor_loop(self, interval=0.01):
+        """イベントループの遅延を計測する（ブロッキング処理の検出用）"""
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(interval)
+            self._loop_lags.append(time.perf_counter() - started - interval)
+
+    async def run(self):
+        """負荷試験を実行して結果を返す"""
+        remaining = list(range(self._total_requests))
+        monitor = asyncio.create_task(self._monitor_loop())
+        started = time.perf_counter()
+        await asyncio.gather(*(self._worker(remaining) for _ in range(self._concurrency)))
+        elapsed = time.perf_counter() - started
+        monitor.cancel()
+        return self._report(elapsed)
+
+    def _report(self, elapsed):
+        results = {"elapsed": elapsed, "concurrency": self._concurrency, "endpoints": {}}
+        for name, values in self._latencies.items():
+            values = sorted(values)
+            results["endpoints"][name] = {
+                "requests": len(values),
+                "errors": self._errors[name],
+                "rps": len(values) / elapsed if elapsed else 0.0,
+                "p50_ms": _percentile(values, 50) * 1000,
+                "p95_ms": _percentile(values, 95) * 1000,
+                "p99_ms": _percentile(values, 99) * 1000,
+            }
+        lags = sorted(self._loop_lags)
+        results["event_loop_lag"] = {
+            "p99_ms": _percentile(lags, 99) * 1000,
+            "max_ms": (lags[-1] if lags else 0.0) * 1000,
+        }
+        return results
+
+
+def print_report(results):
+    """結果を表形式で表示する"""
+    print(f"\nConcurrency: {results['concurrency']} | Elapsed: {results['elapsed']:.2f}s")
+    print(f"{'endpoint':<16}{'requests':>10}{'errors':>8}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, stats in results["endpoints"].items():
+        print(
+            f"{name:<16}{stats['requests']:>10}{stats['errors']:>8}{stats['rps']:>10.1f}"
+            f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}"
+        )
+    lag = results["event_loop_lag"]
+    print(f"\nEvent loop lag: p99 {lag['p99_ms']:.1f} ms | max {lag['max_ms']:.1f} ms")
+    if lag["max_ms"] > 100:
+        print("警告: イベントループが長時間ブロックされています（同期I/Oがasyncハンドラ内で実行されている可能性があります）")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Nook viewerの負荷試験")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時実行するクライアント数")
+    parser.add_argument("--requests", type=int, default=200, help="送信する総リクエスト数")
+    parser.add_argument("--years", type=int, default=3, help="生成するダミーデータの年数")
+    parser.add_argument("--items-per-day", type=int, default=10, help="1日あたりの記事数")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS), help="対象エンドポイント（カンマ区切り）")
+    parser.add_argument("--upstream-latency", type=float, default=0.05, help="天気API・リンク先の模擬遅延（秒）")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Gemini APIの模擬遅延（秒）")
+    parser.add_argument("--data-dir", default=None, help="既存のデータディレクトリを使う場合に指定")
+    parser.add_argument("--json", default=None, help="結果をJSONで保存するパス")
+    args = parser.parse_args(argv)
+
+    endpoints = [name.strip() for name in args.endpoints.split(",") if name.strip()]
+    unknown = [name for name in endpoints if name not in ENDPOINTS]
+    if unknown:
+        parser.error(f"Unknown endpoints: {', '.join(unknown)}")
+
+    from nook.local import viewer
+    from nook.local.common import archive
+
+    with tempfile.TemporaryDirectory(prefix="nook-loadtest-") as tmp_dir:
+        if args.data_dir:
+            data_dir = args.data_dir
+            # パックファイルにまとめた日も含める（展開して読む経路も計測する）
+            dates = sorted({
+                date_str
+                for app_name in viewer.app_names
+                for date_str in archive.list_dates(data_dir, app_name)
+            })
+        else:
+            data_dir = tmp_dir
+            print(f"Generating {args.years} years of synthetic data in {data_dir}...")
+            dates = build_synthetic_data_dir(data_dir, viewer.app_names, args.years, args.items_per_day)
+
+        if not dates:
+            parser.error(f"No data found in {data_dir}")
+
+        # 外部サービスをスタブに差し替える
+        upstream = _StubUpstream(args.upstream_latency)
+        original = (viewer.data_dir, viewer.requests.get, viewer.create_client)
+        viewer.data_dir = data_dir
+        viewer.requests.get = upstream.get
+        viewer.create_client = lambda use_search=False, service=None: _StubLLM(args.llm_latency)
+        try:
+            tester = LoadTester(viewer, dates, args.concurrency, args.requests, endpoints)
+            results = asyncio.run(tester.run())
+        finally:
+            viewer.data_dir, viewer.requests.get, viewer.create_client = original
+
+    results["upstream_calls"] = upstream.calls
+    print_report(results)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Saved results to {args.json}")
+
+    return results
+
+
+if __name__ == "__main__":
+    main()
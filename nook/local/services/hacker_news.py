@@ -1,11 +1,16 @@
 import os
-import datetime
-import json
-import time
-import pytz
+import inspect
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-import requests
+from nook.local.common import clock, http_client
+from nook.local.common.deadline import DeadlineExceeded, expired, record_skip
+from nook.local.common.output_writer import MarkdownWriter
+from nook.local.common.pipeline import FETCH_WORKERS, LLM_WORKERS, Stage, run_pipeline
+from nook.local.common.quota import UNSUMMARIZED, QuotaExceededError, priority
+from nook.local.common.ranking import Candidate, select_top
+from nook.local.common.tracing import span
 
 class HackerNewsCollector:
     """Hacker Newsの記事を収集するコレクター"""
@@ -13,44 +18,168 @@ class HackerNewsCollector:
     def __init__(self):
         self._data_dir = os.environ.get("DATA_DIR", "./data")
         self._api_base_url = "https://hacker-news.firebaseio.com/v0"
+        # 過去の日付の記事は、投稿時刻で絞り込めるAlgoliaの検索APIで取得する
+        self._search_url = "https://hn.algolia.com/api/v1/search"
         self._article_limit = 20
+        # 記事の詳細・コメントは、全ての記事で共有する上限付きのスレッドプールで並行して取得する
+        self._pool = ThreadPoolExecutor(
+            max_workers=int(os.environ.get("NOOK_HN_FETCH_WORKERS", 16)), thread_name_prefix="hacker_news"
+        )
+        # 有効にすると、記事とコメントのツリーを読んで要約する（要約する記事は他の情報源と一緒に順位付けで選ぶ）
+        self._summarize_discussions = os.environ.get("NOOK_HN_DISCUSSIONS", "").lower() in ("1", "true", "yes")
+        # コメントのツリーをたどる深さ（1はトップレベルのコメントのみ）と、1記事あたりのコメント数の上限
+        self._comment_depth = int(os.environ.get("NOOK_HN_COMMENT_DEPTH", 3))
+        self._comment_limit = int(os.environ.get("NOOK_HN_COMMENT_LIMIT", 40))
+        self._client = None
+        if self._summarize_discussions:
+            # Gemini APIのクライアントの読み込みは時間がかかるため、議論を要約する場合だけ読み込む
+            from nook.local.common.gemini_client import create_client
+            
+            self._client = create_client(service="hacker_news")
+        self._writer = None
+        self._stories = []
+    
+    def __call__(self, date=None):
+        """Hacker Newsから最新の記事（`date`を指定した場合はその日に投稿された記事）を収集して保存"""
+        self.summarize(select_top(self.gather(date)))
+    
+    def gather(self, date=None):
+        """トップ記事（`date`を指定した場合はその日に投稿された記事）の詳細を取得する
         
-    def __call__(self):
-        """Hacker Newsから最新の記事を収集して保存"""
+        コメントを要約する設定の場合は、まだ要約していない記事を候補として返す。
+        """
         print("Collecting Hacker News articles...")
         
-        # トップ記事のIDを取得
-        top_stories = self._get_top_stories()
+        # 日本時間で現在の日付を取得
+        date_str = (date or clock.today_jst()).strftime("%Y-%m-%d")
+        
+        # 完了した記事から順にファイルへ追記する（中断した場合は続きから再開）
+        self._writer = MarkdownWriter(
+            self._data_dir, "hacker_news", date_str,
+            header="# Hacker News Top Stories\n\n", separator=""
+        )
+        
+        # トップ記事のIDを取得（過去の日付は検索結果に記事の詳細も含まれる）
+        with span("fetch", cat="hacker_news", item="topstories"):
+            if date is None:
+                top_stories = self._get_top_stories()[:self._article_limit]
+                history = None
+            else:
+                history = self._search_stories(date)
+                top_stories = list(history)
         
-        # 各記事の詳細を取得
-        articles = []
-        for story_id in top_stories[:self._article_limit]:
-            article = self._get_article_details(story_id)
-            if article:
-                articles.append(article)
-                # APIレート制限を避けるための短い遅延
-                time.sleep(0.1)
+        pending = [(i, story_id) for i, story_id in enumerate(top_stories) if not self._writer.is_done(story_id)]
+        if history is not None:
+            articles = [history[story_id] for _, story_id in pending]
+        else:
+            # 各記事の詳細を並行して取得
+            articles = self._map(self._fetch_article, [story_id for _, story_id in pending])
+        
+        self._stories = []
+        candidates = []
+        for (i, story_id), article in zip(pending, articles):
+            if not article:
+                continue
+            self._stories.append((i, article))
+            if self._summarize_discussions:
+                candidates.append(Candidate(
+                    source="hacker_news",
+                    key=str(story_id),
+                    title=article.get("title", "No Title"),
+                    popularity=article.get("score", 0),
+                    published=article.get("time"),
+                    text=article.get("text", ""),
+                    payload=(i, article),
+                ))
+        return candidates
+    
+    def summarize(self, candidates):
+        """選ばれた記事を 記事・コメントの取得 → 要約 → 保存 の段に流し、残りの記事はそのまま保存する"""
+        writer = self._writer
+        selected = {candidate.key for candidate in candidates}
+        
+        run_pipeline("hacker_news", candidates, [
+            Stage("fetch", self._fetch_discussion, workers=FETCH_WORKERS),
+            Stage("summarize", self._summarize_stage, workers=LLM_WORKERS),
+            Stage("render", self._render_stage),
+        ], describe=lambda candidate: candidate.title)
+        
+        for i, article in self._stories:
+            if str(article["id"]) in selected:
+                continue
+            # コレクターの予算を使い切った場合は残りをスキップ
+            if expired():
+                record_skip("hacker_news", article["id"], "collector budget exhausted")
+                continue
+            with span("render", cat="hacker_news", item=article["id"]):
+                # 要約する設定の場合は、次回以降の実行で要約の候補になるよう未完了として保存する
+                writer.append(
+                    article["id"], self._render_article(article), order=i,
+                    complete=not self._summarize_discussions,
+                )
         
         # Markdownで保存
-        self._save_articles_as_markdown(articles)
+        with span("write", cat="hacker_news", items=len(writer)):
+            output_path = writer.finalize()
         
-        print(f"Collected {len(articles)} Hacker News articles")
+        print(f"Saved Hacker News articles to {output_path}")
+        print(f"Collected {len(writer)} Hacker News articles")
+    
+    def _submit(self, func, *args):
+        # ワーカーは呼び出し元のコンテキスト（予算など）を引き継ぐ
+        return self._pool.submit(contextvars.copy_context().run, func, *args)
+    
+    def _map(self, func, items):
+        """`func`を共有のスレッドプールで並行して実行し、結果を元の順番で返す"""
+        futures = [self._submit(func, item) for item in items]
+        return [future.result() for future in futures]
     
     def _get_top_stories(self):
         """トップ記事のIDリストを取得"""
-        response = requests.get(f"{self._api_base_url}/topstories.json")
+        response = http_client.get(f"{self._api_base_url}/topstories.json")
+        response.raise_for_status()
+        return response.json()
+    
+    def _search_stories(self, date):
+        """日本時間でその日に投稿された記事をポイントの高い順に取得（記事ID -> 記事の詳細）"""
+        start, end = clock.day_bounds(date)
+        response = http_client.get(self._search_url, params={
+            "tags": "story",
+            "numericFilters": f"created_at_i>={int(start)},created_at_i<{int(end)}",
+            "hitsPerPage": self._article_limit,
+        })
+        response.raise_for_status()
+        
+        stories = {}
+        for hit in response.json().get("hits", []):
+            article_id = int(hit["objectID"])
+            # Firebase APIの記事と同じ形にそろえる
+            stories[article_id] = {
+                "id": article_id,
+                "title": hit.get("title") or "No Title",
+                "url": hit.get("url") or f"https://news.ycombinator.com/item?id={article_id}",
+                "score": hit.get("points", 0),
+                "by": hit.get("author", "anonymous"),
+                "descendants": hit.get("num_comments", 0),
+                "time": hit.get("created_at_i"),
+                "text": hit.get("story_text") or "",
+            }
+        return stories
+    
+    def _get_item(self, item_id):
+        """記事・コメントの詳細を取得"""
+        response = http_client.get(f"{self._api_base_url}/item/{item_id}.json")
         response.raise_for_status()
         return response.json()
     
-    def _get_article_details(self, article_id):
+    def _fetch_article(self, article_id):
         """記事の詳細情報を取得"""
         try:
-            response = requests.get(f"{self._api_base_url}/item/{article_id}.json")
-            response.raise_for_status()
-            article = response.json()
+            with span("fetch", cat="hacker_news", item=article_id):
+                article = self._get_item(article_id)
             
             # 'story'タイプの記事のみを処理
-            if article.get('type') != 'story':
+            if not article or article.get('type') != 'story':
                 return None
             
             # URLがない記事（Ask HNなど）はHacker News自体のURLを使用
@@ -58,50 +187,201 @@ class HackerNewsCollector:
                 article['url'] = f"https://news.ycombinator.com/item?id={article_id}"
             
             return article
+        except DeadlineExceeded as e:
+            record_skip("hacker_news", article_id, e)
+            return None
         except Exception as e:
             print(f"Error fetching article {article_id}: {e}")
             return None
     
-    def _save_articles_as_markdown(self, articles):
-        """記事をMarkdownフォーマットで保存"""
-        # 日本時間で現在の日付を取得
-        jst = pytz.timezone('Asia/Tokyo')
-        date = datetime.datetime.now(jst).date()
-        date_str = date.strftime("%Y-%m-%d")
+    def _fetch_comment(self, comment_id):
+        """コメントを取得（削除されたコメントや取得できなかったコメントはNone）"""
+        try:
+            comment = self._get_item(comment_id)
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f"Error fetching comment {comment_id}: {e}")
+            return None
+        if not comment or comment.get("deleted") or comment.get("dead") or not comment.get("text"):
+            return None
+        return comment
+    
+    def _fetch_comment_tree(self, article):
+        """コメントのツリーを幅優先でたどり、深さと件数の上限まで(深さ, コメント)を返す
         
-        output_dir = os.path.join(self._data_dir, "hacker_news")
-        os.makedirs(output_dir, exist_ok=True)
+        同じ深さのコメントはまとめて並行して取得する。各階層のコメントはHacker Newsの表示順
+        （評価の高い順）に並んでいるため、件数の上限に達した場合は上位の議論が残る。
+        """
+        kids = article.get("kids")
+        if kids is None:
+            # 検索APIの結果にはコメントのIDが含まれないため、記事の詳細から取得する
+            try:
+                kids = (self._get_item(article["id"]) or {}).get("kids", [])
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                print(f"Error fetching comments of {article['id']}: {e}")
+                kids = []
         
-        output_path = os.path.join(output_dir, f"{date_str}.md")
+        tree = []
+        level = kids
+        for depth in range(self._comment_depth):
+            level = level[:self._comment_limit - len(tree)]
+            if not level or expired():
+                break
+            next_level = []
+            for comment in self._map(self._fetch_comment, level):
+                if comment is None:
+                    continue
+                tree.append((depth, comment))
+                next_level.extend(comment.get("kids", []))
+            level = next_level
         
-        # Markdown形式で記事を整形
-        markdown_content = "# Hacker News Top Stories\n\n"
+        # 表示用に、親のコメントの直後に返信が並ぶ順に並べ替える
+        children = {}
+        for depth, comment in tree:
+            children.setdefault(comment.get("parent"), []).append((depth, comment))
+        ordered = []
         
-        for article in articles:
-            title = article.get('title', 'No Title')
-            url = article.get('url', '')
-            score = article.get('score', 0)
-            author = article.get('by', 'anonymous')
-            comments = article.get('descendants', 0)
-            article_id = article.get('id', '')
-            
-            markdown_content += f"## {title}\n\n"
-            markdown_content += f"**Score**: {score} | "
-            markdown_content += f"**Comments**: {comments} | "
-            markdown_content += f"**Author**: {author}\n\n"
-            
-            markdown_content += f"[Read Article]({url}) | "
-            markdown_content += f"[Discussion](https://news.ycombinator.com/item?id={article_id})\n\n"
-            
-            markdown_content += "---\n\n"
+        def visit(parent_id):
+            for depth, comment in children.get(parent_id, []):
+                ordered.append((depth, comment))
+                visit(comment["id"])
         
-        # ファイルに保存
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(markdown_content)
+        visit(article["id"])
+        return ordered
+    
+    def _fetch_page_text(self, article):
+        """記事のWebページから本文のテキストを取得（Ask HNなどは投稿文を使う）"""
+        from bs4 import BeautifulSoup
         
-        print(f"Saved Hacker News articles to {output_path}")
+        if article.get("text"):
+            return BeautifulSoup(article["text"], "html.parser").get_text(separator="\n", strip=True)
+        url = article["url"]
+        if url.startswith("https://news.ycombinator.com/"):
+            return ""
+        try:
+            response = http_client.get(url, headers=http_client.BROWSER_HEADERS)
+            response.raise_for_status()
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            print(f"Error fetching article content from {url}: {e}")
+            return ""
+        soup = BeautifulSoup(response.text, "html.parser")
+        body = soup.find("article") or soup.find("body") or soup
+        for tag in body.find_all(["script", "style", "iframe", "noscript", "nav", "header", "footer"]):
+            tag.decompose()
+        return body.get_text(separator="\n", strip=True)
+    
+    def _fetch_discussion(self, candidate):
+        """記事ページとコメントのツリーを並行して取得"""
+        article = candidate.payload[1]
+        print(f"Processing article: {article.get('title')}")
+        with span("fetch", cat="hacker_news", item=article["id"]):
+            page = self._submit(self._fetch_page_text, article)
+            comments = self._fetch_comment_tree(article)
+            content = page.result()
+        return {"candidate": candidate, "article": article, "content": content, "comments": comments}
+    
+    def _summarize_stage(self, item):
+        """記事とコメントを要約（Gemini APIの枠が混んでいる場合はスコアの高い記事から通す）"""
+        article = item["article"]
+        title = article.get("title", "No Title")
+        item["complete"] = True
+        with span("summarize", cat="hacker_news", item=title), priority(item["candidate"].score):
+            try:
+                item["summary"] = self._summarize_discussion(article, item["content"], item["comments"])
+            except QuotaExceededError as e:
+                # 利用上限で要約できなかった記事は未要約と明示し、次回の実行でやり直す
+                record_skip("hacker_news", title, e)
+                item["summary"] = UNSUMMARIZED
+                item["complete"] = False
+        return item
+    
+    def _render_stage(self, item):
+        """要約した記事をMarkdown形式に整形して追記"""
+        article = item["article"]
+        with span("render", cat="hacker_news", item=article["id"]):
+            self._writer.append(
+                article["id"], self._render_article(article, item["summary"]),
+                order=item["candidate"].payload[0], complete=item["complete"],
+            )
+        return item
+    
+    def _summarize_discussion(self, article, content, comments):
+        """記事とコメントのツリーを要約"""
+        from bs4 import BeautifulSoup
+        
+        from nook.local.common.gemini_client import summarize_document
+        
+        title = article.get("title", "No Title")
+        discussion = "\n".join(
+            "  " * depth + f"- {comment.get('by', 'anonymous')}: "
+            + BeautifulSoup(comment["text"], "html.parser").get_text(separator=" ", strip=True)
+            for depth, comment in comments
+        )
+        document = f"記事の本文:\n{content or '（取得できませんでした）'}\n\nコメント（インデントは返信）:\n{discussion or '（なし）'}"
+        
+        system_prompt = inspect.cleandoc(
+            """
+            あなたはHacker Newsの記事とその議論の要約を担当するAIアシスタントです。
+            記事の要点と、コメント欄で議論されている主な論点・興味深い意見をまとめてください。
+            回答は日本語で行い、見出しなどは使わず、段落で構成してください。
+            """
+        )
+        
+        def build_prompt(document):
+            return inspect.cleandoc(
+                f"""
+                以下のHacker Newsの記事とコメントを読んで、次の2点をまとめてください。
+                
+                1. 記事の内容
+                2. コメント欄での主な論点や、特に興味深い意見
+                
+                タイトル: {title}
+                URL: {article['url']}
+                
+                {document}
+                
+                要約:
+                """
+            )
+        
+        try:
+            # 長い記事・議論は分けて要約してから、全体の要約にまとめる
+            return summarize_document(
+                self._client, document, build_prompt,
+                system_instruction=system_prompt, title=title,
+            )
+        except (DeadlineExceeded, QuotaExceededError):
+            raise
+        except Exception as e:
+            print(f"Error summarizing article {title}: {e}")
+            return "要約を生成できませんでした。"
+    
+    def _render_article(self, article, summary=None):
+        """記事をMarkdownフォーマットに整形"""
+        title = article.get('title', 'No Title')
+        url = article.get('url', '')
+        score = article.get('score', 0)
+        author = article.get('by', 'anonymous')
+        comments = article.get('descendants', 0)
+        article_id = article.get('id', '')
+        
+        return (
+            f"## {title}\n\n"
+            f"**Score**: {score} | "
+            f"**Comments**: {comments} | "
+            f"**Author**: {author}\n\n"
+            f"[Read Article]({url}) | "
+            f"[Discussion](https://news.ycombinator.com/item?id={article_id})\n\n"
+            + (f"{summary}\n\n" if summary else "")
+            + "---\n\n"
+        )
 
 if __name__ == "__main__":
     # ローカルでテスト実行
     collector = HackerNewsCollector()
-    collector()
\ No newline at end of file
+    collector()
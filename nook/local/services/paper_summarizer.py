@@ -1,71 +1,151 @@
 import os
-import datetime
-import time
 import inspect
-import pytz
+import datetime
+import threading
 from pathlib import Path
 
 import arxiv
-import requests
-from bs4 import BeautifulSoup
 
+from nook.local.common import clock
+from nook.local.common.deadline import (
+    DeadlineExceeded,
+    HTTP_TIMEOUT,
+    call_timeout,
+    record_skip,
+    run_with_timeout,
+)
 from nook.local.common.gemini_client import create_client
+from nook.local.common.output_writer import MarkdownWriter
+from nook.local.common.pipeline import LLM_WORKERS, Stage, run_pipeline
+from nook.local.common.quota import UNSUMMARIZED, QuotaExceededError, priority
+from nook.local.common.ranking import Candidate, select_top
+from nook.local.common.tracing import span
 
 class PaperSummarizer:
     """最新の学術論文を収集・要約するサービス"""
     
     def __init__(self):
         self._data_dir = os.environ.get("DATA_DIR", "./data")
-        self._client = create_client()
-        self._max_papers = 5
+        self._client = create_client(service="paper_summarizer")
+        # 要約の候補にする論文数（カテゴリごと。実際に要約する論文は順位付けで選ぶ）
+        self._max_papers = int(os.environ.get("NOOK_ARXIV_MAX_PAPERS", 15))
+        self._writer = None
+        # arXivは連続したリクエストの間隔を空ける必要があるため、クライアントを共有して順番に検索する
+        # (1ページに多くの論文を含めて、候補を増やしてもリクエスト数が増えにくいようにする)
+        self._page_size = int(os.environ.get("NOOK_ARXIV_PAGE_SIZE", 200))
+        self._arxiv = arxiv.Client(page_size=self._page_size)
+        # 一部のカテゴリの論文が多い日でも他のカテゴリを埋められるよう、取得するページ数の上限だけを決める
+        self._max_pages = int(os.environ.get("NOOK_ARXIV_MAX_PAGES", 5))
+        self._arxiv_lock = threading.Lock()
         
-        # 検索クエリ設定
+        # 検索するカテゴリ（`categories`を全て含む論文。重なる論文は1つにまとめる）
         self._search_queries = [
             {
-                "query": "cat:cs.AI AND cat:cs.LG",
+                "categories": ["cs.AI", "cs.LG"],
                 "name": "AI and Machine Learning",
-                "max_results": self._max_papers
             },
             {
-                "query": "cat:cs.CL",
+                "categories": ["cs.CL"],
                 "name": "Computational Linguistics and NLP",
-                "max_results": self._max_papers
             }
         ]
     
     def __call__(self):
         """arXivから最新の論文を収集・要約"""
+        self.summarize(select_top(self.gather()))
+    
+    def gather(self, date=None):
+        """arXivで最新の論文（`date`を指定した場合はその日に投稿された論文）を検索し、まだ要約していない論文を候補として返す"""
         print("Collecting and summarizing research papers...")
         
-        all_paper_markdowns = []
+        # 日本時間で現在の日付を取得
+        date_str = (date or clock.today_jst()).strftime("%Y-%m-%d")
         
-        for search_config in self._search_queries:
-            query = search_config["query"]
-            name = search_config["name"]
-            max_results = search_config["max_results"]
-            
-            print(f"Searching arXiv for: {name} ({query})")
-            
-            papers = self._search_arxiv(query, max_results)
-            
-            for paper in papers:
-                print(f"Processing paper: {paper.title}")
-                
-                paper_markdown = self._process_paper(paper, name)
-                if paper_markdown:
-                    all_paper_markdowns.append(paper_markdown)
-                
-                # API呼び出しの間隔を空ける
-                time.sleep(1)
+        # 要約が終わった論文から順にファイルへ追記する（中断した場合は続きから再開）
+        self._writer = MarkdownWriter(
+            self._data_dir, "paper_summarizer", date_str,
+            header="# Latest Research Papers\n\n", separator="\n"
+        )
+        
+        # 全てのカテゴリを1つのクエリにまとめ、ページ単位でまとめて取得する
+        query = " OR ".join(
+            "(" + " AND ".join(f"cat:{category}" for category in search_config["categories"]) + ")"
+            for search_config in self._search_queries
+        )
+        if date is not None:
+            query = f"({query}) AND {self._submitted_date_filter(date)}"
+        
+        print(f"Searching arXiv for: {', '.join(config['name'] for config in self._search_queries)} ({query})")
+        
+        try:
+            with span("fetch", cat="paper_summarizer", item="search"):
+                papers = self._search_arxiv(query)
+        except DeadlineExceeded as e:
+            record_skip("paper_summarizer", "search", e)
+            return []
+        
+        candidates = []
+        for i, (paper, names) in enumerate(papers):
+            # 前回の実行で要約済みの論文は候補にしない
+            if self._writer.is_done(paper.entry_id):
+                continue
+            candidates.append(Candidate(
+                source="paper_summarizer",
+                key=paper.entry_id,
+                title=paper.title,
+                published=paper.published.timestamp(),
+                text=paper.summary,
+                payload=(i, paper, ", ".join(names)),
+            ))
+        
+        return candidates
+    
+    def summarize(self, candidates):
+        """選ばれた論文を 要約 → 保存 の段に流し、各段を並行して進める
+        
+        アブストラクトなどは検索結果に含まれているため、論文ごとのページは取得しない。
+        """
+        writer = self._writer
+        
+        run_pipeline("paper_summarizer", candidates, [
+            Stage("summarize", self._summarize_stage, workers=LLM_WORKERS),
+            Stage("render", self._render_paper),
+        ], describe=lambda candidate: candidate.title)
         
         # 保存
-        self._save_papers_as_markdown(all_paper_markdowns)
+        with span("write", cat="paper_summarizer", items=len(writer)):
+            output_path = writer.finalize(write_empty=False)
         
-        print(f"Collected and summarized {len(all_paper_markdowns)} papers")
+        if output_path:
+            print(f"Saved paper summaries to {output_path}")
+        else:
+            print("No papers to save")
+        
+        print(f"Collected and summarized {len(writer)} papers")
+    
+    @staticmethod
+    def _submitted_date_filter(date):
+        """日本時間でその日に投稿された論文に絞り込む条件（arXivの投稿日時はUTC）"""
+        start, end = clock.day_bounds(date)
+        start = datetime.datetime.fromtimestamp(start, datetime.timezone.utc).strftime("%Y%m%d%H%M")
+        end = datetime.datetime.fromtimestamp(end - 60, datetime.timezone.utc).strftime("%Y%m%d%H%M")
+        return f"submittedDate:[{start} TO {end}]"
     
-    def _search_arxiv(self, query, max_results):
-        """arXivで論文を検索"""
-        client = arxiv.Client()
+    def _matching_names(self, paper):
+        """論文が当てはまる検索カテゴリの名前の一覧"""
+        categories = set(paper.categories)
+        return [
+            search_config["name"]
+            for search_config in self._search_queries
+            if categories.issuperset(search_config["categories"])
+        ]
+    
+    def _search_arxiv(self, query):
+        """arXivで論文を新しい順に検索し、(論文, 当てはまるカテゴリ名の一覧)のリストを返す
+        
+        全てのカテゴリで`_max_papers`件集まるか、`_max_pages`ページ分の論文を取得したら打ち切る。
+        """
+        max_results = self._page_size * self._max_pages
         search = arxiv.Search(
             query=query,
             max_results=max_results,
@@ -73,63 +153,75 @@ class PaperSummarizer:
             sort_order=arxiv.SortOrder.Descending
         )
         
-        return list(client.results(search))
+        def collect():
+            counts = {search_config["name"]: 0 for search_config in self._search_queries}
+            papers = []
+            for paper in self._arxiv.results(search):
+                names = self._matching_names(paper)
+                if not any(counts[name] < self._max_papers for name in names):
+                    continue
+                for name in names:
+                    counts[name] += 1
+                papers.append((paper, names))
+                if all(count >= self._max_papers for count in counts.values()):
+                    break
+            return papers
+        
+        # arxivクライアントはタイムアウトを指定できないため、別スレッドで実行して打ち切る
+        # (ページ間の待機とリトライを考慮して1リクエスト分より長めに取る)
+        with self._arxiv_lock:
+            return run_with_timeout(collect, call_timeout(HTTP_TIMEOUT * 3 * self._max_pages))
     
-    def _process_paper(self, paper, category):
-        """論文を処理して要約を含むMarkdownを生成"""
-        try:
-            title = paper.title
-            authors = ", ".join([author.name for author in paper.authors])
-            published = paper.published.strftime("%Y-%m-%d")
-            summary = paper.summary
-            arxiv_url = paper.entry_id
-            pdf_url = paper.pdf_url
-            
-            # 追加情報を取得（可能であれば）
-            additional_content = self._get_paper_additional_content(paper)
-            
-            # 要約を生成
-            ai_summary = self._summarize_paper(title, authors, summary, additional_content)
-            
-            # Markdown形式で論文を整形
-            markdown = f"## {title}\n\n"
-            markdown += f"**Authors**: {authors}  \n"
-            markdown += f"**Published**: {published}  \n"
-            markdown += f"**Category**: {category}  \n"
-            markdown += f"**arXiv**: [{arxiv_url}]({arxiv_url})  \n"
-            markdown += f"**PDF**: [{pdf_url}]({pdf_url})  \n\n"
-            markdown += f"### 要約\n\n{ai_summary}\n\n"
-            markdown += "---\n\n"
-            
-            return markdown
-            
-        except Exception as e:
-            print(f"Error processing paper {paper.title}: {e}")
-            return None
+    def _summarize_stage(self, candidate):
+        """論文を要約（Gemini APIの枠が混んでいる場合はスコアの高い論文から通す）"""
+        paper = candidate.payload[1]
+        item = {"candidate": candidate}
+        title = paper.title
+        authors = ", ".join([author.name for author in paper.authors])
+        item["complete"] = True
+        with span("summarize", cat="paper_summarizer", item=title), priority(item["candidate"].score):
+            try:
+                item["summary"] = self._summarize_paper(title, authors, paper.summary, self._additional_content(paper))
+            except QuotaExceededError as e:
+                # 利用上限で要約できなかった論文は未要約と明示し、次回の実行でやり直す
+                record_skip("paper_summarizer", title, e)
+                item["summary"] = UNSUMMARIZED
+                item["complete"] = False
+        return item
     
-    def _get_paper_additional_content(self, paper):
-        """論文の追加情報を取得（HTMLページなど）"""
-        try:
-            # arXivのHTMLページから追加情報を取得
-            response = requests.get(paper.entry_id, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            })
-            
-            if response.status_code != 200:
-                return ""
-                
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # 論文の要約部分を取得
-            abstract_div = soup.select_one('.abstract')
-            if abstract_div:
-                return abstract_div.get_text(separator=' ', strip=True)
-            
-            return ""
-            
-        except Exception as e:
-            print(f"Error fetching additional content for {paper.title}: {e}")
-            return ""
+    def _render_paper(self, item):
+        """論文をMarkdown形式に整形して追記"""
+        i, paper, category = item["candidate"].payload
+        title = paper.title
+        authors = ", ".join([author.name for author in paper.authors])
+        published = paper.published.strftime("%Y-%m-%d")
+        arxiv_url = paper.entry_id
+        pdf_url = paper.pdf_url
+        
+        with span("render", cat="paper_summarizer", item=title):
+            markdown = (
+                f"## {title}\n\n"
+                f"**Authors**: {authors}  \n"
+                f"**Published**: {published}  \n"
+                f"**Category**: {category}  \n"
+                f"**arXiv**: [{arxiv_url}]({arxiv_url})  \n"
+                f"**PDF**: [{pdf_url}]({pdf_url})  \n\n"
+                f"### 要約\n\n{item['summary']}\n\n"
+                "---\n\n"
+            )
+        self._writer.append(arxiv_url, markdown, order=i, complete=item["complete"])
+        return item
+    
+    @staticmethod
+    def _additional_content(paper):
+        """検索結果に含まれるアブストラクト以外の情報（著者のコメント・掲載先・カテゴリ）"""
+        lines = []
+        if paper.comment:
+            lines.append(f"コメント: {paper.comment}")
+        if paper.journal_ref:
+            lines.append(f"掲載先: {paper.journal_ref}")
+        lines.append(f"カテゴリ: {', '.join(paper.categories)}")
+        return "\n".join(lines)
     
     def _summarize_paper(self, title, authors, abstract, additional_content):
         """論文を要約"""
@@ -137,12 +229,12 @@ class PaperSummarizer:
             """
             あなたは学術論文の要約を行うAIアシスタントです。
             以下の論文のアブストラクトと追加情報を読んで、以下の情報をまとめてください：
-
+            
             1. 研究の背景と目的
             2. 提案されている手法や方法論
             3. 主な成果や結果
             4. 実用的な意義や今後の可能性
-
+            
             要約は日本語で、技術的に正確で、分かりやすくまとめてください。
             """
         )
@@ -169,33 +261,11 @@ class PaperSummarizer:
             )
             
             return summary
+        except (DeadlineExceeded, QuotaExceededError):
+            raise
         except Exception as e:
             print(f"Error summarizing paper {title}: {e}")
             return "要約を生成できませんでした。"
-    
-    def _save_papers_as_markdown(self, paper_markdowns):
-        """論文のMarkdownをファイルに保存"""
-        if not paper_markdowns:
-            print("No papers to save")
-            return
-        
-        # 日本時間で現在の日付を取得
-        jst = pytz.timezone('Asia/Tokyo')
-        date = datetime.datetime.now(jst).date()
-        date_str = date.strftime("%Y-%m-%d")
-        
-        output_dir = os.path.join(self._data_dir, "paper_summarizer")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        output_path = os.path.join(output_dir, f"{date_str}.md")
-        
-        content = "# Latest Research Papers\n\n"
-        content += "\n".join(paper_markdowns)
-        
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        
-        print(f"Saved paper summaries to {output_path}")
 
 if __name__ == "__main__":
     # ローカルでテスト実行
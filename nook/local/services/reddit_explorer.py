@@ -5,12 +5,18 @@ from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Any, Literal
 import sys
-import pytz  # タイムゾーン処理用のライブラリを追加
 
 import praw
 import toml
 
+from nook.local.common import clock
+from nook.local.common.deadline import HTTP_TIMEOUT, expired, record_skip
 from nook.local.common.gemini_client import create_client
+from nook.local.common.output_writer import MarkdownWriter
+from nook.local.common.pipeline import LLM_WORKERS, Stage, run_pipeline
+from nook.local.common.quota import UNSUMMARIZED, QuotaExceededError, priority
+from nook.local.common.ranking import Candidate, select_top
+from nook.local.common.tracing import span
 
 _MARKDOWN_FORMAT = """
 ## {title}
@@ -26,7 +32,8 @@ _MARKDOWN_FORMAT = """
 
 # 設定
 class Config:
-    reddit_top_posts_limit = 10
+    # 要約の候補にする投稿数（実際に要約する投稿は順位付けで選ぶ）
+    reddit_top_posts_limit = 20
     reddit_top_comments_limit = 3
     
     @classmethod
@@ -42,6 +49,8 @@ class RedditPost:
     url: str | None
     upvotes: int
     text: str
+    upvote_ratio: float = 1.0
+    created_utc: float | None = None
     permalink: str = ""
     comments: list[dict[str, str | int]] = field(default_factory=list)
     summary: str = ""
@@ -54,49 +63,101 @@ class RedditExplorer:
             client_id=os.environ.get("REDDIT_CLIENT_ID"),
             client_secret=os.environ.get("REDDIT_CLIENT_SECRET"),
             user_agent=os.environ.get("REDDIT_USER_AGENT"),
+            timeout=int(HTTP_TIMEOUT),
         )
-        self._client = create_client()
+        self._client = create_client(service="reddit_explorer")
         self._data_dir = os.environ.get("DATA_DIR", "./data")
         self._subreddits = Config.load_subreddits()
+        self._writer = None
 
     def __call__(self) -> None:
-        markdowns = []
+        self.summarize(select_top(self.gather()))
+
+    def gather(self) -> list[Candidate]:
+        """各サブレディットの人気投稿を取得し、まだ要約していない投稿を候補として返す"""
         # 日本時間で現在の日付を取得
-        jst = pytz.timezone('Asia/Tokyo')
-        current_date = datetime.datetime.now(jst).date()
+        current_date = clock.today_jst()
+        
+        # 要約が終わった投稿から順にファイルへ追記する（中断した場合は続きから再開）
+        self._writer = self._open_writer(current_date)
         
-        for subreddit in self._subreddits:
+        candidates = []
+        for subreddit_index, subreddit in enumerate(self._subreddits):
             print(f"Fetching posts from r/{subreddit}...")
-            posts = self._retrieve_hot_posts(subreddit)
-            for post in posts:
-                print(f"Processing post: {post.title[:30]}...")
-                post.comments = self._retrieve_top_comments_of_post(post.id)
-                post.summary = self._summarize_reddit_post(post)
-                markdowns.append(self._stylize_post(post))
+            # コレクターの予算を使い切った場合は残りをスキップ
+            if expired():
+                record_skip("reddit_explorer", f"r/{subreddit}", "collector budget exhausted")
+                continue
+            with span("fetch", cat="reddit_explorer", item=f"r/{subreddit}"):
+                posts = self._retrieve_hot_posts(subreddit)
+            for i, post in enumerate(posts):
+                # 前回の実行で要約済みの投稿はコメント取得も要約もやり直さない
+                if self._writer.is_done(post.id):
+                    continue
+                candidates.append(
+                    Candidate(
+                        source="reddit_explorer",
+                        key=post.id,
+                        title=post.title,
+                        popularity=post.upvotes * post.upvote_ratio,
+                        published=post.created_utc,
+                        text=post.text,
+                        payload=(subreddit_index, i, post),
+                    )
+                )
+        return candidates
 
-        # 現在の日付を渡す
-        self._store_summaries(markdowns, current_date)
+    def summarize(self, candidates: list[Candidate]) -> None:
+        """選ばれた投稿を コメント取得 → 要約 → 保存 の段に流し、各段を並行して進める"""
+        writer = self._writer
+        
+        # prawのクライアントはスレッドセーフではないため、コメントの取得は1スレッドで行う
+        run_pipeline("reddit_explorer", candidates, [
+            Stage("fetch", self._fetch_comments),
+            Stage("summarize", self._summarize_stage, workers=LLM_WORKERS),
+            Stage("render", self._render_post),
+        ], describe=lambda candidate: candidate.title)
+
+        with span("write", cat="reddit_explorer", items=len(writer)):
+            output_path = writer.finalize()
+        print(f"Stored Reddit summaries to {output_path}")
         print("Reddit explorer completed")
 
-    def _store_summaries(self, summaries: list[str], date: datetime.date = None) -> None:
+    def _fetch_comments(self, candidate: Candidate) -> Candidate:
+        post = candidate.payload[2]
+        print(f"Processing post: {post.title[:30]}...")
+        with span("fetch", cat="reddit_explorer", item=post.title):
+            post.comments = self._retrieve_top_comments_of_post(post.id)
+        return candidate
+
+    def _summarize_stage(self, candidate: Candidate) -> tuple[Candidate, bool]:
+        post = candidate.payload[2]
+        # Gemini APIの枠が混んでいる場合はスコアの高い投稿から通す
+        with span("summarize", cat="reddit_explorer", item=post.title), priority(candidate.score):
+            try:
+                post.summary = self._summarize_reddit_post(post)
+            except QuotaExceededError as e:
+                # 利用上限で要約できなかった投稿は未要約と明示し、次回の実行でやり直す
+                record_skip("reddit_explorer", post.title, e)
+                post.summary = UNSUMMARIZED
+                return candidate, False
+        return candidate, True
+
+    def _render_post(self, item: tuple[Candidate, bool]) -> Candidate:
+        candidate, complete = item
+        subreddit_index, i, post = candidate.payload
+        with span("render", cat="reddit_explorer", item=post.title):
+            self._writer.append(post.id, self._stylize_post(post), order=[subreddit_index, i], complete=complete)
+        return candidate
+
+    def _open_writer(self, date: datetime.date = None) -> MarkdownWriter:
         # 日付が指定されていない場合は日本時間の現在の日付を使用
         if date is None:
-            jst = pytz.timezone('Asia/Tokyo')
-            date = datetime.datetime.now(jst).date()
+            date = clock.today_jst()
             
         date_str = date.strftime("%Y-%m-%d")
         
-        # 環境変数から保存先ディレクトリを取得
-        output_dir = os.path.join(self._data_dir, "reddit_explorer")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        output_path = os.path.join(output_dir, f"{date_str}.md")
-        content = "\n---\n".join(summaries)
-        
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        
-        print(f"Stored Reddit summaries to {output_path}")
+        return MarkdownWriter(self._data_dir, "reddit_explorer", date_str, separator="\n---\n")
 
     def _retrieve_hot_posts(
         self, subreddit: str, limit: int = None
@@ -128,6 +189,8 @@ class RedditExplorer:
                     url=url,
                     upvotes=post.ups,
                     text=post.selftext,
+                    upvote_ratio=post.upvote_ratio,
+                    created_utc=post.created_utc,
                     thumbnail=post.thumbnail,
                 )
             )
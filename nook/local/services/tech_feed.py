@@ -1,168 +1,351 @@
 import os
 import datetime
-import time
+import calendar
+import threading
+import contextvars
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 import inspect
-import pytz
+import toml
 
 import feedparser
-import requests
 from bs4 import BeautifulSoup
 
-from nook.local.common.gemini_client import create_client
+from nook.local.common import clock, http_client
+from nook.local.common.http_cache import ConditionalCache
+from nook.local.common.deadline import DeadlineExceeded, expired, record_skip
+from nook.local.common.gemini_client import create_client, summarize_document
+from nook.local.common.output_writer import MarkdownWriter
+from nook.local.common.pipeline import FETCH_WORKERS, LLM_WORKERS, PARSE_WORKERS, Stage, run_pipeline
+from nook.local.common.quota import UNSUMMARIZED, QuotaExceededError, priority
+from nook.local.common.ranking import Candidate, select_top
+from nook.local.common.tracing import span
+
+# フィード設定の既定ファイル（環境変数 TECH_FEEDS_FILE で上書き可能）
+DEFAULT_FEEDS_FILE = Path(__file__).resolve().parent.parent / "config" / "tech_feeds.toml"
+
+
+def load_feed_config(path=None):
+    """フィード設定（TOML）を読み込む"""
+    path = path or os.environ.get("TECH_FEEDS_FILE") or DEFAULT_FEEDS_FILE
+    config = toml.load(path)
+    for feed in config.get("feeds", []):
+        if "url" not in feed:
+            raise ValueError(f"Feed without url in {path}: {feed}")
+        feed.setdefault("name", feed.get("key", feed["url"]))
+    config.setdefault("feeds", [])
+    return config
+
+
+def parse_feed(content, limit=None):
+    """フィードを解析し、先頭`limit`件（Noneなら全件）の記事を辞書のリストで返す
+    
+    プロセスプールから呼び出すため、結果はpickleとJSONで保存できる値だけで構成する。
+    """
+    feed = feedparser.parse(content)
+    entries = []
+    for entry in feed.entries[:limit]:
+        published_parsed = entry.get('published_parsed') or entry.get('updated_parsed')
+        contents = entry.get('content') or []
+        entries.append({
+            "title": entry.get('title', 'No Title'),
+            "link": entry.get('link', ''),
+            "published": entry.get('published', entry.get('updated', '')),
+            "published_ts": calendar.timegm(published_parsed) if published_parsed else None,
+            "content": contents[0].get('value', '') if contents else '',
+            "summary": entry.get('summary', ''),
+        })
+    return entries
 
 class TechFeedCollector:
     """テクノロジー関連のRSSフィードを収集・要約するコレクター"""
     
     def __init__(self):
         self._data_dir = os.environ.get("DATA_DIR", "./data")
-        self._client = create_client()
-        self._feed_entries_limit = 5
-        
-        # デフォルトのフィード設定
-        self._feeds = [
-            {
-                "key": "google_ai_blog",
-                "name": "Google AI Blog",
-                "url": "http://googleaiblog.blogspot.com/atom.xml"
-            },
-            {
-                "key": "openai_blog",
-                "name": "OpenAI Blog",
-                "url": "https://openai.com/blog/rss.xml"
-            },
-            {
-                "key": "huggingface_blog",
-                "name": "Hugging Face Blog",
-                "url": "https://huggingface.co/blog/feed.xml"
-            },
-            {
-                "key": "pytorch_blog",
-                "name": "PyTorch Blog",
-                "url": "https://pytorch.org/feed.xml"
-            }
-        ]
+        self._client = create_client(service="tech_feed")
+        # フィード設定をTOMLファイルから読み込む
+        config = load_feed_config()
+        self._feeds = config["feeds"]
+        self._feed_entries_limit = config.get("entries_per_feed", 10)
+        self._max_items = config.get("max_items", 100)
+        self._fetch_workers = config.get("fetch_workers", 16)
+        self._parse_workers = config.get("parse_workers", 0) or os.cpu_count() or 1
+        self._cache = ConditionalCache("tech_feed")
+        self._writer = None
+        # 過去の日付を収集する場合に、コレクターを複製した全ての日で共有するフィードの取得結果
+        self._history = {}
+        self._history_lock = threading.Lock()
     
     def __call__(self):
         """RSSフィードから最新の記事を収集・要約して保存"""
-        print("Collecting tech feed articles...")
+        self.summarize(select_top(self.gather()))
+    
+    def gather(self, date=None):
+        """全フィードを並行して取得・解析し、まだ要約していない記事（`date`を指定した場合はその日に公開された記事）を候補として返す"""
+        print(f"Collecting tech feed articles from {len(self._feeds)} feeds...")
+        
+        # 日本時間で現在の日付を取得
+        date_str = (date or clock.today_jst()).strftime("%Y-%m-%d")
+        
+        # 要約が終わった記事から順にファイルへ追記する（中断した場合は続きから再開）
+        self._writer = MarkdownWriter(
+            self._data_dir, "tech_feed", date_str,
+            header="# Technology Blog Updates\n\n", separator="\n"
+        )
         
-        all_article_markdowns = []
+        if date is None:
+            feeds = self._fetch_feeds()
+        else:
+            feeds = self._fetch_feeds_once()
+            start, end = clock.day_bounds(date)
+        
+        candidates = []
+        for feed_index, feed_info, entries in feeds:
+            if date is None:
+                # フィードごとに新しい記事から設定された件数だけを取り込む
+                entries = entries[:feed_info.get("limit", self._feed_entries_limit)]
+            else:
+                # フィードに残っている記事のうち、その日に公開されたものだけを取り込む
+                entries = [
+                    entry for entry in entries
+                    if entry["published_ts"] is not None and start <= entry["published_ts"] < end
+                ]
+            for i, entry in enumerate(entries):
+                # 前回の実行で要約済みの記事は候補にしない
+                if self._writer.is_done(entry["link"]):
+                    continue
+                candidates.append(Candidate(
+                    source="tech_feed",
+                    key=entry["link"],
+                    title=entry["title"],
+                    published=entry["published_ts"],
+                    text=entry["summary"],
+                    payload=(feed_index, i, feed_info["name"], entry),
+                ))
+        self._cache.save()
+        print(
+            f"Feed cache: {self._cache.hits} not modified, "
+            f"{self._cache.bytes_saved} bytes saved, {self._cache.bytes_downloaded} bytes downloaded"
+        )
+        
+        # 全体の上限まで新しい順に絞り込む
+        candidates.sort(key=lambda candidate: candidate.published or 0, reverse=True)
+        return candidates[:self._max_items]
+    
+    def summarize(self, candidates):
+        """選ばれた記事を 取得 → 本文抽出 → 要約 → 保存 の段に流し、各段を並行して進める"""
+        writer = self._writer
+        
+        run_pipeline("tech_feed", candidates, [
+            Stage("fetch", self._fetch_article, workers=FETCH_WORKERS),
+            Stage("extract", self._extract_article, workers=PARSE_WORKERS),
+            Stage("summarize", self._summarize_stage, workers=LLM_WORKERS),
+            Stage("render", self._render_article),
+        ], describe=lambda candidate: candidate.title)
+        
+        # Markdownで保存
+        with span("write", cat="tech_feed", items=len(writer)):
+            output_path = writer.finalize(write_empty=False)
+        
+        if output_path:
+            print(f"Saved tech feed articles to {output_path}")
+        else:
+            print("No articles to save")
+        
+        print(f"Collected and summarized {len(writer)} tech feed articles")
+    
+    def _fetch_feeds(self):
+        """全フィードを並行して取得し、変更のあったものをプロセスプールで解析する
         
-        for feed_info in self._feeds:
-            feed_name = feed_info["name"]
-            feed_url = feed_info["url"]
+        (フィードの番号, フィード設定, 全ての記事のリスト) を返す。
+        """
+        results = []
+        # 解析するフィードがある場合だけプロセスプールを作る（全て変更なしなら作らない）
+        parser = None
+        
+        with ThreadPoolExecutor(max_workers=self._fetch_workers, thread_name_prefix="feed") as fetcher:
+            fetches = {}
+            for feed_index, feed_info in enumerate(self._feeds):
+                # コレクターの予算を使い切った場合は残りをスキップ
+                if expired():
+                    record_skip("tech_feed", feed_info["name"], "collector budget exhausted")
+                    continue
+                # 期限などのコンテキストをワーカースレッドに引き継ぐ
+                future = fetcher.submit(contextvars.copy_context().run, self._fetch_feed, feed_info)
+                fetches[future] = (feed_index, feed_info)
             
-            print(f"Fetching feed: {feed_name} from {feed_url}")
-            try:
-                # フィードを解析
-                feed = feedparser.parse(feed_url)
+            parses = {}
+            for future in as_completed(fetches):
+                feed_index, feed_info = fetches[future]
+                feed_name = feed_info["name"]
+                try:
+                    response, cached_entries = future.result()
+                except (DeadlineExceeded, http_client.CircuitOpenError) as e:
+                    record_skip("tech_feed", feed_name, e)
+                    continue
+                except Exception as e:
+                    print(f"Error fetching feed {feed_name}: {e}")
+                    continue
+                
+                if response is None:
+                    # 前回から変更がなければ解析済みの記事を再利用する
+                    print(f"Feed not modified: {feed_name}")
+                    results.append((feed_index, feed_info, cached_entries))
+                    continue
                 
-                # 最新の記事を取得
-                for i, entry in enumerate(feed.entries[:self._feed_entries_limit]):
-                    if i >= self._feed_entries_limit:
-                        break
-                    
-                    print(f"Processing article: {entry.title}")
-                    
-                    # 記事の内容を取得・要約
-                    article_markdown = self._process_article(feed_name, entry)
-                    if article_markdown:
-                        all_article_markdowns.append(article_markdown)
-                    
-                    # API呼び出しの間隔を空ける
-                    time.sleep(1)
-                    
-            except Exception as e:
-                print(f"Error processing feed {feed_name}: {e}")
+                # feedparserはCPU負荷が高いため別プロセスで解析する
+                # (スレッドを使っているプロセスからforkしないよう、spawnでワーカーを起動する)
+                if parser is None:
+                    parser = ProcessPoolExecutor(
+                        max_workers=self._parse_workers, mp_context=multiprocessing.get_context("spawn")
+                    )
+                parse_future = parser.submit(parse_feed, response.content)
+                parses[parse_future] = (feed_index, feed_info, response)
         
-        # Markdownで保存
-        self._save_articles_as_markdown(all_article_markdowns)
+        try:
+            for future in as_completed(parses):
+                feed_index, feed_info, response = parses[future]
+                try:
+                    entries = future.result()
+                except BrokenProcessPool:
+                    # ワーカープロセスを使えない環境ではこのプロセスで解析する
+                    entries = parse_feed(response.content)
+                except Exception as e:
+                    print(f"Error parsing feed {feed_info['name']}: {e}")
+                    continue
+                self._cache.store(feed_info["url"], response, entries)
+                results.append((feed_index, feed_info, entries))
+        finally:
+            if parser is not None:
+                parser.shutdown()
         
-        print(f"Collected and summarized {len(all_article_markdowns)} tech feed articles")
+        results.sort(key=lambda result: result[0])
+        return results
+    
+    def _fetch_feeds_once(self):
+        """全フィードを取得する（過去の日付の収集では、フィードの内容は日付によらないため1回だけ取得する）"""
+        with self._history_lock:
+            if "feeds" not in self._history:
+                self._history["feeds"] = self._fetch_feeds()
+            return self._history["feeds"]
     
-    def _process_article(self, feed_name, entry):
-        """記事を処理して要約を含むMarkdownを生成"""
+    def _fetch_feed(self, feed_info):
+        """フィードを条件付きGETで取得"""
+        print(f"Fetching feed: {feed_info['name']} from {feed_info['url']}")
+        # feedparserに直接URLを渡すとタイムアウトを指定できないため、取得は自前で行う
+        with span("fetch", cat="tech_feed", item=feed_info["name"]):
+            return self._cache.get(feed_info["url"])
+    
+    def _fetch_article(self, candidate):
+        """フィードに本文がない記事はWebページを取得する"""
+        entry = candidate.payload[3]
+        print(f"Processing article: {entry['title']}")
+        article = {"candidate": candidate, "entry": entry, "html": None}
+        
+        # エントリーに内容・要約がある場合はそれを使用
+        if entry.get('content') or entry.get('summary'):
+            return article
+        
+        # Webページから内容を取得
+        url = entry["link"]
         try:
-            title = entry.title
-            url = entry.link
-            published = entry.get('published', '')
-            
-            # 公開日を整形
-            try:
-                published_date = datetime.datetime.strptime(published, '%a, %d %b %Y %H:%M:%S %z')
-                published_str = published_date.strftime('%Y-%m-%d')
-            except:
-                published_str = published
-            
-            # 記事の内容を取得
-            content = self._extract_article_content(entry, url)
-            
-            # 内容を要約
-            summary = self._summarize_article(title, content, url)
-            
-            # Markdown形式で記事を整形
-            markdown = f"## {title}\n\n"
-            markdown += f"**Source**: {feed_name}  \n"
-            markdown += f"**Published**: {published_str}  \n"
-            markdown += f"**URL**: [{url}]({url})  \n\n"
-            markdown += f"{summary}\n\n"
-            markdown += "---\n\n"
-            
-            return markdown
-            
+            with span("fetch", cat="tech_feed", item=url):
+                response = http_client.get(url, headers=http_client.BROWSER_HEADERS)
+                response.raise_for_status()
+            article["html"] = response.text
+        except DeadlineExceeded:
+            raise
         except Exception as e:
-            print(f"Error processing article {entry.get('title', 'Unknown')}: {e}")
-            return None
+            print(f"Error fetching article content from {url}: {e}")
+        return article
     
-    def _extract_article_content(self, entry, url):
+    def _extract_article(self, article):
+        """記事の本文を抽出"""
+        with span("extract", cat="tech_feed", item=article["entry"]["title"]):
+            article["content"] = self._extract_article_content(article["entry"], article["html"])
+        return article
+    
+    def _summarize_stage(self, article):
+        """記事を要約（Gemini APIの枠が混んでいる場合はスコアの高い記事から通す）"""
+        entry = article["entry"]
+        title = entry["title"]
+        article["complete"] = True
+        with span("summarize", cat="tech_feed", item=title), priority(article["candidate"].score):
+            try:
+                article["summary"] = self._summarize_article(title, article["content"], entry["link"])
+            except QuotaExceededError as e:
+                # 利用上限で要約できなかった記事は未要約と明示し、次回の実行でやり直す
+                record_skip("tech_feed", title, e)
+                article["summary"] = UNSUMMARIZED
+                article["complete"] = False
+        return article
+    
+    def _render_article(self, article):
+        """記事をMarkdown形式に整形して追記"""
+        feed_index, i, feed_name, entry = article["candidate"].payload
+        title = entry["title"]
+        url = entry["link"]
+        published = entry.get('published', '')
+        
+        # 公開日を整形
+        try:
+            published_date = datetime.datetime.strptime(published, '%a, %d %b %Y %H:%M:%S %z')
+            published_str = published_date.strftime('%Y-%m-%d')
+        except:
+            published_str = published
+        
+        with span("render", cat="tech_feed", item=title):
+            markdown = (
+                f"## {title}\n\n"
+                f"**Source**: {feed_name}  \n"
+                f"**Published**: {published_str}  \n"
+                f"**URL**: [{url}]({url})  \n\n"
+                f"{article['summary']}\n\n"
+                "---\n\n"
+            )
+        self._writer.append(url, markdown, order=[feed_index, i], complete=article["complete"])
+        return article
+    
+    def _extract_article_content(self, entry, html):
         """記事の本文を抽出"""
         # エントリーに内容がある場合はそれを使用
-        if hasattr(entry, 'content') and entry.content:
-            content = entry.content[0].value
+        if entry.get('content'):
+            content = entry['content']
             soup = BeautifulSoup(content, 'html.parser')
-            return soup.get_text(separator=' ', strip=True)
+            return soup.get_text(separator='\n', strip=True)
         
         # 要約がある場合はそれを使用
-        if hasattr(entry, 'summary') and entry.summary:
-            soup = BeautifulSoup(entry.summary, 'html.parser')
-            return soup.get_text(separator=' ', strip=True)
+        if entry.get('summary'):
+            soup = BeautifulSoup(entry['summary'], 'html.parser')
+            return soup.get_text(separator='\n', strip=True)
         
-        # Webページから内容を取得
-        try:
-            response = requests.get(url, headers={
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            })
-            response.raise_for_status()
-            
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # ページから本文を抽出 (一般的なパターン)
-            article = soup.find('article') or soup.find(class_='post-content') or soup.find(class_='entry-content')
-            
-            if article:
-                # スクリプトと広告を削除
-                for tag in article.find_all(['script', 'style', 'iframe', 'noscript']):
-                    tag.decompose()
-                
-                return article.get_text(separator=' ', strip=True)
-            
-            # 見つからない場合は本文から抽出を試みる
-            body = soup.find('body')
-            if body:
-                # 不要な要素を削除
-                for tag in body.find_all(['script', 'style', 'iframe', 'nav', 'header', 'footer']):
-                    tag.decompose()
-                
-                text = body.get_text(separator=' ', strip=True)
-                # 長すぎる場合は最初の部分だけ返す
-                return text[:5000] + '...' if len(text) > 5000 else text
-            
+        if not html:
             return "記事の内容を取得できませんでした。"
+        
+        soup = BeautifulSoup(html, 'html.parser')
+        
+        # ページから本文を抽出 (一般的なパターン)
+        article = soup.find('article') or soup.find(class_='post-content') or soup.find(class_='entry-content')
+        
+        if article:
+            # スクリプトと広告を削除
+            for tag in article.find_all(['script', 'style', 'iframe', 'noscript']):
+                tag.decompose()
             
-        except Exception as e:
-            print(f"Error fetching article content from {url}: {e}")
-            return "記事の内容を取得できませんでした。"
+            return article.get_text(separator='\n', strip=True)
+        
+        # 見つからない場合は本文から抽出を試みる
+        body = soup.find('body')
+        if body:
+            # 不要な要素を削除
+            for tag in body.find_all(['script', 'style', 'iframe', 'nav', 'header', 'footer']):
+                tag.decompose()
+            
+            return body.get_text(separator='\n', strip=True)
+        
+        return "記事の内容を取得できませんでした。"
     
     def _summarize_article(self, title, content, url):
         """記事を要約"""
@@ -175,54 +358,34 @@ class TechFeedCollector:
             """
         )
         
-        content_prompt = inspect.cleandoc(
-            f"""
-            以下の記事を要約してください。
-
-            タイトル: {title}
-            URL: {url}
-
-            内容:
-            {content[:5000]}  # 長すぎる場合は切り詰める
-            
-            要約:
-            """
-        )
+        def build_prompt(content):
+            return inspect.cleandoc(
+                f"""
+                以下の記事を要約してください。
+                
+                タイトル: {title}
+                URL: {url}
+                
+                内容:
+                {content}
+                
+                要約:
+                """
+            )
         
         try:
-            summary = self._client.generate_content(
-                contents=content_prompt,
-                system_instruction=system_prompt
+            # 長い記事は段落の境界で分けて要約してから、全体の要約にまとめる
+            summary = summarize_document(
+                self._client, content, build_prompt,
+                system_instruction=system_prompt, title=title,
             )
             
             return summary
+        except (DeadlineExceeded, QuotaExceededError):
+            raise
         except Exception as e:
             print(f"Error summarizing article {title}: {e}")
             return "要約を生成できませんでした。"
-    
-    def _save_articles_as_markdown(self, article_markdowns):
-        """記事のMarkdownをファイルに保存"""
-        if not article_markdowns:
-            print("No articles to save")
-            return
-        
-        # 日本時間で現在の日付を取得
-        jst = pytz.timezone('Asia/Tokyo')
-        date = datetime.datetime.now(jst).date()
-        date_str = date.strftime("%Y-%m-%d")
-        
-        output_dir = os.path.join(self._data_dir, "tech_feed")
-        os.makedirs(output_dir, exist_ok=True)
-        
-        output_path = os.path.join(output_dir, f"{date_str}.md")
-        
-        content = "# Technology Blog Updates\n\n"
-        content += "\n".join(article_markdowns)
-        
-        with open(output_path, "w", encoding="utf-8") as f:
-            f.write(content)
-        
-        print(f"Saved tech feed articles to {output_path}")
 
 if __name__ == "__main__":
     # ローカルでテスト実行
@@ -1,3 +1,7 @@
+// 静的サイトとして書き出したページでは、サーバーのAPIの代わりに書き出し済みのJSONを読む
+const STATIC_EXPORT = document.body.dataset.static === 'true';
+const BASE_URL = document.body.dataset.base || '';
+
 // テーマ切り替え機能
 document.addEventListener('DOMContentLoaded', function() {
     // テーマ設定の初期化
@@ -22,8 +26,11 @@ document.addEventListener('DOMContentLoaded', function() {
     const dateSelector = document.getElementById('date-selector');
     if (dateSelector) {
         dateSelector.addEventListener('change', function() {
-            window.location.href = `/?date=${this.value}`;
+            window.location.href = STATIC_EXPORT ? `${BASE_URL}/${this.value}/` : `/?date=${this.value}`;
         });
+        if (STATIC_EXPORT) {
+            loadStaticDates(dateSelector);
+        }
     }
 
     // カテゴリナビゲーションのイベントリスナー
@@ -32,13 +39,101 @@ document.addEventListener('DOMContentLoaded', function() {
     // チャット機能の初期化
     initializeChat();
     
-    // 初期表示（最初のカテゴリを表示）
-    const firstCategoryLink = document.querySelector('.nav-category .nav-link');
-    if (firstCategoryLink) {
-        firstCategoryLink.click();
+    // 初期表示（最初のカテゴリはページに埋め込まれているため、見出しのイベントだけを設定する）
+    const initialContent = document.querySelector('.article-content[data-app]');
+    if (initialContent) {
+        setupHeadingClickEvents();
+    } else {
+        const firstCategoryLink = document.querySelector('.nav-category .nav-link');
+        if (firstCategoryLink) {
+            firstCategoryLink.click();
+        }
     }
 });
 
+// 書き出し済みの日付の一覧を日付選択に反映する（日付が増えても各日のページを書き出し直さずに済むよう別のファイルにしている）
+function loadStaticDates(dateSelector) {
+    fetch(`${BASE_URL}/dates.json`)
+        .then(response => response.json())
+        .then(dates => {
+            const selected = dateSelector.value;
+            dateSelector.innerHTML = '';
+            dates.forEach(date => {
+                const option = document.createElement('option');
+                option.value = date;
+                option.textContent = date;
+                option.selected = date === selected;
+                dateSelector.appendChild(option);
+            });
+        })
+        .catch(error => {
+            console.error('Error fetching dates:', error);
+        });
+}
+
+// カテゴリの記事を {title, html, headings} の形で取得する
+function fetchArticle(appName, date) {
+    if (STATIC_EXPORT) {
+        // 書き出し時にHTMLへ変換済み
+        return fetch(`${BASE_URL}/${date}/${appName}.json`).then(response => response.json());
+    }
+    // 収集時にHTMLへ変換済みの本文を取得し、取得できなければMarkdownをブラウザで変換する
+    return fetch(`/fetch_rendered?app_name=${appName}&date=${date}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP ${response.status}`);
+            }
+            return response.json();
+        })
+        .catch(error => {
+            console.warn('Falling back to client-side rendering:', error);
+            return fetchAndRenderMarkdown(appName, date);
+        });
+}
+
+// Markdownを取得してブラウザで変換する（Showdownは必要になった時だけ読み込む）
+function fetchAndRenderMarkdown(appName, date) {
+    return Promise.all([
+        fetch(`/fetch_markdown?app_name=${appName}&date=${date}`).then(response => response.json()),
+        loadShowdown(),
+    ])
+        .then(([data]) => {
+            if (!data.content) {
+                return { title: null, html: '', headings: [] };
+            }
+            // マークダウンの変換
+            const converter = new showdown.Converter();
+            const html = converter.makeHtml(data.content);
+            
+            // タイトルと本文を分離
+            const titleMatch = html.match(/<h1>(.*?)<\/h1>/);
+            return {
+                title: titleMatch ? titleMatch[1] : null,
+                html: html.replace(/<h1>.*?<\/h1>/, ''),
+                headings: extractHeadingsFromMarkdown(data.content).map(title => ({ id: null, title: title })),
+            };
+        });
+}
+
+// Showdownの読み込み（ブラウザでMarkdownを変換する場合だけ）
+let showdownPromise = null;
+
+function loadShowdown() {
+    if (!showdownPromise) {
+        showdownPromise = new Promise((resolve, reject) => {
+            const script = document.createElement('script');
+            script.src = 'https://cdn.jsdelivr.net/npm/showdown@2.1.0/dist/showdown.min.js';
+            script.onload = resolve;
+            script.onerror = () => {
+                showdownPromise = null;
+                reject(new Error('Failed to load showdown'));
+            };
+            document.head.appendChild(script);
+        });
+    }
+    return showdownPromise;
+}
+
 // テーマアイコンの更新
 function updateThemeToggleIcon(theme) {
     const themeIcon = document.querySelector('.theme-toggle-icon');
@@ -85,20 +180,23 @@ function updateHeadingsInLeftMenu(appName) {
     const date = document.getElementById('date-selector').value;
     
     // 選択されたカテゴリの見出しを取得
-    fetch(`/fetch_markdown?app_name=${appName}&date=${date}`)
-        .then(response => response.json())
+    fetchArticle(appName, date)
         .then(data => {
-            if (data.content) {
-                // マークダウンから見出しを抽出
-                const headings = extractHeadingsFromMarkdown(data.content);
+            if (data.html) {
+                const headings = data.headings;
                 
                 if (headings.length > 0) {
-                    // 見出しリストを生成
-                    let headingsHTML = '';
+                    // 見出しリストを生成（引用符や<を含む見出しもそのままの文字列で持つよう、要素として組み立てる）
+                    headingsContainer.innerHTML = '';
                     headings.forEach(heading => {
-                        headingsHTML += `<div class="article-heading" data-app="${appName}" data-heading="${heading}">${heading}</div>`;
+                        const headingItem = document.createElement('div');
+                        headingItem.className = 'article-heading';
+                        headingItem.dataset.app = appName;
+                        headingItem.dataset.heading = heading.title;
+                        headingItem.dataset.headingId = heading.id || '';
+                        headingItem.textContent = heading.title;
+                        headingsContainer.appendChild(headingItem);
                     });
-                    headingsContainer.innerHTML = headingsHTML;
                     
                     // 見出しのクリックイベントを設定
                     setupHeadingClickEvents();
@@ -145,6 +243,7 @@ function setupHeadingClickEvents() {
         heading.addEventListener('click', function() {
             const appName = this.getAttribute('data-app');
             const headingText = this.getAttribute('data-heading');
+            const headingId = this.getAttribute('data-heading-id');
             
             // アクティブ状態の切り替え
             document.querySelectorAll('.article-heading').forEach(h => {
@@ -153,13 +252,13 @@ function setupHeadingClickEvents() {
             this.classList.add('active');
             
             // 記事コンテンツの読み込みと特定の見出しへのスクロール
-            loadArticleContent(appName, headingText);
+            loadArticleContent(appName, headingText, headingId);
         });
     });
 }
 
 // 記事コンテンツの読み込み
-function loadArticleContent(appName, headingText = null) {
+function loadArticleContent(appName, headingText = null, headingId = null) {
     const date = document.getElementById('date-selector').value;
     const contentContainer = document.querySelector('.article-content');
     
@@ -187,17 +286,10 @@ function loadArticleContent(appName, headingText = null) {
         }
         
         // 記事データの取得
-        fetch(`/fetch_markdown?app_name=${appName}&date=${date}`)
-            .then(response => response.json())
+        fetchArticle(appName, date)
             .then(data => {
-                if (data.content) {
-                    // マークダウンの変換と表示
-                    const converter = new showdown.Converter();
-                    const html = converter.makeHtml(data.content);
-                    
-                    // タイトルと本文を分離
-                    const titleMatch = html.match(/<h1>(.*?)<\/h1>/);
-                    const title = titleMatch ? titleMatch[1] : appName;
+                if (data.html) {
+                    const title = data.title || appName;
                     
                     // タイトルを設定
                     const titleElement = document.querySelector('.article-title');
@@ -206,16 +298,21 @@ function loadArticleContent(appName, headingText = null) {
                     }
                     
                     // 本文を設定
-                    contentContainer.innerHTML = html.replace(/<h1>.*?<\/h1>/, '');
+                    contentContainer.innerHTML = data.html;
                     
                     // 特定の見出しが指定されている場合、その位置にスクロール
                     if (headingText) {
-                        // 即座に見出しを検索
-                        const headingElement = Array.from(contentContainer.querySelectorAll('h2')).find(
+                        // 即座に見出しを検索（変換時にidを付けた見出しはidで探す）
+                        const headingElement = (headingId && document.getElementById(headingId)) || Array.from(contentContainer.querySelectorAll('h2')).find(
                             h2 => h2.textContent.trim() === headingText
                         );
                         
                         if (headingElement) {
+                            // 過去の関連する項目を見出しの下に表示（索引を持つviewerでのみ）
+                            if (!STATIC_EXPORT) {
+                                showRelatedItems(appName, date, headingText, headingElement);
+                            }
+                            
                             // 画像の読み込みを待ってからスクロール
                             if (document.readyState === 'complete') {
                                 scrollToHeading(headingElement);
@@ -241,6 +338,35 @@ function loadArticleContent(appName, headingText = null) {
     }
 }
 
+// 過去の関連する項目を取得して見出しの下に表示する関数
+function showRelatedItems(appName, date, headingText, headingElement) {
+    const params = new URLSearchParams({ app_name: appName, date: date, title: headingText });
+    fetch(`/related?${params}`)
+        .then(response => response.json())
+        .then(data => {
+            if (!data.items || data.items.length === 0) return;
+            
+            const container = document.createElement('div');
+            container.className = 'related-items';
+            container.innerHTML = '<div class="related-items-title">関連する項目</div>';
+            const list = document.createElement('ul');
+            data.items.forEach(item => {
+                const entry = document.createElement('li');
+                const link = document.createElement('a');
+                link.href = `/?date=${item.date}`;
+                link.textContent = item.title;
+                entry.appendChild(link);
+                entry.appendChild(document.createTextNode(` (${item.source}, ${item.date})`));
+                list.appendChild(entry);
+            });
+            container.appendChild(list);
+            headingElement.insertAdjacentElement('afterend', container);
+        })
+        .catch(error => {
+            console.error('Error fetching related items:', error);
+        });
+}
+
 // 見出しへのスクロール処理を行う関数
 function scrollToHeading(headingElement) {
     // スクロール処理
@@ -11,7 +11,7 @@ load_dotenv()
 
 import uvicorn
 import requests
-from fastapi import FastAPI, Request
+from fastapi import BackgroundTasks, Body, FastAPI, Request
 from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
@@ -19,7 +19,13 @@ from bs4 import BeautifulSoup
 
 # gemini_clientを適切なパスからインポート
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from nook.local.common.gemini_client import create_client
+from nook.local.common import archive
+from nook.local.common.chat_sessions import get_sessions
+from nook.local.common.deadline import DeadlineExceeded, LLM_TIMEOUT, budget
+from nook.local.common.gemini_client import CHUNK_CHARS, condense_document, create_client
+from nook.local.common.quota import INTERACTIVE_PRIORITY, QuotaExceededError, priority
+from nook.local.common.related_index import get_index
+from nook.local.common.rendering import load_rendered
 
 app = FastAPI()
 
@@ -42,13 +48,7 @@ os.makedirs(static_dir, exist_ok=True)
 app.mount("/static", StaticFiles(directory=static_dir), name="static")
 
 # 対象のアプリ名リスト
-app_names = [
-    "github_trending",
-    "hacker_news",
-    "paper_summarizer",
-    "reddit_explorer",
-    "tech_feed",
-]
+app_names = list(archive.SOURCES)
 
 # 天気アイコンの対応表（元のコードから）
 WEATHER_ICONS = {
@@ -141,10 +141,8 @@ def fetch_url_content(url: str) -> str | None:
         # メインコンテンツを抽出（article, main, または本文要素）
         main_content = soup.find("article") or soup.find("main") or soup.find("body")
         if main_content:
-            # テキストを抽出し、余分な空白を削除
-            text = " ".join(main_content.get_text(separator=" ").split())
-            # 長すぎる場合は最初の1000文字に制限
-            return text[:1000] + "..." if len(text) > 1000 else text
+            # テキストを段落の区切りを残して抽出し、余分な空白を削除
+            return main_content.get_text(separator="\n", strip=True)
 
         return None
     except Exception as e:
@@ -153,67 +151,36 @@ def fetch_url_content(url: str) -> str | None:
 
 def fetch_markdown(app_name: str, date_str: str) -> str:
     """
-    指定されたアプリ名と日付のローカルファイルシステム上のMarkdownファイルを取得
+    指定されたアプリ名と日付のMarkdownを、個別のファイルまたは月ごとのパックファイルから取得
     """
-    file_path = os.path.join(data_dir, f"{app_name}/{date_str}.md")
     try:
-        if os.path.exists(file_path):
-            with open(file_path, "r", encoding="utf-8") as f:
-                return f.read()
+        content = archive.read_day(data_dir, app_name, date_str)
+        if content is not None:
+            return content
         else:
             return f"No data available for {app_name} on {date_str}"
     except Exception as e:
-        return f"Error reading {file_path}: {e}"
-
-def extract_headings(markdown_text: str) -> dict:
-    """
-    Markdownテキストからh2見出しとその内容を抽出する
-    """
-    # h2見出し（## で始まる行）を検出
-    h2_pattern = r'^## (.+)$'
-    
-    # 行ごとに分割
-    lines = markdown_text.split('\n')
-    
-    headings = {}
-    current_h2 = None
-    
-    for i, line in enumerate(lines):
-        h2_match = re.match(h2_pattern, line.strip())
-        if h2_match:
-            current_h2 = h2_match.group(1).strip()
-            if current_h2 not in headings:
-                headings[current_h2] = []
-    
-    # 見出しがない場合は「サマリー」という見出しを追加
-    if not headings and markdown_text.strip():
-        headings["サマリー"] = []
-    
-    return headings
+        return f"Error reading {app_name}/{date_str}: {e}"
 
+# ファイル・パックファイルの読み込みと天気APIの呼び出しでイベントループを止めないよう、
+# 以下のエンドポイントはスレッドプールで実行する
 @app.get("/", response_class=HTMLResponse)
-async def index(request: Request, date: str = None):
+def index(request: Request, date: str = None):
     if date is None:
         date = datetime.date.today().strftime("%Y-%m-%d")
     
     # 利用可能な日付のリストを取得
-    available_dates = []
+    available_dates = set()
     for app_name in app_names:
-        app_dir = os.path.join(data_dir, app_name)
-        if os.path.exists(app_dir):
-            for file_name in os.listdir(app_dir):
-                if file_name.endswith(".md"):
-                    date_str = file_name.replace(".md", "")
-                    if date_str not in available_dates:
-                        available_dates.append(date_str)
+        available_dates.update(archive.list_dates(data_dir, app_name))
     
-    available_dates.sort(reverse=True)
+    available_dates = sorted(available_dates, reverse=True)
     
-    # コンテンツを取得
-    contents = {name: fetch_markdown(name, date) for name in app_names}
+    # 収集時にHTMLへ変換済みのコンテンツを取得（最初のカテゴリはページに埋め込んで返す）
+    contents = {name: load_rendered(data_dir, name, date) for name in app_names}
     
-    # 各アプリのh2見出しを抽出
-    headings = {name: extract_headings(content) for name, content in contents.items()}
+    # 各アプリのh2見出し
+    headings = {name: content["headings"] for name, content in contents.items()}
     
     # 天気データを取得
     weather_data = get_weather_data()
@@ -245,19 +212,48 @@ async def index(request: Request, date: str = None):
             "app_names": app_names,
             "weather": weather,
             "available_dates": available_dates,
+            "base": "",
         },
     )
 
 @app.get("/fetch_markdown", response_class=JSONResponse)
-async def get_markdown(app_name: str, date: str):
+def get_markdown(app_name: str, date: str):
     """
     指定されたアプリ名と日付のMarkdownコンテンツを取得するAPIエンドポイント
     """
     content = fetch_markdown(app_name, date)
     return {"content": content}
 
+@app.get("/fetch_rendered", response_class=JSONResponse)
+def get_rendered(app_name: str, date: str):
+    """
+    指定されたアプリ名と日付のコンテンツを、HTMLに変換済みの本文と見出しの一覧として取得するAPIエンドポイント
+    """
+    if app_name not in app_names:
+        return JSONResponse(status_code=404, content={"error": f"unknown app: {app_name}"})
+    return load_rendered(data_dir, app_name, date)
+
+@app.get("/related", response_class=JSONResponse)
+def get_related(app_name: str = None, date: str = None, title: str = None, q: str = None, k: int = 5):
+    """
+    指定した項目（アプリ名・日付・見出し）またはテキスト`q`に類似した、過去の項目を返すAPIエンドポイント
+    """
+    index = get_index()
+    index.refresh()
+    # 索引はコレクター・常駐モードが作る（まだ作られていなければ、リクエストの中では作らずに空を返す）
+    if not len(index):
+        return {"items": []}
+
+    k = max(1, min(k, 50))
+    if q:
+        return {"items": index.search(q, k)}
+    items = index.related(app_name, date, title, k)
+    if items is None:
+        return JSONResponse(status_code=404, content={"items": [], "error": "item not found"})
+    return {"items": items}
+
 @app.get("/api/weather", response_class=JSONResponse)
-async def get_weather():
+def get_weather():
     """天気データを取得するAPIエンドポイント"""
     return get_weather_data()
 
@@ -286,42 +282,97 @@ _MESSAGE = """
 それでは、回答をお願いします。
 """
 
+# リンクの取得やGemini APIの呼び出しでイベントループを止めないよう、スレッドプールで実行する
 @app.post("/chat/{topic_id}")
-async def chat(topic_id: str, request: Request):
-    data = await request.json()
+def chat(topic_id: str, background_tasks: BackgroundTasks, data: dict = Body(...)):
     message = data.get("message")
-    markdown = data.get("markdown")
-    chat_history = data.get("chat_history", "なし")  # チャット履歴を受け取る
-
-    # markdownとメッセージからリンクを抽出
-    links = extract_links(markdown) + extract_links(message)
-
-    # リンクの内容を取得
-    additional_context = []
-    for url in links:
-        if content := fetch_url_content(url):
-            additional_context.append(f"- Content from {url}:\n\n'''{content}'''\n\n")
-
-    # 追加コンテキストがある場合、markdownに追加
-    if additional_context:
-        additional_context = (
-            "\n\n[記事またはユーザーからの質問に含まれるリンクの内容](うまく取得できていない可能性があります)\n\n"
-            + "\n\n".join(additional_context)
-        )
-    else:
-        additional_context = ""
-
-    formatted_message = _MESSAGE.format(
-        markdown=markdown,
-        additional_context=additional_context,
-        chat_history=chat_history,
-        message=message,
-    )
 
-    gemini_client = create_client(use_search=True)
-    response_text = gemini_client.chat_with_search(formatted_message)
+    # 会話はサーバー側でトピックとセッションIDごとに保持する
+    session = get_sessions().get(topic_id, data.get("session_id"))
+    with session.lock:
+        # 記事とリンクの内容はセッションの最初に一度だけ受け取って取得する
+        if data.get("markdown"):
+            session.markdown = data["markdown"]
+        # 以前のクライアントから送られた履歴は、新しいセッションの要約として引き継ぐ
+        chat_history = data.get("chat_history")
+        if chat_history and chat_history != "なし" and not session.summary and not session.turns:
+            session.summary = chat_history
+
+        # markdownとメッセージからリンクを抽出
+        links = extract_links(session.markdown) + extract_links(message)
+
+        # リンクの内容を取得（取得済みのものはセッションに保存した内容を使う）
+        additional_context = []
+        for url in dict.fromkeys(links):
+            if url not in session.link_contents:
+                session.link_contents[url] = _link_context(url)
+            if content := session.link_contents[url]:
+                additional_context.append(f"- Content from {url}:\n\n'''{content}'''\n\n")
+
+        # 追加コンテキストがある場合、markdownに追加
+        if additional_context:
+            additional_context = (
+                "\n\n[記事またはユーザーからの質問に含まれるリンクの内容](うまく取得できていない可能性があります)\n\n"
+                + "\n\n".join(additional_context)
+            )
+        else:
+            additional_context = ""
 
-    return {"response": response_text}
+        formatted_message = _MESSAGE.format(
+            markdown=session.markdown,
+            additional_context=additional_context,
+            chat_history=session.history(),
+            message=message,
+        )
+
+        gemini_client = create_client(use_search=True, service="chat")
+        try:
+            # コレクターと同じクォータマネージャーを通すため、枠が空くまで待つ場合がある
+            # (1回の呼び出しのタイムアウトを超えて待たせない)
+            with budget(LLM_TIMEOUT, name="chat"):
+                response_text = gemini_client.chat_with_search(formatted_message)
+        except QuotaExceededError as e:
+            return JSONResponse(
+                status_code=429,
+                content={
+                    "response": f"Gemini APIの利用上限に達しているため、現在は応答できません。（{e}）",
+                    "session_id": session.session_id,
+                },
+            )
+        except DeadlineExceeded as e:
+            return JSONResponse(
+                status_code=503,
+                content={
+                    "response": f"Gemini APIが混み合っているため応答できませんでした。しばらくしてから再度お試しください。（{e}）",
+                    "session_id": session.session_id,
+                },
+            )
+
+        session.add_turn("user", message)
+        session.add_turn("assistant", response_text)
+
+        # 履歴が長くなったら、応答を返した後に古いやり取りを要約に畳み込む
+        if session.needs_compaction():
+            background_tasks.add_task(_compact_session, session)
+
+    return {"response": response_text, "session_id": session.session_id}
+
+def _link_context(url):
+    """リンク先の内容を取得する（長いページは全体を分割して要約し、要点に縮める）"""
+    content = fetch_url_content(url)
+    if not content or len(content) <= CHUNK_CHARS:
+        return content
+    try:
+        with budget(LLM_TIMEOUT, name="chat"), priority(INTERACTIVE_PRIORITY):
+            return condense_document(create_client(service="chat_context"), content, title=url)
+    except (QuotaExceededError, DeadlineExceeded) as e:
+        # 要約できない場合は先頭の部分だけを使う
+        print(f"Could not condense {url}: {e}")
+        return content[:CHUNK_CHARS]
+
+def _compact_session(session):
+    with budget(LLM_TIMEOUT, name="chat"):
+        session.compact(create_client(service="chat_compaction"))
 
 if __name__ == "__main__":
     # データディレクトリのサブディレクトリを作成
@@ -32,13 +32,17 @@ echo "Using GEMINI_MODEL_NAME: $GEMINI_MODEL_NAME"
 # コマンドライン引数に基づいて実行するモジュールを決定
 if [ "$1" == "collector" ]; then
   echo "Running collector module..."
-  python -m nook.local.collector
+  python -m nook.local.collector "${@:2}"
 elif [ "$1" == "viewer" ]; then
   echo "Starting viewer at http://localhost:8080..."
   python -m nook.local.viewer
+elif [ "$1" == "loadtest" ]; then
+  echo "Running viewer load test..."
+  python -m nook.local.loadtest "${@:2}"
 else
-  echo "Usage: ./run_local.sh [collector|viewer]"
+  echo "Usage: ./run_local.sh [collector|viewer|loadtest]"
   echo "  collector: Run the data collection module"
   echo "  viewer: Start the web viewer"
+  echo "  loadtest: Run a load test against the viewer"
   exit 1
 fi 
\ No newline at end of file
@@ -0,0 +1,47 @@
+import pstats
+
+import pytest
+
+from nook.local.common.pipeline import Stage, run_pipeline
+
+
+def _busy(item):
+    """ワーカースレッドで実行される、計測結果に現れるだけの時間がかかる処理"""
+    total = 0
+    for i in range(20000):
+        total += i * item
+    return total
+
+
+class ThreadedCollector:
+    """パイプラインのワーカースレッドで処理するだけのコレクター"""
+
+    def __call__(self):
+        run_pipeline("threaded", list(range(8)), [
+            Stage("work", _busy, workers=4),
+            Stage("collect", lambda value: value),
+        ])
+
+
+@pytest.fixture
+def collector_module(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DATA_DIR", str(tmp_path / "data"))
+    from nook.local import collector
+
+    monkeypatch.setattr(collector, "data_dir", str(tmp_path / "data"))
+    monkeypatch.setattr(collector, "logs_dir", str(tmp_path / "logs"))
+    monkeypatch.setattr(collector, "COLLECTORS", {"threaded": ("Threaded", __name__, "ThreadedCollector")})
+    (tmp_path / "logs").mkdir(exist_ok=True)
+    return collector
+
+
+def test_profile_includes_pipeline_worker_threads(collector_module, tmp_path):
+    collector_module.main(["--profile", "--only", "threaded"])
+
+    prof_paths = list((tmp_path / "logs").glob("profile_*_threaded.prof"))
+    assert len(prof_paths) == 1
+    stats = pstats.Stats(str(prof_paths[0])).stats
+    calls = {func_name: values[1] for (_, _, func_name), values in stats.items()}
+    # 計測を開始したスレッドではなく、パイプラインのワーカースレッドで呼ばれた関数も含まれる
+    assert calls.get("_busy") == 8